@@ -3,16 +3,40 @@ Excel Splitter Web Application
 Splits master Excel files into multiple files based on user-defined rules
 """
 import os
+import sys
 import pandas as pd
+import numpy as np
+import openpyxl
 import json
+import pyarrow.parquet as pq
+import pyarrow.types as pa_types
 import uuid
-from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_file, session
+import hashlib
+from flask import Flask, render_template, request, jsonify, send_file, session, Response, stream_with_context
 from werkzeug.utils import secure_filename
 import tempfile
 import shutil
 import logging
-import gc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import time
+import re
+import zipfile
+import threading
+import itertools
+import sqlite3
+from contextlib import contextmanager
+from collections import OrderedDict
+from splitting import (ALLOWED_EXTENSIONS, OUTPUT_MIMETYPES, WRITE_COMPRESSLEVEL, XLSX_MAX_ROWS,
+                       categorize_columns, column_codes, condition_columns, evaluate_leaf,
+                       evaluate_plan, format_value, generate_filename, missing_output_columns,
+                       parse_output_options, partition_rows, plan_rules, read_upload, rule_conditions,
+                       sheet_name_for, split_group_rule, validate_rule, write_output, write_workbook)
+try:
+    import fcntl  # POSIX only: lets worker processes lock a chunked upload against each other
+except ImportError:
+    fcntl = None
 
 app = Flask(__name__)
 
@@ -27,136 +51,2108 @@ app.config['PERMANENT_SESSION_LIFETIME'] = 3600  # 1 hour
 
 # Configuration
 UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
-ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
-MAX_FILE_SIZE = int(os.environ.get('MAX_FILE_SIZE', 10 * 1024 * 1024))  # 10MB default
+MAX_FILE_SIZE = int(os.environ.get('MAX_FILE_SIZE', 500 * 1024 * 1024))  # 500MB default
+
+# Ingestion: 'streaming' reads .xlsx rows through openpyxl's read-only iterator, .csv files through
+# pandas' chunked reader and .parquet files batch by batch, all with bounded memory; 'pandas' loads
+# the whole file at once (.xls files always are)
+INGEST_MODE = os.environ.get('INGEST_MODE', 'streaming')
+INGEST_CHUNK_ROWS = int(os.environ.get('INGEST_CHUNK_ROWS', 50000))
+
+# Column value index: every distinct value with its frequency, served a page at a time by /values
+VALUE_PAGE_SIZE = 100
+VALUE_PAGE_MAX = 1000
+VALUE_INDEX_CACHE_ENTRIES = int(os.environ.get('VALUE_INDEX_CACHE_ENTRIES', 8))
+
+# Inverted row index behind /preview: values on at least 1/ROW_INDEX_DENSE_RATIO of the rows are
+# stored as packed row bitmaps, rarer values as sorted row-number lists (whichever is smaller)
+ROW_INDEX_DENSE_RATIO = 32
+
+# Output files are written by this many worker processes (0 or 1 writes in the request process)
+PROCESS_WORKERS = int(os.environ.get('PROCESS_WORKERS', 0))
+process_pool = None
+process_pool_lock = threading.Lock()
+
+# Asynchronous split jobs run on a small thread pool; clients poll /jobs/<job_id>
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', 3600))
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS)
+BUNDLE_CHUNK_SIZE = 1024 * 1024
+
+# LOAD_MODE=compact loads datasets with repeated text as categoricals and integers downcast to the
+# smallest type that holds them, and lets a run with "output_columns" read only the columns it
+# uses; LOAD_MODE=full keeps columns as parsed.
+LOAD_MODE = os.environ.get('LOAD_MODE', 'compact')
+
+# Admission control: each split reserves its estimated memory in the registry before it runs, and
+# waits (up to ADMISSION_WAIT_SECONDS for synchronous requests) while the reservations of running
+# splits would exceed MEMORY_BUDGET_BYTES. 0 disables it.
+MEMORY_BUDGET_BYTES = int(os.environ.get('MEMORY_BUDGET_BYTES', 0))
+ADMISSION_WAIT_SECONDS = float(os.environ.get('ADMISSION_WAIT_SECONDS', 30))
+ADMISSION_POLL_SECONDS = 0.25
+OBJECT_VALUE_BYTES = 64  # Rough size of one Python string held in an object column
 
 # Create upload folder if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Global storage for file paths (session alternative)
-file_storage = {}
+# Sessions, job state and the files produced by each split run (for /bundle) are kept in a SQLite
+# registry, so any gunicorn worker can serve a request for work started on another one
+REGISTRY_PATH = os.environ.get('REGISTRY_PATH', os.path.join(UPLOAD_FOLDER, 'state', 'registry.db'))
+os.makedirs(os.path.dirname(os.path.abspath(REGISTRY_PATH)), exist_ok=True)
+registry_local = threading.local()
+
+REGISTRY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    file_path TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_by_file ON sessions (file_path);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS run_files (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS run_files_by_run ON run_files (run_id);
+CREATE TABLE IF NOT EXISTS output_memo (
+    memo_key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS disk_items (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS disk_items_by_use ON disk_items (last_used);
+CREATE TABLE IF NOT EXISTS disk_pins (
+    pin_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    pid INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS disk_pins_by_path ON disk_pins (path);
+CREATE TABLE IF NOT EXISTS metrics (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels)
+);
+CREATE TABLE IF NOT EXISTS memory_reservations (
+    reservation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    bytes INTEGER NOT NULL,
+    pid INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lazy_outputs (
+    run_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    dataset_id TEXT NOT NULL,
+    memo_key TEXT NOT NULL,
+    output TEXT NOT NULL,
+    PRIMARY KEY (run_id, filename)
+);
+CREATE TABLE IF NOT EXISTS rule_sets (
+    name TEXT PRIMARY KEY,
+    definition TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Saved rule sets: validated and compiled once when saved, then applied to new uploads by name.
+# Each process keeps the decoded plans of the versions it has applied.
+RULE_SET_NAME_PATTERN = re.compile(r'[A-Za-z0-9][A-Za-z0-9 _.-]{0,99}')
+OUTPUT_OPTION_KEYS = ('writer', 'output_mode', 'output_format', 'workbook_name', 'output_columns')
+rule_set_plans = {}  # name -> (updated_at, (predicates, trees))
+rule_set_plans_lock = threading.Lock()
+
+# Disk janitor: uploads, parsed caches, run outputs, memoized files and partial uploads are indexed
+# in the registry with their size and last use. A background thread evicts items idle for longer
+# than DISK_TTL_SECONDS, then the least recently used ones while the total is over DISK_QUOTA_BYTES.
+# Items pinned by a running split are never evicted.
+DISK_QUOTA_BYTES = int(os.environ.get('DISK_QUOTA_BYTES', 5 * 1024 * 1024 * 1024))  # 5GB default
+DISK_TTL_SECONDS = int(os.environ.get('DISK_TTL_SECONDS', 3600))
+DISK_JANITOR_INTERVAL = int(os.environ.get('DISK_JANITOR_INTERVAL', 60))  # 0 disables the background thread
+janitor_wakeup = threading.Event()
+janitor_lock = threading.Lock()
+janitor_pid = None  # Process the janitor thread was started in; forked workers start their own
+
+# Uploads are hashed as they are received and stored as UPLOAD_FOLDER/<sha256>.<ext>, so identical
+# files share one stored copy and parsed cache. Chunked uploads collect in PARTIAL_FOLDER until complete.
+PARTIAL_FOLDER = os.path.join(UPLOAD_FOLDER, 'partial')
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))  # 8MB suggested chunk size
+COPY_BLOCK_SIZE = 1024 * 1024
+os.makedirs(PARTIAL_FOLDER, exist_ok=True)
+
+# Each split run writes into its own OUTPUT_FOLDER/<run_id>/ folder, so concurrent runs never
+# overwrite each other's files. Written files are also linked into MEMO_FOLDER under a hash of
+# (upload content, selected rows, writer); an identical split later links that file instead.
+OUTPUT_FOLDER = os.path.join(UPLOAD_FOLDER, 'outputs')
+MEMO_FOLDER = os.path.join(UPLOAD_FOLDER, 'memo')
+os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+os.makedirs(MEMO_FOLDER, exist_ok=True)
+RUN_ID_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+upload_hashers = {}  # upload_id -> (SHA-256 of the bytes received so far, byte count it covers)
+upload_locks = {}  # upload_id -> lock serializing this process's threads on that upload
+upload_locks_lock = threading.Lock()
+
+# Parsed dataset cache: columnar copies on disk plus an in-memory LRU layer
+CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'cache')
+DATASET_CACHE_MAX_BYTES = int(os.environ.get('DATASET_CACHE_MAX_BYTES', 512 * 1024 * 1024))  # 512MB default
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+
+dataset_cache = OrderedDict()  # dataset_id -> (DataFrame, size in bytes)
+dataset_cache_lock = threading.Lock()
+
+# Errors (ours and other libraries') also go to ERROR_LOG_PATH; the file is only created by the first error
+ERROR_LOG_PATH = os.environ.get('ERROR_LOG_PATH', 'error.log')
+error_log_handler = logging.FileHandler(ERROR_LOG_PATH, delay=True)
+error_log_handler.setLevel(logging.ERROR)
+error_log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+logging.basicConfig(level=logging.ERROR, handlers=[error_log_handler])
+
+# Application log on stderr: LOG_LEVEL sets the threshold and LOG_FORMAT=json writes one JSON object
+# per line. Fields passed with extra= stay structured (appended as key=value in the text format).
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+class LogFormatter(logging.Formatter):
+    """Formats records as text or JSON lines, including the fields passed with extra="""
+    
+    def __init__(self, json_lines=False):
+        super().__init__('%(asctime)s %(levelname)s %(message)s')
+        self.json_lines = json_lines
+    
+    def format(self, record):
+        fields = {key: value for key, value in vars(record).items() if key not in LOG_RECORD_ATTRIBUTES}
+        if not self.json_lines:
+            text = super().format(record)
+            return ' '.join([text] + [f"{key}={value}" for key, value in fields.items()])
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'message': record.getMessage(), **fields}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class StderrHandler(logging.StreamHandler):
+    """Writes to the current sys.stderr, so logging follows a replaced stderr (e.g. under a test runner)"""
+    
+    @property
+    def stream(self):
+        return sys.stderr
+    
+    @stream.setter
+    def stream(self, value):
+        pass
+
+logger = logging.getLogger('excel_splitter')
+logger.setLevel(LOG_LEVEL)
+log_handler = StderrHandler()
+log_handler.setFormatter(LogFormatter(json_lines=LOG_FORMAT == 'json'))
+logger.addHandler(log_handler)
+# Not propagated: the root logger's handlers (the error log among them) would get every record that passes LOG_LEVEL
+logger.propagate = False
+logger.addHandler(error_log_handler)
 
-# Set up error logging
-logging.basicConfig(filename='error.log', level=logging.ERROR, format='%(asctime)s %(levelname)s %(message)s')
+# Stage metrics served by /metrics in Prometheus' text format. Each process buffers its samples
+# and adds them to the registry after every request and background task, so any worker reports
+# the totals of all of them. Stages: upload_save, parse (which includes column_summary),
+# column_summary, load, filter, write and preview.
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRIC_DEFINITIONS = {
+    'excel_splitter_stage_seconds': ('histogram', 'Time spent per processing stage.'),
+    'excel_splitter_stage_rows_total': ('counter', 'Rows handled per processing stage.'),
+    'excel_splitter_stage_bytes_total': ('counter', 'Bytes received (upload_save), parsed (parse) or written (write).'),
+    'excel_splitter_stage_rows_per_second': ('gauge', 'Rows per second per stage over everything recorded.'),
+}
+metrics_buffer = {}  # (metric name, labels as JSON) -> amount to add
+metrics_lock = threading.Lock()
+
+def registry():
+    """Return this thread's connection to the shared registry, creating the schema on first use"""
+    connection = getattr(registry_local, 'connection', None)
+    if connection is None or registry_local.pid != os.getpid():
+        # Autocommit mode; multi-statement updates go through registry_transaction
+        connection = sqlite3.connect(REGISTRY_PATH, timeout=30, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(REGISTRY_SCHEMA)
+        registry_local.connection = connection
+        registry_local.pid = os.getpid()
+    return connection
+
+@contextmanager
+def registry_transaction():
+    """Hold the registry's write lock for a read-modify-write, committing on success"""
+    connection = registry()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+def count_metric(name, amount, **labels):
+    """Add to a counter (or one series of a histogram) in this process's buffer"""
+    key = (name, json.dumps(labels, sort_keys=True))
+    with metrics_lock:
+        metrics_buffer[key] = metrics_buffer.get(key, 0) + amount
+
+def observe_stage(stage, seconds, rows=0, size=0, **fields):
+    """Record one run of a processing stage and log it at debug level"""
+    count_metric('excel_splitter_stage_seconds_count', 1, stage=stage)
+    count_metric('excel_splitter_stage_seconds_sum', seconds, stage=stage)
+    for bound in STAGE_BUCKETS:
+        # Empty buckets are still written, since every bucket of a histogram must be present
+        count_metric('excel_splitter_stage_seconds_bucket', int(seconds <= bound), stage=stage, le=str(bound))
+    count_metric('excel_splitter_stage_seconds_bucket', 1, stage=stage, le='+Inf')
+    if rows:
+        count_metric('excel_splitter_stage_rows_total', rows, stage=stage)
+    if size:
+        count_metric('excel_splitter_stage_bytes_total', size, stage=stage)
+    logger.debug('Stage %s took %.4fs', stage, seconds,
+                 extra={'stage': stage, 'seconds': round(seconds, 6), 'rows': rows, 'bytes': size, **fields})
+
+@contextmanager
+def stage_timer(stage, **fields):
+    """Time a block as one stage; the block may fill in 'rows' and 'bytes' on the yielded dict"""
+    counts = {'rows': 0, 'bytes': 0}
+    start = time.perf_counter()
+    yield counts
+    observe_stage(stage, time.perf_counter() - start, counts['rows'], counts['bytes'], **fields)
+
+def flush_metrics():
+    """Add this process's buffered samples to the registry's totals"""
+    global metrics_buffer
+    with metrics_lock:
+        if not metrics_buffer:
+            return
+        pending, metrics_buffer = metrics_buffer, {}
+    with registry_transaction() as connection:
+        connection.executemany(
+            'INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?) '
+            'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value',
+            [(name, labels, amount) for (name, labels), amount in pending.items()]
+        )
+
+def format_metric_labels(labels):
+    """Render a label dict the way the Prometheus text format expects"""
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+def metric_sort_key(sample):
+    """Order samples by label set, then histogram buckets by bound, then _sum and _count"""
+    name, labels, _ = sample
+    suffix_order = {'bucket': 0, 'sum': 1, 'count': 2}.get(name.rsplit('_', 1)[-1], 0)
+    bound = float(labels.get('le', 'inf'))
+    return sorted((key, value) for key, value in labels.items() if key != 'le'), suffix_order, bound
+
+def render_metrics():
+    """Return every worker's metrics in the Prometheus text exposition format"""
+    flush_metrics()
+    samples = {}
+    for name, labels, value in registry().execute('SELECT name, labels, value FROM metrics'):
+        family = name if name in METRIC_DEFINITIONS else name.rsplit('_', 1)[0]
+        samples.setdefault(family, []).append((name, json.loads(labels), value))
+    
+    # Throughput is derived from the row and time totals rather than stored
+    seconds = {labels['stage']: value for name, labels, value in samples.get('excel_splitter_stage_seconds', [])
+               if name.endswith('_sum')}
+    samples['excel_splitter_stage_rows_per_second'] = [
+        ('excel_splitter_stage_rows_per_second', labels, value / seconds[labels['stage']])
+        for _, labels, value in samples.get('excel_splitter_stage_rows_total', []) if seconds.get(labels['stage'])
+    ]
+    
+    lines = []
+    for family, (kind, help_text) in METRIC_DEFINITIONS.items():
+        if not samples.get(family):
+            continue
+        lines.append(f'# HELP {family} {help_text}')
+        lines.append(f'# TYPE {family} {kind}')
+        for name, labels, value in sorted(samples[family], key=metric_sort_key):
+            number = str(int(value)) if float(value).is_integer() else repr(float(value))
+            lines.append(f'{name}{format_metric_labels(labels)} {number}')
+    return '\n'.join(lines) + '\n'
+
+def set_session_file(session_id, file_path):
+    """Record the stored upload a session works on"""
+    registry().execute('INSERT OR REPLACE INTO sessions (session_id, file_path, created_at) VALUES (?, ?, ?)',
+                       (session_id, file_path, time.time()))
+
+def get_session_file(session_id):
+    """Return the stored upload of a session, or None for an unknown session"""
+    if not session_id:
+        return None
+    row = registry().execute('SELECT file_path FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+    return row[0] if row else None
+
+def forget_session(session_id):
+    """Remove a session; return (its file path, whether another session still uses that file)"""
+    with registry_transaction() as connection:
+        row = connection.execute('SELECT file_path FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        if row is None:
+            return None, False
+        connection.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+        shared = connection.execute('SELECT 1 FROM sessions WHERE file_path = ? LIMIT 1', (row[0],)).fetchone()
+    return row[0], shared is not None
+
+def disk_usage(path):
+    """Bytes used by a file, or by every file under a directory"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass  # Replaced or removed while we walked
+    return total
+
+def track_disk_item(kind, path, size=None):
+    """Record a file or folder in the disk index as just used, measuring it unless size is given"""
+    connection = registry()
+    connection.execute('INSERT OR REPLACE INTO disk_items (path, kind, bytes, last_used) VALUES (?, ?, ?, ?)',
+                       (path, kind, disk_usage(path) if size is None else size, time.time()))
+    if connection.execute('SELECT COALESCE(SUM(bytes), 0) FROM disk_items').fetchone()[0] > DISK_QUOTA_BYTES:
+        janitor_wakeup.set()
+
+def touch_disk_items(*paths):
+    """Mark indexed items as just used, so LRU eviction keeps them longest"""
+    now = time.time()
+    registry().executemany('UPDATE disk_items SET last_used = ? WHERE path = ?', [(now, path) for path in paths])
+
+def untrack_disk_items(*paths):
+    """Drop items whose files were removed or moved by other means"""
+    registry().executemany('DELETE FROM disk_items WHERE path = ?', [(path,) for path in paths])
+
+def add_disk_pins(paths):
+    """Pin paths against the janitor and /cleanup until release_disk_pins; returns the pin IDs"""
+    connection = registry()
+    pin_ids = [connection.execute('INSERT INTO disk_pins (path, pid) VALUES (?, ?)', (path, os.getpid())).lastrowid
+               for path in paths]
+    touch_disk_items(*paths)
+    return pin_ids
+
+def release_disk_pins(pin_ids):
+    """Drop pins taken by add_disk_pins"""
+    registry().executemany('DELETE FROM disk_pins WHERE pin_id = ?', [(pin_id,) for pin_id in pin_ids])
+
+@contextmanager
+def pin_disk_items(paths):
+    """Keep the janitor from evicting paths while a job uses them"""
+    pin_ids = add_disk_pins(paths)
+    try:
+        yield
+    finally:
+        release_disk_pins(pin_ids)
+
+def discard_upload(file_path):
+    """Delete an upload and its parsed cache, unless a job has either pinned; returns whether
+    they were deleted
+    
+    Pinned files stay in the disk index, marked as long idle, so the janitor evicts them as
+    soon as the job releases its pins.
+    """
+    release_dead_pins()
+    dataset_id = dataset_id_for(file_path)
+    paths = (file_path, dataset_cache_dir(dataset_id))
+    with registry_transaction() as connection:
+        if connection.execute('SELECT 1 FROM disk_pins WHERE path IN (?, ?) LIMIT 1', paths).fetchone():
+            connection.execute('UPDATE disk_items SET last_used = 0 WHERE path IN (?, ?)', paths)
+            return False
+        # Deleted while holding the registry lock, so no job can pin the files halfway through
+        connection.execute('DELETE FROM disk_items WHERE path IN (?, ?)', paths)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        drop_dataset(dataset_id)
+    return True
+
+def release_dead_pins():
+    """Drop pins and memory reservations left behind by worker processes that exited mid-job"""
+    if os.name != 'posix':
+        return  # os.kill(pid, 0) only probes a process on POSIX
+    connection = registry()
+    for table in ('disk_pins', 'memory_reservations'):
+        for (pid,) in connection.execute(f'SELECT DISTINCT pid FROM {table}').fetchall():
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                connection.execute(f'DELETE FROM {table} WHERE pid = ?', (pid,))
+            except OSError:
+                pass  # Alive, owned by another user
+
+def estimate_split_memory(dataset_id, columns=None):
+    """Estimate the memory a split of a dataset needs on top of what is already loaded
+    
+    A dataset that isn't in the memory cache has to be loaded first; it is estimated from the
+    row and column counts of its cached parts, with text columns counted as Python strings.
+    Either way the split may copy up to the whole (projected) dataset while writing, once in
+    this process and once in every output worker process.
+    """
+    with dataset_cache_lock:
+        entry = dataset_cache.get(dataset_id)
+    if entry is not None:
+        loaded, size = 0, entry[1]
+        if columns is not None and len(entry[0].columns):
+            size = size * len(columns) // len(entry[0].columns)
+    else:
+        size = 0
+        folder = dataset_cache_dir(dataset_id)
+        for part in dataset_part_names(folder):
+            if not part.endswith('.parquet'):
+                size += os.path.getsize(os.path.join(folder, part)) * 4  # Pickled parts: no schema to go by
+                continue
+            schema = pq.read_schema(os.path.join(folder, part))
+            rows = pq.ParquetFile(os.path.join(folder, part)).metadata.num_rows
+            for field in schema:
+                if columns is None or field.name in columns:
+                    text = pa_types.is_string(field.type) or pa_types.is_large_string(field.type)
+                    size += rows * (OBJECT_VALUE_BYTES if text else 8)
+        loaded = size
+    return loaded + size * (1 + max(PROCESS_WORKERS, 0))
+
+def memory_budget_error(estimate):
+    """Return why a split of this estimated size can never be admitted, or None"""
+    if MEMORY_BUDGET_BYTES <= 0 or estimate <= MEMORY_BUDGET_BYTES:
+        return None
+    return (f'This split needs about {estimate / (1024 * 1024):.1f}MB of memory, more than the server\'s '
+            f'{MEMORY_BUDGET_BYTES / (1024 * 1024):.1f}MB budget. Pick fewer output_columns or split a smaller file.')
+
+def reserve_memory(estimate, wait=None):
+    """Reserve estimate bytes of the memory budget, waiting while running splits hold too much
+    
+    wait is the most seconds to wait (None waits as long as it takes). Returns the reservation
+    ID (0 when admission control is off), or None if the wait ran out.
+    """
+    if MEMORY_BUDGET_BYTES <= 0:
+        return 0
+    deadline = None if wait is None else time.monotonic() + wait
+    while True:
+        release_dead_pins()
+        with registry_transaction() as connection:
+            used = connection.execute('SELECT COALESCE(SUM(bytes), 0) FROM memory_reservations').fetchone()[0]
+            # A split bigger than the budget was rejected up front, so one alone always fits
+            if used == 0 or used + estimate <= MEMORY_BUDGET_BYTES:
+                return connection.execute('INSERT INTO memory_reservations (bytes, pid) VALUES (?, ?)',
+                                          (estimate, os.getpid())).lastrowid
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        time.sleep(ADMISSION_POLL_SECONDS)
+
+def release_memory(reservation_id):
+    """Give back a reservation made by reserve_memory"""
+    if reservation_id:
+        registry().execute('DELETE FROM memory_reservations WHERE reservation_id = ?', (reservation_id,))
+
+def memory_in_use():
+    """Bytes currently reserved by running splits"""
+    return registry().execute('SELECT COALESCE(SUM(bytes), 0) FROM memory_reservations').fetchone()[0]
+
+def remove_disk_item(connection, kind, path):
+    """Delete an evicted item's files, along with what only made sense next to them"""
+    if kind == 'dataset':
+        drop_dataset(os.path.basename(path))
+    elif kind == 'run':
+        shutil.rmtree(path, ignore_errors=True)
+    elif kind == 'partial':
+        forget_chunked_upload(os.path.splitext(os.path.basename(path))[0])
+    elif os.path.exists(path):
+        os.remove(path)
+    
+    if kind == 'upload':
+        # An upload's parsed cache is of no use without it
+        dataset_id = dataset_id_for(path)
+        connection.execute('DELETE FROM disk_items WHERE path = ?', (dataset_cache_dir(dataset_id),))
+        drop_dataset(dataset_id)
+    elif kind == 'memo':
+        connection.execute('DELETE FROM output_memo WHERE path = ?', (path,))
+
+def evict_disk_items():
+    """Evict unpinned items idle for longer than DISK_TTL_SECONDS, then the least recently used
+    ones until the index is back under DISK_QUOTA_BYTES; return the evicted paths
+    
+    Works from the index alone, one item per transaction, so pins taken meanwhile are honored.
+    """
+    release_dead_pins()
+    evicted = []
+    while True:
+        with registry_transaction() as connection:
+            total = connection.execute('SELECT COALESCE(SUM(bytes), 0) FROM disk_items').fetchone()[0]
+            row = connection.execute(
+                'SELECT path, kind, last_used FROM disk_items AS item '
+                'WHERE NOT EXISTS (SELECT 1 FROM disk_pins WHERE disk_pins.path = item.path) '
+                'ORDER BY last_used LIMIT 1'
+            ).fetchone()
+            if row is None or (row[2] >= time.time() - DISK_TTL_SECONDS and total <= DISK_QUOTA_BYTES):
+                break
+            connection.execute('DELETE FROM disk_items WHERE path = ?', (row[0],))
+            remove_disk_item(connection, row[1], row[0])
+        evicted.append(row[0])
+    return evicted
+
+def janitor_loop():
+    """Background thread: evict disk items every DISK_JANITOR_INTERVAL, or sooner when over quota"""
+    while True:
+        janitor_wakeup.wait(DISK_JANITOR_INTERVAL)
+        janitor_wakeup.clear()
+        try:
+            evicted = evict_disk_items()
+            if evicted:
+                logger.info('Janitor evicted %d items', len(evicted), extra={'evicted': len(evicted)})
+            flush_metrics()
+        except Exception as e:
+            logger.error(f"Error in disk janitor: {str(e)}", exc_info=True)
+
+def ensure_janitor():
+    """Start this process's janitor thread if it isn't running yet"""
+    global janitor_pid
+    if DISK_JANITOR_INTERVAL <= 0:
+        return
+    with janitor_lock:
+        if janitor_pid != os.getpid():
+            threading.Thread(target=janitor_loop, name='disk-janitor', daemon=True).start()
+            janitor_pid = os.getpid()
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def generate_filename(rule_data):
-    """Generate filename based on rule data"""
-    if rule_data.get('custom_name'):
-        return f"{rule_data['custom_name']}.xlsx"
-    
-    # Auto-generate name based on rule
-    rule_type = rule_data['rule_type']
-    if rule_type == 'single':
-        col = rule_data['column1']
-        values = rule_data['value1'] if isinstance(rule_data['value1'], list) else [rule_data['value1']]
-        values_str = '_'.join(values)
-        return f"{col}_{values_str}.xlsx"
-    elif rule_type == 'and':
-        # Start with first two columns
-        col1 = rule_data['column1']
-        values1 = rule_data['value1'] if isinstance(rule_data['value1'], list) else [rule_data['value1']]
-        col2 = rule_data['column2']
-        values2 = rule_data['value2'] if isinstance(rule_data['value2'], list) else [rule_data['value2']]
-        values1_str = '_'.join(values1)
-        values2_str = '_'.join(values2)
-        filename = f"{col1}_{values1_str}_{col2}_{values2_str}"
-        
-        # Add additional columns
-        additional_columns = rule_data.get('additional_columns', [])
-        additional_values = rule_data.get('additional_values', [])
-        
-        for i, col in enumerate(additional_columns):
-            if i < len(additional_values):
-                values = additional_values[i] if isinstance(additional_values[i], list) else [additional_values[i]]
-                values_str = '_'.join(values)
-                filename += f"_{col}_{values_str}"
-        
-        return f"{filename}.xlsx"
-    elif rule_type == 'or':
-        # Start with first two columns
-        col1 = rule_data['column1']
-        values1 = rule_data['value1'] if isinstance(rule_data['value1'], list) else [rule_data['value1']]
-        col2 = rule_data['column2']
-        values2 = rule_data['value2'] if isinstance(rule_data['value2'], list) else [rule_data['value2']]
-        values1_str = '_'.join(values1)
-        values2_str = '_'.join(values2)
-        filename = f"{col1}_{values1_str}_OR_{col2}_{values2_str}"
-        
-        # Add additional columns
-        additional_columns = rule_data.get('additional_columns', [])
-        additional_values = rule_data.get('additional_values', [])
-        
-        for i, col in enumerate(additional_columns):
-            if i < len(additional_values):
-                values = additional_values[i] if isinstance(additional_values[i], list) else [additional_values[i]]
-                values_str = '_'.join(values)
-                filename += f"_OR_{col}_{values_str}"
-        
-        return f"{filename}.xlsx"
+def dataset_cache_dir(dataset_id):
+    """Return the directory holding a dataset's cached parts"""
+    return os.path.join(CACHE_FOLDER, dataset_id)
+
+def dataset_paths(dataset_id):
+    """The upload and parsed cache a job on the dataset reads, for pinning"""
+    return [path for path in (dataset_file(dataset_id), dataset_cache_dir(dataset_id)) if path]
+
+def remember_dataset(dataset_id, df):
+    """Put a parsed DataFrame in the in-memory LRU, evicting old entries over the size budget"""
+    size = int(df.memory_usage(index=True, deep=True).sum())
+    with dataset_cache_lock:
+        dataset_cache.pop(dataset_id, None)
+        if size > DATASET_CACHE_MAX_BYTES:
+            return
+        dataset_cache[dataset_id] = (df, size)
+        total = sum(entry[1] for entry in dataset_cache.values())
+        while total > DATASET_CACHE_MAX_BYTES and len(dataset_cache) > 1:
+            _, (_, evicted_size) = dataset_cache.popitem(last=False)
+            total -= evicted_size
+
+def write_dataset_part(folder, index, df):
+    """Write one chunk of a dataset as Parquet, or pickle when Parquet can't represent it"""
+    part_path = os.path.join(folder, f"part-{index:05d}.parquet")
+    try:
+        df.to_parquet(part_path, index=False)
+    except Exception as e:
+        # Mixed-type or non-string headers can't go to Parquet; pickle still beats re-parsing
+        logger.error(f"Falling back to pickle for dataset part {part_path}: {str(e)}")
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        df.to_pickle(os.path.join(folder, f"part-{index:05d}.pkl"))
+
+def write_dataset_parts(dataset_id, chunks):
+    """Write an iterable of DataFrame chunks as a dataset's cache"""
+    final_dir = dataset_cache_dir(dataset_id)
+    tmp_dir = f"{final_dir}.tmp-{uuid.uuid4().hex}"
+    os.makedirs(tmp_dir)
+    try:
+        for index, chunk in enumerate(chunks):
+            write_dataset_part(tmp_dir, index, chunk)
+        # Swap the finished directory in so readers never see a partial dataset
+        if os.path.isdir(final_dir):
+            shutil.rmtree(final_dir)
+        os.rename(tmp_dir, final_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    track_disk_item('dataset', final_dir)
+
+def dataset_part_names(folder):
+    """List the data part files of a cached dataset directory in order"""
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name for name in os.listdir(folder) if name.startswith('part-'))
+
+def read_dataset_parts(dataset_id, columns=None):
+    """Read a dataset's cached parts back into one DataFrame, or None if not cached
+    
+    columns, if given, reads only those columns (in that order).
+    """
+    folder = dataset_cache_dir(dataset_id)
+    if not os.path.isdir(folder):
+        return None
+    frames = []
+    for part in dataset_part_names(folder):
+        part_path = os.path.join(folder, part)
+        if part.endswith('.parquet'):
+            frames.append(pd.read_parquet(part_path, columns=columns))
+        elif part.endswith('.pkl'):
+            frame = pd.read_pickle(part_path)
+            frames.append(frame if columns is None else frame[columns])
+    if not frames:
+        return None
+    if len(frames) == 1:
+        return frames[0]
+    # Chunks infer dtypes independently, so let pandas settle on one dtype per column
+    return pd.concat(frames, ignore_index=True).infer_objects()
+
+def downcast_integers(df):
+    """Store integer columns in the smallest integer type that holds their values"""
+    for col in df.columns:
+        dtype = df[col].dtype
+        if pd.api.types.is_integer_dtype(dtype) and not pd.api.types.is_extension_array_dtype(dtype):
+            df[col] = pd.to_numeric(df[col], downcast='unsigned' if dtype.kind == 'u' else 'integer')
+    return df
+
+def compact_dataset(df):
+    """Shrink a freshly loaded dataset as LOAD_MODE asks; values are unchanged
     
-    return f"split_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+    The parsed dtypes of the columns it changes are kept in df.attrs (which slices of df
+    carry along), so restore_dtypes can write outputs with the input's schema.
+    """
+    if LOAD_MODE == 'compact':
+        parsed = df.dtypes.to_dict()
+        downcast_integers(categorize_columns(df))
+        df.attrs['parsed_dtypes'] = {col: dtype for col, dtype in parsed.items() if df[col].dtype != dtype}
+    return df
+
+def store_dataset(dataset_id, df):
+    """Persist a parsed DataFrame to the on-disk cache and the in-memory LRU"""
+    write_dataset_parts(dataset_id, [df])
+    remember_dataset(dataset_id, compact_dataset(df))
 
-def apply_rule(df, rule_data):
-    """Apply rule to DataFrame and return filtered data"""
-    rule_type = rule_data['rule_type']
+def load_dataset(dataset_id, columns=None):
+    """Return a parsed dataset, parsing the uploaded file only on a cache miss
     
-    if rule_type == 'single':
-        column = rule_data['column1']
-        values = rule_data['value1'] if isinstance(rule_data['value1'], list) else [rule_data['value1']]
-        return df[df[column].isin(values)]
+    columns names the only columns the caller needs. In the compact load mode a dataset that
+    isn't in memory is then read with just those columns, and not kept in the memory cache;
+    the result may hold more columns than asked for.
+    """
+    with dataset_cache_lock:
+        entry = dataset_cache.get(dataset_id)
+        if entry is not None:
+            dataset_cache.move_to_end(dataset_id)
+            return entry[0]
     
-    elif rule_type == 'and':
-        # Start with first two columns
-        col1 = rule_data['column1']
-        values1 = rule_data['value1'] if isinstance(rule_data['value1'], list) else [rule_data['value1']]
-        col2 = rule_data['column2']
-        values2 = rule_data['value2'] if isinstance(rule_data['value2'], list) else [rule_data['value2']]
-        
-        # Apply first two conditions
-        filtered_df = df[(df[col1].isin(values1)) & (df[col2].isin(values2))]
-        
-        # Apply additional columns (3-6) if they exist
-        additional_columns = rule_data.get('additional_columns', [])
-        additional_values = rule_data.get('additional_values', [])
-        
-        for i, col in enumerate(additional_columns):
-            if i < len(additional_values):
-                values = additional_values[i] if isinstance(additional_values[i], list) else [additional_values[i]]
-                filtered_df = filtered_df[filtered_df[col].isin(values)]
-        
-        return filtered_df
-    
-    elif rule_type == 'or':
-        # Start with first two columns
-        col1 = rule_data['column1']
-        values1 = rule_data['value1'] if isinstance(rule_data['value1'], list) else [rule_data['value1']]
-        col2 = rule_data['column2']
-        values2 = rule_data['value2'] if isinstance(rule_data['value2'], list) else [rule_data['value2']]
+    projected = columns is not None and LOAD_MODE == 'compact'
+    try:
+        with stage_timer('load', dataset=dataset_id) as counts:
+            df = read_dataset_parts(dataset_id, list(columns) if projected else None)
+            counts['rows'] = 0 if df is None else len(df)
+    except Exception as e:
+        logger.error(f"Discarding unreadable dataset cache for {dataset_id}: {str(e)}")
+        df = None
+    
+    if df is not None:
+        compact_dataset(df)
+        if not projected:
+            remember_dataset(dataset_id, df)
+        return df
+    
+    file_path = dataset_file(dataset_id)
+    if file_path is None:
+        raise FileNotFoundError(f"No uploaded file for dataset {dataset_id}")
+    df = read_upload(file_path)
+    store_dataset(dataset_id, df)
+    return df
+
+def drop_dataset(dataset_id):
+    """Remove a dataset and its indexes from both cache layers"""
+    with dataset_cache_lock:
+        dataset_cache.pop(dataset_id, None)
+    with value_index_lock:
+        value_index_cache.pop(dataset_id, None)
+        row_index_cache.pop(dataset_id, None)
+    shutil.rmtree(dataset_cache_dir(dataset_id), ignore_errors=True)
+
+def make_column_names(header):
+    """Turn a raw header row into unique column names, following pandas' naming"""
+    header = list(header)
+    while header and header[-1] is None:
+        header.pop()
+    columns = []
+    seen = {}
+    for i, name in enumerate(header):
+        if name is None:
+            name = f"Unnamed: {i}"
+        base = name
+        while name in seen:
+            seen[base] += 1
+            name = f"{base}.{seen[base]}"
+        seen.setdefault(name, 0)
+        columns.append(name)
+    return columns
+
+def ingest_workbook(dataset_id, file_path):
+    """Stream an .xlsx file once: count rows, summarize columns and cache the data in chunks"""
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        columns = make_column_names(next(rows, None) or [])
+        summary = {'columns': columns, 'distinct_values': {}, 'total_rows': 0}
+        if not columns:
+            return summary
         
-        # Apply first two conditions
-        filtered_df = df[(df[col1].isin(values1)) | (df[col2].isin(values2))]
+        width = len(columns)
+        counter = ValueCounter(width)
         
-        # Apply additional columns (3-6) if they exist
-        additional_columns = rule_data.get('additional_columns', [])
-        additional_values = rule_data.get('additional_values', [])
+        def chunks():
+            chunk = []
+            for row in rows:
+                if all(value is None for value in row):
+                    continue
+                row = tuple(row[:width]) + (None,) * (width - len(row))
+                chunk.append(row)
+                summary['total_rows'] += 1
+                
+                if len(chunk) >= INGEST_CHUNK_ROWS:
+                    yield counter.add(pd.DataFrame.from_records(chunk, columns=columns))
+                    chunk = []
+            if chunk or summary['total_rows'] == 0:
+                yield counter.add(pd.DataFrame.from_records(chunk, columns=columns))
         
-        for i, col in enumerate(additional_columns):
-            if i < len(additional_values):
-                values = additional_values[i] if isinstance(additional_values[i], list) else [additional_values[i]]
-                filtered_df = filtered_df | df[df[col].isin(values)]
+        write_dataset_parts(dataset_id, chunks())
+        summary['distinct_values'] = distinct_value_counts(columns, write_value_index(dataset_id, counter))
+        return summary
+    finally:
+        workbook.close()
+
+def ingest_frames(dataset_id, frames, columns=None):
+    """Cache an iterable of DataFrame chunks and summarize them the way ingest_workbook does
+    
+    columns names the columns for when there are no chunks at all.
+    """
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is not None:
+        columns = first.columns.tolist()
+    summary = {'columns': columns or [], 'distinct_values': {}, 'total_rows': 0}
+    if first is None or not columns:
+        return summary
+    
+    counter = ValueCounter(len(columns))
+    
+    def chunks():
+        for chunk in itertools.chain([first], frames):
+            summary['total_rows'] += len(chunk)
+            yield counter.add(chunk)
+    
+    write_dataset_parts(dataset_id, chunks())
+    summary['distinct_values'] = distinct_value_counts(columns, write_value_index(dataset_id, counter))
+    return summary
+
+def ingest_csv(dataset_id, file_path):
+    """Read a CSV file INGEST_CHUNK_ROWS rows at a time: count rows, summarize columns and cache the data"""
+    try:
+        reader = pd.read_csv(file_path, chunksize=INGEST_CHUNK_ROWS, encoding_errors='replace')
+    except pd.errors.EmptyDataError:
+        return {'columns': [], 'distinct_values': {}, 'total_rows': 0}
+    with reader:
+        return ingest_frames(dataset_id, reader)
+
+def ingest_parquet(dataset_id, file_path):
+    """Read a Parquet file batch by batch: count rows, summarize columns and cache the data"""
+    parquet_file = pq.ParquetFile(file_path)
+    batches = (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=INGEST_CHUNK_ROWS))
+    return ingest_frames(dataset_id, batches, parquet_file.schema_arrow.names)
+
+# Bounded-memory readers used by the 'streaming' ingest mode, by upload extension
+STREAMING_INGESTERS = {
+    'xlsx': ingest_workbook,
+    'csv': ingest_csv,
+    'parquet': ingest_parquet,
+}
+
+def ingest_with_pandas(dataset_id, file_path):
+    """Parse a file with pandas in one go (used for .xls and when streaming is disabled)"""
+    df = read_upload(file_path)
+    columns = df.columns.tolist()
+    distinct_values = {}
+    
+    if not df.empty:
+        try:
+            store_dataset(dataset_id, df)
+            counter = ValueCounter(len(columns))
+            counter.add(df)
+            distinct_values = distinct_value_counts(columns, write_value_index(dataset_id, counter))
+        except Exception as e:
+            logger.error(f"Error caching parsed dataset: {str(e)}")
+    
+    return {'columns': columns, 'distinct_values': distinct_values, 'total_rows': len(df)}
+
+def dataset_columns(dataset_id):
+    """Return a dataset's column names, reading only the first cached part when possible"""
+    with dataset_cache_lock:
+        entry = dataset_cache.get(dataset_id)
+        if entry is not None:
+            return entry[0].columns.tolist()
+    
+    folder = dataset_cache_dir(dataset_id)
+    parts = dataset_part_names(folder)
+    if parts:
+        first_part = os.path.join(folder, parts[0])
+        if first_part.endswith('.parquet'):
+            return pq.read_schema(first_part).names
+        return pd.read_pickle(first_part).columns.tolist()
+    return load_dataset(dataset_id).columns.tolist()
+
+def dataset_id_for(file_path):
+    """Return the dataset ID (the content hash) of a stored upload"""
+    return os.path.splitext(os.path.basename(file_path))[0]
+
+def dataset_file(dataset_id):
+    """Return the stored upload for a dataset ID, or None if it has been removed"""
+    for extension in ALLOWED_EXTENSIONS:
+        path = os.path.join(UPLOAD_FOLDER, f"{dataset_id}.{extension}")
+        if os.path.exists(path):
+            return path
+    return None
+
+def dataset_summary_path(dataset_id):
+    """Return the file recording a parsed dataset's upload summary"""
+    return os.path.join(dataset_cache_dir(dataset_id), 'summary.json')
+
+def copy_stream(stream, target, hasher, limit=None):
+    """Copy a byte stream into an open file while hashing it; return the bytes copied
+    
+    Raises ValueError if the stream holds more than limit bytes.
+    """
+    copied = 0
+    while True:
+        block = stream.read(COPY_BLOCK_SIZE)
+        if not block:
+            return copied
+        copied += len(block)
+        if limit is not None and copied > limit:
+            raise ValueError('More data than expected')
+        target.write(block)
+        hasher.update(block)
+
+def upload_filename(filename):
+    """Sanitize an uploaded file's name, keeping its extension even if nothing else survives"""
+    return secure_filename(filename) or f"upload.{filename.rsplit('.', 1)[1].lower()}"
+
+def store_upload(tmp_path, filename, digest):
+    """Move a fully received upload into content-addressed storage and parse it
+    
+    If an identical file was already stored and parsed, tmp_path is discarded and the stored
+    copy and its cache are reused. Returns (stored file path, summary, reused).
+    """
+    extension = filename.rsplit('.', 1)[1].lower()
+    file_path = os.path.join(UPLOAD_FOLDER, f"{digest}.{extension}")
+    summary_path = dataset_summary_path(digest)
+    if os.path.exists(file_path) and os.path.exists(summary_path):
+        try:
+            with open(summary_path) as f:
+                summary = json.load(f)
+            os.remove(tmp_path)
+            touch_disk_items(file_path, dataset_cache_dir(digest))
+            logger.info('Reusing stored upload %s', file_path, extra={'dataset': digest})
+            return file_path, summary, True
+        except (OSError, ValueError) as e:
+            logger.error(f"Ignoring unreadable upload summary {summary_path}: {str(e)}")
+    
+    os.replace(tmp_path, file_path)
+    track_disk_item('upload', file_path)
+    with stage_timer('parse', dataset=digest, format=extension) as counts:
+        if INGEST_MODE == 'streaming' and extension in STREAMING_INGESTERS:
+            summary = STREAMING_INGESTERS[extension](digest, file_path)
+        else:
+            summary = ingest_with_pandas(digest, file_path)
+        counts['rows'] = summary['total_rows']
+        counts['bytes'] = os.path.getsize(file_path)
+    
+    # Only a parse that produced a cache can be reused by later uploads
+    if summary['total_rows'] and summary['columns'] and os.path.isdir(dataset_cache_dir(digest)):
+        tmp_summary = f"{summary_path}.tmp-{uuid.uuid4().hex}"
+        with open(tmp_summary, 'w') as f:
+            json.dump(summary, f, default=str)
+        os.replace(tmp_summary, summary_path)
+    return file_path, summary, False
+
+def upload_path(upload_id, suffix):
+    """Return the partial-data ('.part') or metadata ('.json') file of a chunked upload"""
+    return os.path.join(PARTIAL_FOLDER, f"{upload_id}{suffix}")
+
+def get_chunked_upload(upload_id):
+    """Return a chunked upload's metadata with its received byte count, or None if unknown"""
+    if not re.fullmatch(r'[0-9a-f]{32}', upload_id or ''):
+        return None
+    try:
+        with open(upload_path(upload_id, '.json')) as f:
+            upload = json.load(f)
+        upload['received'] = os.path.getsize(upload_path(upload_id, '.part'))
+    except (OSError, ValueError):
+        return None
+    return upload
+
+@contextmanager
+def upload_lock(upload_id):
+    """Serialize work on one chunked upload across threads and, via flock, worker processes"""
+    with upload_locks_lock:
+        lock = upload_locks.setdefault(upload_id, threading.Lock())
+    with lock:
+        try:
+            handle = open(upload_path(upload_id, '.json'), 'rb') if fcntl else None
+        except FileNotFoundError:
+            handle = None  # Completed meanwhile; the caller's re-check reports it
+        try:
+            if handle:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            yield
+        finally:
+            if handle:
+                handle.close()  # Releases the flock
+
+def upload_hasher(upload_id):
+    """Return the running hash of a chunked upload, re-hashing its partial file if this process's
+    copy was lost or is behind (another worker took the latest chunks)"""
+    received = os.path.getsize(upload_path(upload_id, '.part'))
+    hasher, hashed = upload_hashers.get(upload_id, (None, None))
+    if hashed != received:
+        hasher = hashlib.sha256()
+        with open(upload_path(upload_id, '.part'), 'rb') as f:
+            for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+                hasher.update(block)
+        upload_hashers[upload_id] = (hasher, received)
+    return hasher
+
+def forget_chunked_upload(upload_id):
+    """Remove a chunked upload's partial files and in-memory state"""
+    for suffix in ('.part', '.json'):
+        if os.path.exists(upload_path(upload_id, suffix)):
+            os.remove(upload_path(upload_id, suffix))
+    upload_hashers.pop(upload_id, None)
+    with upload_locks_lock:
+        upload_locks.pop(upload_id, None)
+    untrack_disk_items(upload_path(upload_id, '.part'))
+
+class ValueCounter:
+    """Accumulates the frequency of every distinct value per column over a dataset's chunks"""
+    
+    def __init__(self, width):
+        self.counts = [[] for _ in range(width)]
+        self.rows = 0
+        self.seconds = 0.0  # Time spent counting, reported as the column_summary stage
+    
+    def add(self, df):
+        """Count one chunk's values and return the chunk, so it can wrap a chunk generator"""
+        start = time.perf_counter()
+        self.rows += len(df)
+        for position in range(len(self.counts)):
+            counts = df.iloc[:, position].value_counts(sort=False)
+            counts = counts[counts > 0]  # Categoricals also list unused categories
+            if len(counts):
+                self.counts[position].append(counts)
+        self.seconds += time.perf_counter() - start
+        return df
+    
+    def frame(self):
+        """Return the (position, value, count) table, each column's values in natural sort order"""
+        frames = []
+        for position, chunk_counts in enumerate(self.counts):
+            if not chunk_counts:
+                continue
+            counts = pd.concat(chunk_counts)
+            # Group by the displayed string, keeping one raw value to sort numbers and dates by
+            merged = pd.DataFrame({
+                'value': [format_value(value) for value in counts.index],
+                'raw': counts.index.to_numpy(dtype=object),
+                'count': counts.to_numpy(dtype=np.int64)
+            }).groupby('value', sort=False).agg(raw=('raw', 'first'), count=('count', 'sum')).reset_index()
+            try:
+                merged = merged.sort_values('raw', kind='stable')
+            except TypeError:
+                merged = merged.sort_values('value', kind='stable')  # Mixed types: sort as text
+            merged.insert(0, 'position', position)
+            frames.append(merged[['position', 'value', 'count']])
+        if not frames:
+            return pd.DataFrame({'position': pd.Series(dtype=np.int64), 'value': pd.Series(dtype=object),
+                                 'count': pd.Series(dtype=np.int64)})
+        return pd.concat(frames, ignore_index=True)
+
+value_index_cache = OrderedDict()  # dataset_id -> {column position: searchable value list}
+value_index_lock = threading.Lock()
+
+def value_index_path(dataset_id):
+    """Return the file holding a dataset's column value index, next to its parts"""
+    return os.path.join(dataset_cache_dir(dataset_id), 'values.parquet')
+
+def write_value_index(dataset_id, counter):
+    """Save a counted value index for a dataset and return the (position, value, count) table"""
+    start = time.perf_counter()
+    frame = counter.frame()
+    path = value_index_path(dataset_id)
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+    frame.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    with value_index_lock:
+        value_index_cache.pop(dataset_id, None)
+    observe_stage('column_summary', counter.seconds + time.perf_counter() - start, counter.rows, dataset=dataset_id)
+    return frame
+
+def distinct_value_counts(columns, frame):
+    """Number of distinct values per column name, from a value index table"""
+    sizes = frame.groupby('position').size()
+    return {col: int(sizes.get(position, 0)) for position, col in enumerate(columns)}
+
+def searchable_values(frame):
+    """Prepare one column's (value, count) rows for paging and case-insensitive search"""
+    values = frame['value'].to_numpy(dtype=object)
+    keys = frame['value'].str.lower().reset_index(drop=True)
+    order = np.argsort(keys.to_numpy(dtype=object), kind='stable')
+    return {
+        'values': values,
+        'positions': {value: k for k, value in enumerate(values)},
+        'counts': frame['count'].to_numpy(),
+        'keys': keys,
+        'sorted_keys': keys.to_numpy(dtype=object)[order],
+        'order': order
+    }
+
+def load_value_index(dataset_id):
+    """Return a dataset's value index by column position, building it if it was never saved"""
+    with value_index_lock:
+        index = value_index_cache.get(dataset_id)
+        if index is not None:
+            value_index_cache.move_to_end(dataset_id)
+            return index
+    
+    path = value_index_path(dataset_id)
+    if os.path.exists(path):
+        frame = pd.read_parquet(path)
+    else:
+        df = load_dataset(dataset_id)
+        counter = ValueCounter(df.shape[1])
+        counter.add(df)
+        frame = write_value_index(dataset_id, counter)
+    
+    index = {position: searchable_values(group) for position, group in frame.groupby('position', sort=False)}
+    with value_index_lock:
+        value_index_cache[dataset_id] = index
+        while len(value_index_cache) > max(VALUE_INDEX_CACHE_ENTRIES, 1):
+            value_index_cache.popitem(last=False)
+    return index
+
+def search_values(entry, query='', match='prefix', offset=0, limit=VALUE_PAGE_SIZE):
+    """Return (number of matches, [(value, count)]) for one page of a column's values
+    
+    Prefix search is a binary search over the lower-cased values; substring search scans them.
+    Matches keep the column's sort order.
+    """
+    if entry is None:
+        return 0, []
+    query = query.lower()
+    if not query:
+        matches = None
+        total = len(entry['values'])
+    elif match == 'prefix':
+        sorted_keys = entry['sorted_keys']
+        start = np.searchsorted(sorted_keys, query, side='left')
+        end = np.searchsorted(sorted_keys, query + '\U0010ffff', side='left')
+        matches = np.sort(entry['order'][start:end])
+        total = len(matches)
+    else:
+        matches = np.flatnonzero(entry['keys'].str.contains(query, regex=False).to_numpy())
+        total = len(matches)
+    
+    page = slice(offset, offset + limit)
+    positions = np.arange(total)[page] if matches is None else matches[page]
+    return total, [(entry['values'][i], int(entry['counts'][i])) for i in positions]
+
+row_index_cache = OrderedDict()  # dataset_id -> opened row index, sized like the value index cache
+row_index_build_lock = threading.Lock()
+
+# Number of set bits in every byte value, for counting rows in packed bitmaps
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.int64)
+
+def row_index_dir(dataset_id):
+    """Return the directory holding a dataset's inverted row index"""
+    return os.path.join(dataset_cache_dir(dataset_id), 'rows')
+
+def value_codes(series, entry):
+    """Map every row of a column to its value's position in the column's value index (-1 if missing)"""
+    codes, label_codes, n_categories = column_codes(series)
+    lookup = np.full(n_categories + 1, -1, dtype=np.int64)  # Last slot is what code -1 reads
+    for label, label_code_list in label_codes.items():
+        position = entry['positions'].get(label)
+        if position is not None:
+            lookup[label_code_list] = position
+    return lookup[codes]
+
+def build_row_index(dataset_id):
+    """Write the (column, value) -> rows index for a dataset, unless it already exists
+    
+    Per column it stores the rows of each rare value as one sorted uint32 array sliced by
+    offsets, the rows of each frequent value as a packed bitmap, and a slot array telling
+    which bitmap (or -1 for a row list) each value uses. Values are numbered as in the
+    column's value index.
+    """
+    with row_index_build_lock:
+        folder = row_index_dir(dataset_id)
+        if os.path.exists(os.path.join(folder, 'meta.json')):
+            return
+        df = load_dataset(dataset_id)
+        value_index = load_value_index(dataset_id)
+        n_rows = len(df)
+        start = time.perf_counter()
         
-        return filtered_df
+        tmp_dir = f"{folder}.tmp-{uuid.uuid4().hex}"
+        os.makedirs(tmp_dir)
+        try:
+            for position in range(df.shape[1]):
+                entry = value_index.get(position)
+                if entry is None:
+                    continue
+                codes = value_codes(df.iloc[:, position], entry)
+                counts = np.bincount(codes[codes >= 0], minlength=len(entry['values']))
+                dense = np.flatnonzero(counts * ROW_INDEX_DENSE_RATIO >= n_rows)
+                slots = np.full(len(counts), -1, dtype=np.int32)
+                slots[dense] = np.arange(len(dense), dtype=np.int32)
+                
+                # Rare values: row numbers grouped by value, ascending within each value
+                sparse_rows = np.flatnonzero((codes >= 0) & (slots[codes] < 0)).astype(np.uint32)
+                postings = sparse_rows[np.argsort(codes[sparse_rows], kind='stable')]
+                sparse_counts = counts.copy()
+                sparse_counts[dense] = 0
+                offsets = np.concatenate([[0], np.cumsum(sparse_counts)]).astype(np.int64)
+                
+                bitmaps = np.zeros((len(dense), (n_rows + 7) // 8), dtype=np.uint8)
+                for slot, value_position in enumerate(dense):
+                    bitmaps[slot] = np.packbits(codes == value_position)
+                
+                for name, array in (('postings', postings), ('offsets', offsets), ('slots', slots), ('bitmaps', bitmaps)):
+                    np.save(os.path.join(tmp_dir, f"{name}-{position:05d}.npy"), array)
+            
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump({'rows': n_rows}, f)
+            shutil.rmtree(folder, ignore_errors=True)
+            os.rename(tmp_dir, folder)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        track_disk_item('dataset', dataset_cache_dir(dataset_id))
+        logger.info('Built row index for %s in %.3fs', dataset_id, time.perf_counter() - start,
+                    extra={'dataset': dataset_id, 'rows': n_rows})
+
+def prebuild_row_index(dataset_id):
+    """Background entry point: build a fresh upload's row index so the first preview is fast
     
-    return df
+    The upload and its parsed cache are pinned, as for a run, so the janitor can't remove the
+    cache while the index is built from it.
+    """
+    try:
+        with pin_disk_items(dataset_paths(dataset_id)):
+            build_row_index(dataset_id)
+    except Exception as e:
+        logger.error(f"Error building row index for {dataset_id}: {str(e)}", exc_info=True)
+    finally:
+        flush_metrics()
+
+def load_row_index(dataset_id):
+    """Return a dataset's opened row index, building it first if needed
+    
+    Columns are memory-mapped on first use, so a preview only touches the columns it filters on.
+    """
+    with value_index_lock:
+        index = row_index_cache.get(dataset_id)
+        if index is not None:
+            row_index_cache.move_to_end(dataset_id)
+            return index
+    
+    folder = row_index_dir(dataset_id)
+    if not os.path.exists(os.path.join(folder, 'meta.json')):
+        build_row_index(dataset_id)
+    with open(os.path.join(folder, 'meta.json')) as f:
+        index = {'folder': folder, 'rows': json.load(f)['rows'], 'columns': {}}
+    with value_index_lock:
+        row_index_cache[dataset_id] = index
+        while len(row_index_cache) > max(VALUE_INDEX_CACHE_ENTRIES, 1):
+            row_index_cache.popitem(last=False)
+    return index
+
+def row_index_column(index, position):
+    """Return the memory-mapped arrays of one column of a row index"""
+    column = index['columns'].get(position)
+    if column is None:
+        column = {
+            name: np.load(os.path.join(index['folder'], f"{name}-{position:05d}.npy"), mmap_mode='r')
+            for name in ('postings', 'offsets', 'slots', 'bitmaps')
+        }
+        index['columns'][position] = column
+    return column
+
+def value_bitmap(index, column, entry, values):
+    """Packed bitmap of the rows whose value is any of the given value strings"""
+    bitmap = np.zeros((index['rows'] + 7) // 8, dtype=np.uint8)
+    if entry is None:
+        return bitmap
+    positions = [entry['positions'][value] for value in values if value in entry['positions']]
+    if not positions:
+        return bitmap
+    slots = np.asarray(column['slots'][positions])
+    for slot in slots[slots >= 0]:
+        np.bitwise_or(bitmap, column['bitmaps'][slot], out=bitmap)
+    sparse = [position for position, slot in zip(positions, slots) if slot < 0]
+    if sparse:
+        offsets = column['offsets']
+        rows = np.concatenate([column['postings'][offsets[position]:offsets[position + 1]] for position in sparse])
+        np.bitwise_or.at(bitmap, rows >> 3, (0x80 >> (rows & 7)).astype(np.uint8))
+    return bitmap
+
+def evaluate_bitmap_tree(tree, leaf_bitmaps, all_rows):
+    """Evaluate a predicate tree over packed row bitmaps, mirroring evaluate_tree"""
+    if 'leaf' in tree:
+        return leaf_bitmaps[tree['leaf']]
+    bitmaps = [evaluate_bitmap_tree(child, leaf_bitmaps, all_rows) for child in tree['children']]
+    if tree['op'] == 'not':
+        return np.bitwise_and(np.bitwise_not(bitmaps[0]), all_rows)  # Keep the padding bits clear
+    if not bitmaps:
+        return all_rows
+    combine = np.bitwise_or if tree['op'] == 'or' else np.bitwise_and
+    result = bitmaps[0].copy()
+    for bitmap in bitmaps[1:]:
+        combine(result, bitmap, out=result)
+    return result
+
+def preview_rules(dataset_id, rules):
+    """Count the rows each rule would match without writing anything
+    
+    Returns one entry per rule: {'rule', 'rows'} (plus 'files' for split rules), or
+    {'rule', 'error'} for a rule that can't be applied yet.
+    """
+    columns = dataset_columns(dataset_id)
+    index = load_row_index(dataset_id)
+    value_index = load_value_index(dataset_id)
+    all_rows = np.packbits(np.ones(index['rows'], dtype=bool))
+    
+    results = []
+    filter_rules = []
+    for i, rule in enumerate(rules):
+        error = validate_rule(rule, columns)
+        if error:
+            results.append({'rule': i + 1, 'error': error})
+        elif rule.get('rule_type') == 'split':
+            # Group sizes need the key combinations, which the in-memory dataset answers directly
+            sizes = load_dataset(dataset_id).groupby(rule['columns'], observed=True, dropna=True, sort=False).size()
+            results.append({'rule': i + 1, 'rows': int(sizes.sum()), 'files': int((sizes > 0).sum())})
+        else:
+            results.append({'rule': i + 1})
+            filter_rules.append((i, rule))
+    
+    predicates, trees = plan_rules([rule for _, rule in filter_rules])
+    leaf_bitmaps = {}
+    for key in predicates:
+        if key[0] == 'in':
+            position = columns.index(key[1])
+            leaf_bitmaps[key] = value_bitmap(index, row_index_column(index, position), value_index.get(position), key[2])
+    # Comparisons, ranges, prefixes and date windows aren't in the index; they are evaluated on the dataset
+    other = [key for key in predicates if key[0] != 'in']
+    if other:
+        df = load_dataset(dataset_id, list(dict.fromkeys(key[1] for key in other)))
+        encoded = {}
+        for key in other:
+            leaf_bitmaps[key] = np.packbits(evaluate_leaf(df, key, encoded))
+    for (i, _), tree in zip(filter_rules, trees):
+        results[i]['rows'] = int(POPCOUNT[evaluate_bitmap_tree(tree, leaf_bitmaps, all_rows)].sum())
+    return index['rows'], results
+
+def run_output_dir(run_id):
+    """Return the folder holding a run's files, or None if run_id is not a run ID"""
+    if not RUN_ID_PATTERN.fullmatch(run_id or ''):
+        return None
+    return os.path.join(OUTPUT_FOLDER, run_id)
+
+def canonical_tree(tree):
+    """JSON-serializable form of a predicate tree that ignores the order of values and children"""
+    if 'leaf' in tree:
+        return [sorted(part) if isinstance(part, frozenset) else part for part in tree['leaf']]
+    return [tree['op'], sorted((canonical_tree(child) for child in tree['children']), key=json.dumps)]
+
+def output_memo_key(dataset_id, selection, output):
+    """Hash identifying an output's content: the upload it comes from, the rows it holds, and the
+    format and writer it was written with"""
+    key = [dataset_id, selection, output['format'], output['writer']]
+    if output.get('columns'):
+        key.append(output['columns'])
+    payload = json.dumps(key, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def link_file(source, target):
+    """Put source at target as a hard link (a copy across filesystems), replacing any file there"""
+    tmp_path = os.path.join(os.path.dirname(target), f".{uuid.uuid4().hex}_{os.path.basename(target)}")
+    try:
+        try:
+            os.link(source, tmp_path)
+        except OSError as e:
+            if isinstance(e, FileNotFoundError):
+                raise
+            shutil.copyfile(source, tmp_path)  # e.g. the memo is on another filesystem
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def recall_output(memo_key, target):
+    """Link a memoized output to target and return the entry recorded with it, or None on a miss"""
+    row = registry().execute('SELECT path, entry FROM output_memo WHERE memo_key = ?', (memo_key,)).fetchone()
+    if row is None:
+        return None
+    try:
+        link_file(row[0], target)
+    except FileNotFoundError:
+        # The memoized file was cleaned up; forget it and write the output again
+        registry().execute('DELETE FROM output_memo WHERE memo_key = ?', (memo_key,))
+        return None
+    touch_disk_items(row[0])
+    return json.loads(row[1])
+
+def memoize_output(memo_key, path, entry):
+    """Keep a link to a written output so later identical splits can reuse it"""
+    memo_path = os.path.join(MEMO_FOLDER, f"{memo_key}{os.path.splitext(path)[1]}")
+    try:
+        link_file(path, memo_path)
+        track_disk_item('memo', memo_path)
+        registry().execute('INSERT OR REPLACE INTO output_memo (memo_key, path, entry, created_at) VALUES (?, ?, ?, ?)',
+                           (memo_key, memo_path, json.dumps(entry), time.time()))
+    except Exception as e:
+        # Only reuse is lost; the run's own file is already in place
+        logger.warning(f"Could not memoize {path}: {str(e)}")
+
+def get_process_pool():
+    """Return the shared process pool for writing outputs, creating it on first use"""
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return process_pool
+
+def reset_process_pool():
+    """Drop a broken process pool so the next run starts a fresh one"""
+    global process_pool
+    with process_pool_lock:
+        if process_pool is not None:
+            process_pool.shutdown(wait=False, cancel_futures=True)
+        process_pool = None
+
+def write_rows_task(dataset_id, row_indices, output_path, writer, columns=None):
+    """Process-pool task: load the cached dataset in this worker and write the selected rows
+    
+    Workers read the dataset's columnar cache from disk (and keep it in their own LRU), so
+    only the row indices are pickled per task rather than the DataFrame. columns limits the
+    output to those columns.
+    """
+    df = load_dataset(dataset_id, columns)
+    if columns is not None:
+        df = df[columns]
+    return write_output(df.iloc[row_indices], output_path, writer)
+
+def write_outputs(dataset_id, df, tasks, writer, folder, columns=None):
+    """Write each (rule index, filename, row indices, selection) task into folder and yield
+    (rule index, filename, stats)
+    
+    Tasks run in the process pool when PROCESS_WORKERS > 1, otherwise in this process. A task
+    that fails is logged and yields None stats, so one bad rule doesn't stop the others.
+    df already holds only the output columns; columns names them for the pool's workers.
+    """
+    if PROCESS_WORKERS <= 1 or len(tasks) <= 1:
+        for i, filename, row_indices, _ in tasks:
+            try:
+                stats = write_output(df.iloc[row_indices], os.path.join(folder, filename), writer)
+            except Exception as e:
+                logger.error(f"Error processing rule {i + 1}: {str(e)}", exc_info=True)
+                stats = None
+            yield i, filename, stats
+        return
+    
+    pool = get_process_pool()
+    futures = [
+        (i, filename, pool.submit(write_rows_task, dataset_id, row_indices,
+                                  os.path.join(folder, filename), writer, columns))
+        for i, filename, row_indices, _ in tasks
+    ]
+    for i, filename, future in futures:
+        try:
+            stats = future.result()
+        except BrokenProcessPool as e:
+            logger.error(f"Output worker pool failed on rule {i + 1}: {str(e)}", exc_info=True)
+            reset_process_pool()
+            stats = None
+        except Exception as e:
+            logger.error(f"Error processing rule {i + 1}: {str(e)}", exc_info=True)
+            stats = None
+        yield i, filename, stats
+
+def summarize_write_stats(stats_list, writer, memoized=0):
+    """Combine per-file write stats into totals for a run; memoized counts files reused as-is"""
+    rows = sum(stats['rows'] for stats in stats_list)
+    seconds = sum(stats['seconds'] for stats in stats_list)
+    return {
+        'writer': writer,
+        'files': len(stats_list),
+        'memoized_files': memoized,
+        'rows': rows,
+        'bytes': sum(stats['bytes'] for stats in stats_list),
+        'seconds': round(seconds, 4),
+        'rows_per_second': round(rows / seconds) if seconds > 0 else None
+    }
+
+def run_split(dataset_id, rules, output, run_id, on_progress=None, plan=None):
+    """Apply validated rules to a dataset and write their outputs
+    
+    output is the dict returned by parse_output_options. In 'files' mode each matching rule
+    gets its own file; in 'workbook' mode each becomes a sheet of a single workbook. Files
+    are written to the run's own folder and recorded under run_id for /bundle; outputs an
+    identical earlier split already wrote are linked from the memo instead of written. The
+    upload, its parsed cache and the run folder are pinned against the disk janitor while
+    the run works. on_progress, if given, is called as
+    on_progress(rule index, 'file', file entry) for every file written, as
+    on_progress(rule index, 'file_failed', {'filename', 'rule'}) for every file that couldn't be
+    written (also listed in the result's failed_files), as
+    on_progress(rule index, 'sheet', sheet entry) for every workbook sheet written, and as
+    on_progress(rule index, status) with status 'skipped' (no matching rows), 'done' or
+    'failed' (the rule or one of its files failed) when a rule completes. plan is the rules' (predicates, trees) from plan_rules,
+    when they were compiled ahead of time (saved rule sets).
+    """
+    register_run(run_id)
+    folder = run_output_dir(run_id)
+    os.makedirs(folder, exist_ok=True)
+    track_disk_item('run', folder, 0)
+    with pin_disk_items(dataset_paths(dataset_id) + [folder]):
+        try:
+            return split_into_folder(dataset_id, rules, output, run_id, folder, on_progress, plan)
+        finally:
+            track_disk_item('run', folder)  # Measure what the run wrote
+
+def split_into_folder(dataset_id, rules, output, run_id, folder, on_progress, plan=None):
+    """The work of run_split, done while its inputs and output folder are pinned"""
+    writer = output['writer']
+    df = load_dataset(dataset_id, split_columns(rules, output))
+    
+    def report(i, status, file_entry=None):
+        if on_progress:
+            on_progress(i, status, file_entry)
+    
+    generated_files = []
+    write_stats = []
+    
+    logger.info('Starting run %s with %d rules', run_id, len(rules), extra={'run': run_id, 'dataset': dataset_id})
+    
+    # Evaluate each distinct (column, values) predicate once, shared by all rules
+    with stage_timer('filter', run=run_id) as counts:
+        predicates, trees = plan or plan_rules(rules)
+        rule_masks = evaluate_plan(df, predicates, trees)
+        counts['rows'] = len(df)
+    logger.debug('Evaluated %d distinct predicates for %d rules', len(predicates), len(rules), extra={'run': run_id})
+    
+    # Work out each rule's output first, then write the files (in parallel when a pool is configured)
+    tasks = []
+    for i, rule in enumerate(rules):
+        try:
+            if rule.get('rule_type') == 'split':
+                # One file per distinct key combination, from a single groupby pass
+                with stage_timer('filter', run=run_id, rule=i + 1) as counts:
+                    groups = partition_rows(df, rule['columns'])
+                    counts['rows'] = len(df)
+                if not groups:
+                    logger.debug('Rule %d: no key values to split on, skipping', i + 1, extra={'run': run_id})
+                    report(i, 'skipped')
+                    continue
+                for key, row_indices in groups:
+                    # Raw key values with their types, since distinct keys may format alike
+                    selection = ['split', rule['columns'], [[type(value).__name__, value] for value in key]]
+                    tasks.append((i, generate_filename(split_group_rule(rule, key), output['format']), row_indices, selection))
+                logger.debug('Rule %d split into %d files', i + 1, len(groups), extra={'run': run_id})
+                continue
+            
+            row_indices = np.flatnonzero(rule_masks[i])
+            
+            # Skip if no data matches the rule
+            if len(row_indices) == 0:
+                logger.debug('Rule %d: no data matches, skipping', i + 1, extra={'run': run_id})
+                report(i, 'skipped')
+                continue
+            
+            # Generate filename
+            filename = generate_filename(rule, output['format'])
+            logger.debug('Rule %d matched %d rows into %s', i + 1, len(row_indices), filename, extra={'run': run_id})
+            
+            tasks.append((i, filename, row_indices, canonical_tree(trees[i])))
+            
+        except Exception as e:
+            logger.error(f"Error processing rule {i + 1}: {str(e)}", exc_info=True)
+            report(i, 'failed')
+            continue
+    
+    # Rows are selected on every loaded column; only the output columns are written
+    if output['columns'] is not None:
+        df = df[output['columns']]
+    
+    if output['mode'] == 'workbook':
+        generated_files, write_stats, memoized = write_run_workbook(dataset_id, df, tasks, output, run_id, report)
+        return {
+            'run_id': run_id,
+            'files': generated_files,
+            'total_files': len(generated_files),
+            'bundle_url': f'/bundle/{run_id}',
+            'write_stats': summarize_write_stats(write_stats, writer, memoized)
+        }
+    
+    # A rule is finished once all of its files are written (split rules produce several)
+    # A rule with any file that couldn't be written is reported as failed, and so is the file
+    remaining = {}
+    failed_files = []
+    failed_rules = set()
+    for i, _, _, _ in tasks:
+        remaining[i] = remaining.get(i, 0) + 1
+    
+    def file_done(i, filename, stats, memoized=False, deferred_rows=None):
+        remaining[i] -= 1
+        if stats is None and deferred_rows is None:
+            failed_entry = {'filename': filename, 'rule': i + 1}
+            failed_files.append(failed_entry)
+            failed_rules.add(i)
+            report(i, 'file_failed', failed_entry)
+            if remaining[i] == 0:
+                report(i, 'failed')
+            return
+        file_entry = {
+            'filename': filename,
+            'rows': stats['rows'] if stats is not None else deferred_rows,
+            'download_url': f'/download/{run_id}/{filename}',
+            'write_stats': stats,
+            'memoized': memoized,
+            'deferred': stats is None
+        }
+        generated_files.append(file_entry)
+        add_run_file(run_id, filename, os.path.join(folder, filename))
+        report(i, 'file', file_entry)
+        if remaining[i] == 0:
+            report(i, 'failed' if i in failed_rules else 'done')
+    
+    # Outputs an identical split already wrote are linked from the memo; only the rest are written
+    # In the lazy mode the rest are only recorded, and written by their first download
+    memo_keys = {}
+    to_write = []
+    memoized = 0
+    deferred = 0
+    for i, filename, row_indices, selection in tasks:
+        memo_key = output_memo_key(dataset_id, selection, output)
+        stats = recall_output(memo_key, os.path.join(folder, filename))
+        if stats is not None:
+            memoized += 1
+            file_done(i, filename, stats, memoized=True)
+        elif output['mode'] == 'lazy':
+            defer_output(run_id, folder, filename, dataset_id, row_indices, memo_key, output)
+            deferred += 1
+            file_done(i, filename, None, deferred_rows=len(row_indices))
+        else:
+            memo_keys[filename] = memo_key
+            to_write.append((i, filename, row_indices, selection))
+    
+    for i, filename, stats in write_outputs(dataset_id, df, to_write, writer, folder, output['columns']):
+        if stats is not None:
+            write_stats.append(stats)
+            observe_stage('write', stats['seconds'], stats['rows'], stats['bytes'], run=run_id, file=filename, writer=stats['writer'])
+            memoize_output(memo_keys[filename], os.path.join(folder, filename), stats)
+        file_done(i, filename, stats)
+    
+    logger.info('Run %s generated %d files for %d rules, %d reused, %d deferred', run_id, len(generated_files),
+                len(rules), memoized, deferred,
+                extra={'run': run_id, 'files': len(generated_files), 'memoized': memoized, 'deferred': deferred})
+    return {
+        'run_id': run_id,
+        'files': generated_files,
+        'total_files': len(generated_files),
+        'deferred_files': deferred,
+        'failed_files': failed_files,
+        'bundle_url': f'/bundle/{run_id}',
+        'write_stats': summarize_write_stats(write_stats, writer, memoized)
+    }
+
+def write_run_workbook(dataset_id, df, tasks, output, run_id, report):
+    """Write every (rule index, filename, row indices, selection) task as a sheet of one workbook
+    
+    Sheet names are derived from the task filenames. Returns (file entries, write stats, number
+    of memoized files); the lists are empty when there is nothing to write.
+    """
+    # A sheet holds at most XLSX_MAX_ROWS rows including the header
+    writable = []
+    for task in tasks:
+        if len(task[2]) >= XLSX_MAX_ROWS:
+            logger.error(f"Rule {task[0] + 1}: {len(task[2])} rows do not fit on one sheet, skipping")
+        else:
+            writable.append(task)
+    finished = set()
+    for i in sorted({task[0] for task in tasks} - {task[0] for task in writable}):
+        report(i, 'failed')
+        finished.add(i)
+    if not writable:
+        return [], [], 0
+    
+    filename = generate_filename({'rule_type': 'workbook', 'custom_name': output.get('workbook_name')})
+    output_path = os.path.join(run_output_dir(run_id), filename)
+    
+    # The whole workbook is memoized: same upload, same sheets (named from the task filenames)
+    memo_key = output_memo_key(dataset_id, ['workbook', [[task[1], task[3]] for task in writable]], output)
+    memoized = recall_output(memo_key, output_path)
+    if memoized is not None:
+        for sheet_entry in memoized['sheets']:
+            report(sheet_entry['rule'] - 1, 'sheet', sheet_entry)
+        for i in sorted({task[0] for task in writable}):
+            report(i, 'done')
+        file_entry = {
+            'filename': filename,
+            'rows': memoized['write_stats']['rows'],
+            'sheets': memoized['sheets'],
+            'download_url': f'/download/{run_id}/{filename}',
+            'write_stats': memoized['write_stats'],
+            'memoized': True
+        }
+        add_run_file(run_id, filename, output_path)
+        logger.info('Reused memoized workbook for %s', filename, extra={'run': run_id})
+        return [file_entry], [], 1
+    
+    remaining = {}
+    for i, _, _, _ in writable:
+        remaining[i] = remaining.get(i, 0) + 1
+    used_names = set()
+    sheet_entries = []
+    
+    def sheets():
+        for i, task_filename, row_indices, _ in writable:
+            sheet_name = sheet_name_for(task_filename, used_names)
+            yield sheet_name, df.iloc[row_indices]
+            # Resumed once the writer asks for the next sheet, i.e. this one is written
+            sheet_entry = {'sheet': sheet_name, 'rule': i + 1, 'rows': len(row_indices)}
+            sheet_entries.append(sheet_entry)
+            report(i, 'sheet', sheet_entry)
+            remaining[i] -= 1
+            if remaining[i] == 0:
+                report(i, 'done')
+                finished.add(i)
+    
+    try:
+        stats = write_workbook(sheets(), output_path, output['writer'])
+    except Exception as e:
+        logger.error(f"Error writing workbook {filename}: {str(e)}", exc_info=True)
+        for i in sorted(set(remaining) - finished):
+            report(i, 'failed')
+        raise
+    
+    file_entry = {
+        'filename': filename,
+        'rows': stats['rows'],
+        'sheets': sheet_entries,
+        'download_url': f'/download/{run_id}/{filename}',
+        'write_stats': stats,
+        'memoized': False
+    }
+    add_run_file(run_id, filename, output_path)
+    observe_stage('write', stats['seconds'], stats['rows'], stats['bytes'], run=run_id, file=filename, writer=stats['writer'])
+    memoize_output(memo_key, output_path, {'sheets': sheet_entries, 'write_stats': stats})
+    logger.info('Wrote %d sheets to %s', len(sheet_entries), filename, extra={'run': run_id})
+    return [file_entry], [stats], 0
+
+def deferred_rows_path(folder, filename):
+    """Where a lazy run keeps the row indices of an output it hasn't written yet"""
+    return os.path.join(folder, '.rows', f"{filename}.npy")
+
+def defer_output(run_id, folder, filename, dataset_id, row_indices, memo_key, output):
+    """Record an output of a lazy run for materialize_output to write on its first download"""
+    rows_path = deferred_rows_path(folder, filename)
+    os.makedirs(os.path.dirname(rows_path), exist_ok=True)
+    if len(row_indices) and row_indices.max() <= np.iinfo(np.int32).max:
+        row_indices = row_indices.astype(np.int32)
+    np.save(rows_path, row_indices)
+    registry().execute('INSERT OR REPLACE INTO lazy_outputs (run_id, filename, dataset_id, memo_key, output) '
+                       'VALUES (?, ?, ?, ?, ?)', (run_id, filename, dataset_id, memo_key, json.dumps(output)))
+
+def deferred_output(run_id, filename):
+    """Return (dataset ID, memo key, output options) of an output a lazy run hasn't written yet, or None"""
+    row = registry().execute('SELECT dataset_id, memo_key, output FROM lazy_outputs WHERE run_id = ? AND filename = ?',
+                             (run_id, filename)).fetchone()
+    return None if row is None else (row[0], row[1], json.loads(row[2]))
+
+def materialize_output(run_id, filename):
+    """Write an output a lazy run deferred, if it isn't written yet: returns (path, error message)
+    
+    The file is linked from the memo when an identical split already wrote it. Returns
+    (None, None) when the run has no such output, and an error when the output can't be
+    written any more because its upload or its recorded rows were cleaned up. Two first
+    downloads racing each other both write the file; the later one replaces it atomically.
+    """
+    folder = run_output_dir(run_id)
+    path = os.path.join(folder, filename)
+    deferred = deferred_output(run_id, filename)
+    if deferred is None:
+        return (path, None) if os.path.exists(path) else (None, None)
+    dataset_id, memo_key, output = deferred
+    rows_path = deferred_rows_path(folder, filename)
+    
+    with pin_disk_items(dataset_paths(dataset_id) + [folder]):
+        if not os.path.exists(path) and recall_output(memo_key, path) is None:
+            try:
+                row_indices = np.load(rows_path)
+                df = load_dataset(dataset_id, output['columns'])
+            except FileNotFoundError:
+                if os.path.exists(path):
+                    return path, None  # A concurrent download wrote it meanwhile
+                return None, 'This file was cleaned up before it was downloaded. Please run the split again.'
+            if output['columns'] is not None:
+                df = df[output['columns']]
+            stats = write_output(df.iloc[row_indices], path, output['writer'])
+            observe_stage('write', stats['seconds'], stats['rows'], stats['bytes'], run=run_id, file=filename,
+                          writer=stats['writer'])
+            memoize_output(memo_key, path, stats)
+            logger.info('Wrote deferred output %s', filename, extra={'run': run_id, 'rows': stats['rows']})
+        registry().execute('DELETE FROM lazy_outputs WHERE run_id = ? AND filename = ?', (run_id, filename))
+        if os.path.exists(rows_path):
+            os.remove(rows_path)
+        track_disk_item('run', folder)
+    return path, None
+
+def split_columns(rules, output):
+    """Columns a split has to load: those its rules read plus its output columns (None: all)"""
+    if output['columns'] is None:
+        return None
+    return list(dict.fromkeys([col for rule in rules for col in rule_columns(rule)] + output['columns']))
+
+def register_run(run_id):
+    """Start recording the files produced by a split run, forgetting runs older than the job TTL"""
+    cutoff = time.time() - JOB_TTL_SECONDS
+    with registry_transaction() as connection:
+        connection.execute('DELETE FROM run_files WHERE run_id IN (SELECT run_id FROM runs WHERE created_at < ?)', (cutoff,))
+        connection.execute('DELETE FROM lazy_outputs WHERE run_id IN (SELECT run_id FROM runs WHERE created_at < ?)', (cutoff,))
+        connection.execute('DELETE FROM runs WHERE created_at < ?', (cutoff,))
+        connection.execute('INSERT OR IGNORE INTO runs (run_id, created_at) VALUES (?, ?)', (run_id, time.time()))
+
+def add_run_file(run_id, filename, path):
+    """Record a file written by a split run"""
+    registry().execute('INSERT INTO run_files (run_id, filename, path) VALUES (?, ?, ?)', (run_id, filename, path))
+
+def get_run_files(run_id):
+    """Return the (filename, path) pairs written by a run, or None for an unknown run"""
+    connection = registry()
+    if connection.execute('SELECT 1 FROM runs WHERE run_id = ?', (run_id,)).fetchone() is None:
+        return None
+    rows = connection.execute('SELECT filename, path FROM run_files WHERE run_id = ? ORDER BY seq', (run_id,))
+    return [(filename, path) for filename, path in rows]
+
+def rule_columns(rule_data):
+    """Return the columns a valid rule reads, in order"""
+    if rule_data.get('rule_type') == 'split':
+        return list(rule_data['columns'])
+    if rule_data.get('rule_type') == 'filter':
+        return list(dict.fromkeys(condition_columns(rule_data['condition'])))
+    return [column for column, _ in rule_conditions(rule_data)]
+
+def tree_from_canonical(node):
+    """Rebuild a predicate tree from its canonical_tree form"""
+    if node[0] in ('and', 'or', 'not'):
+        return {'op': node[0], 'children': [tree_from_canonical(child) for child in node[1]]}
+    if node[0] == 'in':
+        return {'leaf': ('in', node[1], frozenset(node[2]))}
+    return {'leaf': tuple(node)}
+
+def compile_rule_set(name, rules, output_options, columns):
+    """Validate rules against a column schema and compile them into a storable rule set
+    
+    Returns (definition, error message). The definition holds the rules, the output options,
+    the columns the rules need, and the plan: the shared predicates, each rule's predicate
+    tree and the outputs each rule produces.
+    """
+    if not isinstance(rules, list) or not rules:
+        return None, 'A rule set needs at least one rule.'
+    for i, rule in enumerate(rules):
+        error = validate_rule(rule, columns) if isinstance(rule, dict) else 'A rule must be an object.'
+        if error:
+            return None, f'Rule {i + 1}: {error}'
+    output, error = parse_output_options(output_options)
+    if error:
+        return None, error
+    missing = missing_output_columns(output, columns)
+    if missing:
+        return None, f'output_columns not found in the column schema: {", ".join(missing)}'
+    
+    predicates, trees = plan_rules(rules)
+    layout = []
+    for i, rule in enumerate(rules):
+        if rule.get('rule_type') == 'split':
+            layout.append({'rule': i + 1, 'output': 'split', 'columns': rule['columns']})
+        else:
+            layout.append({'rule': i + 1, 'output': 'file', 'filename': generate_filename(rule, output['format'])})
+    return {
+        'name': name,
+        'rules': rules,
+        'output': {key: output_options[key] for key in OUTPUT_OPTION_KEYS if output_options.get(key)},
+        'columns': list(columns),
+        'required_columns': list(dict.fromkeys(col for rule in rules for col in rule_columns(rule))),
+        'plan': {
+            'predicates': [canonical_tree({'leaf': key}) for key in predicates],
+            'trees': [canonical_tree(tree) for tree in trees],
+            'layout': layout
+        }
+    }, None
+
+def save_rule_set(definition):
+    """Store a compiled rule set under its name, replacing any earlier version; return it as stored"""
+    now = time.time()
+    with registry_transaction() as connection:
+        row = connection.execute('SELECT definition FROM rule_sets WHERE name = ?', (definition['name'],)).fetchone()
+        definition = {**definition, 'created_at': json.loads(row[0])['created_at'] if row else now, 'updated_at': now}
+        connection.execute('INSERT OR REPLACE INTO rule_sets (name, definition, updated_at) VALUES (?, ?, ?)',
+                           (definition['name'], json.dumps(definition), now))
+    return definition
+
+def get_rule_set(name):
+    """Return a saved rule set's definition, or None"""
+    row = registry().execute('SELECT definition FROM rule_sets WHERE name = ?', (name,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def list_rule_sets():
+    """Summaries of the saved rule sets, by name"""
+    rows = registry().execute('SELECT definition FROM rule_sets ORDER BY name')
+    return [
+        {**{key: definition[key] for key in ('name', 'required_columns', 'output', 'updated_at')},
+         'rules': len(definition['rules'])}
+        for definition in (json.loads(row[0]) for row in rows)
+    ]
+
+def delete_rule_set(name):
+    """Delete a saved rule set; return whether it existed"""
+    with rule_set_plans_lock:
+        rule_set_plans.pop(name, None)
+    return registry().execute('DELETE FROM rule_sets WHERE name = ?', (name,)).rowcount > 0
+
+def rule_set_plan(definition):
+    """Return a rule set's (predicates, trees), decoded once per saved version in this process"""
+    with rule_set_plans_lock:
+        cached = rule_set_plans.get(definition['name'])
+        if cached and cached[0] == definition['updated_at']:
+            return cached[1]
+    plan = definition['plan']
+    compiled = ([tree_from_canonical(key)['leaf'] for key in plan['predicates']],
+                [tree_from_canonical(tree) for tree in plan['trees']])
+    with rule_set_plans_lock:
+        rule_set_plans[definition['name']] = (definition['updated_at'], compiled)
+    return compiled
+
+class ZipStreamBuffer:
+    """Write-only file object that collects bytes until drained
+    
+    It has no seek(), so zipfile writes entries with data descriptors and the archive can be
+    sent as it is built.
+    """
+    
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.position
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(files):
+    """Yield a ZIP archive of (arcname, path) files chunk by chunk, compressing only CSV entries"""
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED, compresslevel=WRITE_COMPRESSLEVEL) as archive:
+        seen = set()
+        for arcname, path in files:
+            if arcname in seen or not os.path.exists(path):
+                continue
+            seen.add(arcname)
+            # .xlsx and .parquet files are already compressed, so store them as-is; deflate CSV
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.compress_type = zipfile.ZIP_DEFLATED if arcname.lower().endswith('.csv') else zipfile.ZIP_STORED
+            with open(path, 'rb') as source, archive.open(info, 'w') as entry:
+                while True:
+                    chunk = source.read(BUNDLE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    entry.write(chunk)
+                    yield buffer.drain()
+            yield buffer.drain()
+    yield buffer.drain()
+
+def prune_jobs():
+    """Forget finished jobs older than JOB_TTL_SECONDS"""
+    registry().execute('DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?',
+                       (time.time() - JOB_TTL_SECONDS,))
+
+def get_job(job_id):
+    """Return a snapshot of a job's state, or None if it doesn't exist"""
+    row = registry().execute('SELECT state FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def update_job(job_id, change):
+    """Apply change(job) to a job's stored state as one atomic update"""
+    with registry_transaction() as connection:
+        row = connection.execute('SELECT state FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        if row is None:
+            return
+        job = json.loads(row[0])
+        change(job)
+        connection.execute('UPDATE jobs SET state = ?, finished_at = ? WHERE job_id = ?',
+                           (json.dumps(job), job.get('finished_at'), job_id))
+
+def submit_split_job(dataset_id, rules, output, plan=None, memory=0):
+    """Queue a split on the background executor and return its job ID
+    
+    memory is the split's estimated memory; the job waits in the queue until it fits the budget.
+    """
+    prune_jobs()
+    job_id = str(uuid.uuid4())
+    job = {
+        'job_id': job_id,
+        'status': 'queued',
+        'created_at': time.time(),
+        'finished_at': None,
+        'total_rules': len(rules),
+        'completed_rules': 0,
+        'rows_written': 0,
+        'rules': [{'rule': i + 1, 'status': 'pending', 'files': [], 'sheets': [], 'rows': 0} for i in range(len(rules))],
+        'files': [],
+        'failed_files': [],
+        'bundle_url': f'/bundle/{job_id}',
+        'estimated_memory_bytes': memory,
+        'error': None
+    }
+    registry().execute('INSERT INTO jobs (job_id, state, finished_at) VALUES (?, ?, NULL)', (job_id, json.dumps(job)))
+    # Pinned from now on, so /cleanup can't delete the upload while the job waits in the queue
+    pin_ids = add_disk_pins(dataset_paths(dataset_id))
+    job_executor.submit(run_split_job, job_id, dataset_id, rules, output, plan, memory, pin_ids)
+    return job_id
+
+def run_split_job(job_id, dataset_id, rules, output, plan=None, memory=0, pin_ids=()):
+    """Background executor entry point: run a split and record its progress on the job
+    
+    pin_ids are the pins submit_split_job took on the dataset; they are released at the end.
+    """
+    reservation = reserve_memory(memory, wait=0)
+    if reservation is None:
+        update_job(job_id, lambda job: job.update(waiting_for_memory=True))
+        reservation = reserve_memory(memory)
+    update_job(job_id, lambda job: job.update(status='running', waiting_for_memory=False))
+    
+    def on_progress(i, status, file_entry=None):
+        def change(job):
+            if status == 'file':
+                job['rules'][i]['files'].append(file_entry['filename'])
+                job['rules'][i]['rows'] += file_entry['rows']
+                if not file_entry['deferred']:
+                    job['rows_written'] += file_entry['rows']
+                job['files'].append(file_entry)
+            elif status == 'file_failed':
+                job['failed_files'].append(file_entry)
+            elif status == 'sheet':
+                job['rules'][i]['sheets'].append(file_entry['sheet'])
+                job['rules'][i]['rows'] += file_entry['rows']
+                job['rows_written'] += file_entry['rows']
+            else:
+                job['rules'][i]['status'] = status
+                job['completed_rules'] += 1
+        update_job(job_id, change)
+    
+    try:
+        result = run_split(dataset_id, rules, output, job_id, on_progress, plan)
+        update_job(job_id, lambda job: job.update(status='finished', files=result['files'], write_stats=result['write_stats'],
+                                                  total_files=result['total_files'], finished_at=time.time()))
+    except Exception as e:
+        logger.error(f"Error in split job {job_id}: {str(e)}", exc_info=True)
+        update_job(job_id, lambda job: job.update(status='failed', error=f'Error processing rules: {str(e)}',
+                                                  finished_at=time.time()))
+    finally:
+        release_memory(reservation)
+        release_disk_pins(pin_ids)
+        flush_metrics()
+
+def start_split(dataset_id, rules, output, run_async, plan=None, **response_fields):
+    """Admit a split against the memory budget, then queue or run it; returns the response
+    
+    A split estimated to need more than the whole budget is rejected with 413. An async split
+    is queued and waits for room; a synchronous one waits up to ADMISSION_WAIT_SECONDS and is
+    turned away with 503 if running splits still hold too much.
+    """
+    estimate = estimate_split_memory(dataset_id, split_columns(rules, output))
+    error = memory_budget_error(estimate)
+    if error:
+        return jsonify({'error': error, 'estimated_memory_bytes': estimate}), 413
+    
+    # Asynchronous mode: queue the split and let the client poll /jobs/<job_id>
+    if run_async:
+        job_id = submit_split_job(dataset_id, rules, output, plan, estimate)
+        logger.info('Queued split job %s for %d rules', job_id, len(rules), extra={'job': job_id})
+        return jsonify({
+            'success': True,
+            **response_fields,
+            'job_id': job_id,
+            'status_url': f'/jobs/{job_id}'
+        }), 202
+    
+    reservation = reserve_memory(estimate, ADMISSION_WAIT_SECONDS)
+    if reservation is None:
+        logger.warning('Turned away a split needing %d bytes', estimate, extra={'in_use': memory_in_use()})
+        return jsonify({
+            'error': 'The server is busy with other large splits. Please try again in a minute, '
+                     'or send the request with "async": true to wait in the queue.',
+            'estimated_memory_bytes': estimate
+        }), 503, {'Retry-After': '30'}
+    try:
+        result = run_split(dataset_id, rules, output, str(uuid.uuid4()), plan=plan)
+    finally:
+        release_memory(reservation)
+    return jsonify({'success': True, **response_fields, **result})
+
+@app.before_request
+def start_janitor():
+    """Make sure this worker process runs its disk janitor"""
+    ensure_janitor()
+
+@app.teardown_request
+def record_metrics(error=None):
+    """Hand the stage timings a request recorded over to the shared registry"""
+    try:
+        flush_metrics()
+    except Exception as e:
+        logger.warning(f"Could not record metrics: {str(e)}")
+
+@app.route('/metrics')
+def metrics():
+    """Stage timings, rows and bytes in the Prometheus text format"""
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/test-session')
 def test_session():
     """Test session functionality"""
-    print(f"Current session: {dict(session)}")  # Debug log
+    logger.debug('Session test', extra={'session_keys': sorted(session.keys())})
     return jsonify({
         'session_data': dict(session),
         'file_path': session.get('file_path'),
@@ -170,14 +2166,12 @@ def health_check():
 @app.route('/')
 def index():
     """Main page"""
-    return render_template('index.html')
+    return render_template('index.html', max_file_size=MAX_FILE_SIZE)
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """Handle file upload and return column data"""
     try:
-        print("=== UPLOAD FILE CALLED ===")  # Debug log
-        
         if 'file' not in request.files:
             return jsonify({'error': 'No file uploaded'}), 400
         
@@ -186,7 +2180,7 @@ def upload_file():
             return jsonify({'error': 'No file selected'}), 400
         
         if not allowed_file(file.filename):
-            return jsonify({'error': 'Invalid file type. Please upload Excel files only.'}), 400
+            return jsonify({'error': 'Invalid file type. Please upload Excel, CSV or Parquet files.'}), 400
         
         # Check file size
         file.seek(0, 2)  # Seek to end
@@ -196,199 +2190,463 @@ def upload_file():
         if file_size > MAX_FILE_SIZE:
             return jsonify({'error': f'File too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)}MB.'}), 400
         
-        # Save file temporarily
-        filename = secure_filename(file.filename)
-        session_id = str(uuid.uuid4())
-        file_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_{filename}")
-        file.save(file_path)
+        # Save the file under a temporary name, hashing it on the way to disk
+        filename = upload_filename(file.filename)
+        tmp_path = os.path.join(PARTIAL_FOLDER, f"{uuid.uuid4().hex}.upload")
+        hasher = hashlib.sha256()
+        with stage_timer('upload_save', file=filename) as counts:
+            with open(tmp_path, 'wb') as target:
+                counts['bytes'] = copy_stream(file.stream, target, hasher)
         
-        print(f"File saved to: {file_path}")  # Debug log
+        logger.info('Received upload %s', filename, extra={'bytes': file_size})
+        return finish_upload(tmp_path, filename, hasher.hexdigest())
         
-        # Read Excel file
+    except Exception as e:
+        logger.error(f"Error in upload_file: {str(e)}", exc_info=True)
+        return jsonify({'error': f'Error processing file: {str(e)}'}), 500
+
+def finish_upload(tmp_path, filename, digest):
+    """Store and parse a fully received upload, then start a session for it
+    
+    Shared by /upload and chunked uploads; returns the /upload JSON response.
+    """
+    try:
+        file_path, summary, reused = store_upload(tmp_path, filename, digest)
+    except Exception as e:
+        logger.error(f"Error reading uploaded file: {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return jsonify({'error': 'Failed to read the file. Please check the file format and ensure it is not corrupted.'}), 400
+    
+    if summary['total_rows'] == 0 or len(summary['columns']) == 0:
+        return jsonify({'error': 'The uploaded file is empty or has no columns.'}), 400
+    
+    columns = summary['columns']
+    session_id = str(uuid.uuid4())
+    
+    # Record the session in the shared registry and the cookie
+    set_session_file(session_id, file_path)
+    job_executor.submit(prebuild_row_index, dataset_id_for(file_path))
+    session['session_id'] = session_id
+    session['file_path'] = file_path
+    session['columns'] = columns
+    session.permanent = True  # Make session permanent
+    
+    logger.info('Started session for %s', file_path,
+                extra={'session': session_id, 'rows': summary['total_rows'], 'reused': reused})
+    
+    return jsonify({
+        'success': True,
+        'columns': columns,
+        'distinct_values': summary['distinct_values'],
+        'total_rows': summary['total_rows'],
+        'session_id': session_id,
+        'reused': reused
+    })
+
+@app.route('/uploads', methods=['POST'])
+def start_chunked_upload():
+    """Start a resumable upload: the client then PUTs the file in order, chunk by chunk"""
+    data = request.get_json(force=True, silent=True) or {}
+    original_name = str(data.get('filename') or '')
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Upload size is required'}), 400
+    if not allowed_file(original_name):
+        return jsonify({'error': 'Invalid file type. Please upload Excel, CSV or Parquet files.'}), 400
+    if size <= 0:
+        return jsonify({'error': 'No file selected'}), 400
+    if size > MAX_FILE_SIZE:
+        return jsonify({'error': f'File too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)}MB.'}), 400
+    
+    filename = upload_filename(original_name)
+    upload_id = uuid.uuid4().hex
+    open(upload_path(upload_id, '.part'), 'wb').close()
+    with open(upload_path(upload_id, '.json'), 'w') as f:
+        json.dump({'upload_id': upload_id, 'filename': filename, 'size': size, 'created_at': time.time()}, f)
+    upload_hashers[upload_id] = (hashlib.sha256(), 0)
+    # Counted at its declared size, so the quota covers bytes still to come
+    track_disk_item('partial', upload_path(upload_id, '.part'), size)
+    return jsonify({
+        'success': True,
+        'upload_id': upload_id,
+        'size': size,
+        'received': 0,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'upload_url': f'/uploads/{upload_id}'
+    }), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    """Report how many bytes of an upload have arrived, so an interrupted client can resume"""
+    upload = get_chunked_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify({'success': True, **upload})
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """Append the request body at ?offset=, which must equal the bytes received so far"""
+    if get_chunked_upload(upload_id) is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    with upload_lock(upload_id):
+        # Re-read under the lock: another worker may have appended or completed it meanwhile
+        upload = get_chunked_upload(upload_id)
+        if upload is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        received = upload['received']
         try:
-            df = pd.read_excel(file_path)
-        except Exception as e:
-            logging.error(f"Error reading Excel file: {str(e)}")
-            return jsonify({'error': 'Failed to read Excel file. Please check the file format and ensure it is not corrupted.'}), 400
+            offset = int(request.args.get('offset', received))
+        except ValueError:
+            return jsonify({'error': 'offset must be an integer'}), 400
+        if offset != received:
+            # Chunks must arrive in order; tell the client where to resume
+            return jsonify({'error': 'Chunk is out of order', 'received': received}), 409
         
-        if df.empty or len(df.columns) == 0:
-            return jsonify({'error': 'The uploaded Excel file is empty or has no columns.'}), 400
+        hasher = upload_hasher(upload_id)
+        try:
+            with stage_timer('upload_save', upload=upload_id) as counts:
+                with open(upload_path(upload_id, '.part'), 'ab') as target:
+                    counts['bytes'] = copy_stream(request.stream, target, hasher, upload['size'] - received)
+        except ValueError:
+            # Drop the bytes past the declared size; the hash is rebuilt from disk next time
+            with open(upload_path(upload_id, '.part'), 'ab') as target:
+                target.truncate(received)
+            upload_hashers.pop(upload_id, None)
+            return jsonify({'error': 'Chunk goes past the declared upload size', 'received': received}), 400
+        except Exception:
+            upload_hashers.pop(upload_id, None)
+            raise
+        received = os.path.getsize(upload_path(upload_id, '.part'))
+        upload_hashers[upload_id] = (hasher, received)
+        touch_disk_items(upload_path(upload_id, '.part'))
+    return jsonify({'success': True, 'received': received, 'size': upload['size']})
 
-        # Get column information
-        columns = df.columns.tolist()
-        column_values = {}
-        
-        for col in columns:
-            try:
-                unique_values = df[col].dropna().unique().tolist()
-                # Convert to strings and limit to first 50 unique values
-                column_values[col] = [str(val) for val in unique_values[:50]]
-            except Exception as e:
-                logging.error(f"Error processing column '{col}': {str(e)}")
-                column_values[col] = []
-        
-        # Store file path in global storage and session
-        file_storage[session_id] = file_path
-        session['session_id'] = session_id
-        session['file_path'] = file_path
-        session['columns'] = columns
-        session.permanent = True  # Make session permanent
-        
-        print(f"Session ID: {session_id}")  # Debug log
-        print(f"File stored in global storage: {file_storage.get(session_id)}")  # Debug log
-        
-        return jsonify({
-            'success': True,
-            'columns': columns,
-            'column_values': column_values,
-            'total_rows': len(df),
-            'session_id': session_id
-        })
-        
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """Finish a chunked upload: hash check, dedupe against earlier uploads, parse"""
+    if get_chunked_upload(upload_id) is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    with upload_lock(upload_id):
+        # Re-read under the lock: another worker may have appended or completed it meanwhile
+        upload = get_chunked_upload(upload_id)
+        if upload is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        if upload['received'] != upload['size']:
+            return jsonify({'error': 'Upload is incomplete', 'received': upload['received'], 'size': upload['size']}), 400
+        digest = upload_hasher(upload_id).hexdigest()
+        tmp_path = os.path.join(PARTIAL_FOLDER, f"{uuid.uuid4().hex}.upload")
+        os.replace(upload_path(upload_id, '.part'), tmp_path)
+        forget_chunked_upload(upload_id)
+    return finish_upload(tmp_path, upload['filename'], digest)
+
+@app.route('/values')
+def column_values():
+    """Page through one column's distinct values and their counts, optionally filtered by a search"""
+    session_id = request.args.get('session_id')
+    column = request.args.get('column')
+    file_path = get_session_file(session_id)
+    if not file_path or not os.path.exists(file_path):
+        return jsonify({'error': 'No file uploaded or file not found'}), 404
+    dataset_id = dataset_id_for(file_path)
+    touch_disk_items(file_path, dataset_cache_dir(dataset_id))
+    
+    match = request.args.get('match', 'prefix')
+    if match not in ('prefix', 'contains'):
+        return jsonify({'error': 'match must be "prefix" or "contains"'}), 400
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', VALUE_PAGE_SIZE)), 1), VALUE_PAGE_MAX)
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    
+    try:
+        columns = dataset_columns(dataset_id)
+        position = next((i for i, col in enumerate(columns) if str(col) == column), None)
+        if position is None:
+            return jsonify({'error': f'Column "{column}" not found in the uploaded file'}), 400
+        entry = load_value_index(dataset_id).get(position)
     except Exception as e:
-        logging.error(f"Error in upload_file: {str(e)}", exc_info=True)
-        return jsonify({'error': f'Error processing file: {str(e)}'}), 500
+        logger.error(f"Error reading column values: {str(e)}", exc_info=True)
+        return jsonify({'error': f'Error reading column values: {str(e)}'}), 500
+    
+    total, page = search_values(entry, request.args.get('q', ''), match, offset, limit)
+    return jsonify({
+        'success': True,
+        'column': column,
+        'distinct_values': len(entry['values']) if entry else 0,
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'values': [{'value': value, 'count': count} for value, count in page]
+    })
+
+@app.route('/preview', methods=['POST'])
+def preview():
+    """Dry run: return how many rows each rule would match, without writing any files"""
+    data = request.get_json(force=True, silent=True)
+    if not data:
+        return jsonify({'error': 'Invalid request. Please try again or refresh the page.'}), 400
+    session_id = data.get('session_id')
+    rules = data.get('rules', [])
+    file_path = get_session_file(session_id)
+    if not file_path or not os.path.exists(file_path):
+        return jsonify({'error': 'No file uploaded or file not found'}), 400
+    touch_disk_items(file_path, dataset_cache_dir(dataset_id_for(file_path)))
+    
+    start = time.perf_counter()
+    try:
+        with stage_timer('preview') as counts:
+            total_rows, results = preview_rules(dataset_id_for(file_path), rules)
+            counts['rows'] = total_rows
+    except Exception as e:
+        logger.error(f"Error in preview: {str(e)}", exc_info=True)
+        return jsonify({'error': f'Error previewing rules: {str(e)}'}), 500
+    return jsonify({
+        'success': True,
+        'total_rows': total_rows,
+        'rules': results,
+        'seconds': round(time.perf_counter() - start, 4)
+    })
 
 @app.route('/process', methods=['POST'])
 def process_rules():
     """Process rules and generate Excel files"""
     try:
-        print("=== PROCESS RULES CALLED ===")  # Debug log
         data = request.get_json(force=True, silent=True)
         if not data:
             return jsonify({'error': 'Invalid request. Please try again or refresh the page.'}), 400
-        print(f"Received data: {data}")  # Debug log
         rules = data.get('rules', [])
         session_id = data.get('session_id')  # Get session ID from request
-        print(f"Rules: {rules}")  # Debug log
-        print(f"Session ID from request: {session_id}")  # Debug log
+        logger.debug('Process request with %d rules', len(rules), extra={'session': session_id})
         
         if not rules:
             return jsonify({'error': 'No rules provided'}), 400
         
-        # Get file path from global storage using session ID
-        file_path = file_storage.get(session_id) if session_id else None
+        output, error = parse_output_options(data)
+        if error:
+            return jsonify({'error': error}), 400
         
-        print(f"File path from global storage: {file_path}")  # Debug log
-        print(f"Available session IDs: {list(file_storage.keys())}")  # Debug log
+        # Get file path from global storage using session ID
+        file_path = get_session_file(session_id)
         
         if not file_path or not os.path.exists(file_path):
-            print(f"File exists: {os.path.exists(file_path) if file_path else False}")  # Debug log
+            logger.debug('No stored file for session', extra={'session': session_id})
             return jsonify({'error': 'No file uploaded or file not found'}), 400
         
-        # Read the Excel file
+        # Check the rules against the file's columns (read from the parsed-data cache)
         try:
-            df = pd.read_excel(file_path)
+            columns = dataset_columns(dataset_id_for(file_path))
         except Exception as e:
-            logging.error(f"Error reading Excel file during processing: {str(e)}")
+            logger.error(f"Error reading Excel file during processing: {str(e)}")
             return jsonify({'error': 'Failed to read Excel file during processing. The file may be corrupted or in an unsupported format.'}), 400
         
-        if df.empty or len(df.columns) == 0:
+        if len(columns) == 0:
             return jsonify({'error': 'The uploaded Excel file is empty or has no columns.'}), 400
 
-        generated_files = []
-        
-        print(f"Starting to process {len(rules)} rules...")  # Debug log
-        
+        # Validate every rule before doing any work
         for i, rule in enumerate(rules):
-            print(f"Processing rule {i + 1}/{len(rules)}: {rule}")  # Debug log
-            try:
-                # Validate rule structure
-                if not rule.get('column1') or not rule.get('value1'):
-                    return jsonify({'error': f'Rule {i+1}: Missing required column or value.'}), 400
-                if rule['rule_type'] in ['and', 'or'] and (not rule.get('column2') or not rule.get('value2')):
-                    return jsonify({'error': f'Rule {i+1}: Missing required column2 or value2.'}), 400
-                # Check columns exist
-                for col in [rule.get('column1'), rule.get('column2')] + rule.get('additional_columns', []):
-                    if col and col not in df.columns:
-                        return jsonify({'error': f'Rule {i+1}: Column "{col}" not found in the uploaded file.'}), 400
-                # Apply rule to get filtered data
-                filtered_df = apply_rule(df, rule)
-                print(f"Rule {i + 1} filtered data shape: {filtered_df.shape}")  # Debug log
-                
-                # Skip if no data matches the rule
-                if len(filtered_df) == 0:
-                    print(f"Rule {i + 1}: No data matches rule, skipping")  # Debug log
-                    continue
-                
-                # Generate filename
-                filename = generate_filename(rule)
-                print(f"Rule {i + 1} generated filename: {filename}")  # Debug log
-                
-                # Save filtered data to new Excel file
-                output_path = os.path.join(UPLOAD_FOLDER, filename)
-                filtered_df.to_excel(output_path, index=False)
-                print(f"Rule {i + 1} saved file to: {output_path}")  # Debug log
-                
-                generated_files.append({
-                    'filename': filename,
-                    'rows': len(filtered_df),
-                    'download_url': f'/download/{filename}'
-                })
-                print(f"Rule {i + 1} added to generated_files. Total so far: {len(generated_files)}")  # Debug log
-                
-                del filtered_df
-                gc.collect()
-                
-            except Exception as e:
-                logging.error(f"Error processing rule {i + 1}: {str(e)}", exc_info=True)
-                continue
+            error = validate_rule(rule, columns)
+            if error:
+                return jsonify({'error': f'Rule {i+1}: {error}'}), 400
+        missing = missing_output_columns(output, columns)
+        if missing:
+            return jsonify({'error': f'output_columns not found in the uploaded file: {", ".join(missing)}'}), 400
         
-        print(f"Final result: Generated {len(generated_files)} files out of {len(rules)} rules")  # Debug log
-        print(f"Generated files: {generated_files}")  # Debug log
-        return jsonify({
-            'success': True,
-            'files': generated_files,
-            'total_files': len(generated_files)
-        })
+        return start_split(dataset_id_for(file_path), rules, output, data.get('async'))
         
     except Exception as e:
-        logging.error(f"Error in process_rules: {str(e)}", exc_info=True)
+        logger.error(f"Error in process_rules: {str(e)}", exc_info=True)
         return jsonify({'error': f'Error processing rules: {str(e)}'}), 500
 
-@app.route('/download/<filename>')
-def download_file(filename):
-    """Download generated Excel file"""
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report a split job's status, per-rule progress and finished downloads"""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/rule-sets', methods=['GET'])
+def rule_sets_index():
+    """List the saved rule sets"""
+    return jsonify({'success': True, 'rule_sets': list_rule_sets()})
+
+@app.route('/rule-sets/<name>', methods=['PUT'])
+def save_rule_set_route(name):
+    """Validate, compile and save a named rule set
+    
+    The body holds "rules" and the /process output options, plus the column schema the rules
+    are checked against: a "columns" list, or the "session_id" of an upload to take it from.
+    """
+    if not RULE_SET_NAME_PATTERN.fullmatch(name):
+        return jsonify({'error': 'Rule set names may use letters, digits, spaces, "_", "." and "-" (up to 100).'}), 400
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Invalid request. Please try again or refresh the page.'}), 400
+    
+    columns = data.get('columns')
+    if columns is None and data.get('session_id'):
+        file_path = get_session_file(data['session_id'])
+        if not file_path or not os.path.exists(file_path):
+            return jsonify({'error': 'No file uploaded or file not found'}), 400
+        columns = [str(col) for col in dataset_columns(dataset_id_for(file_path))]
+    if not isinstance(columns, list) or not columns:
+        return jsonify({'error': 'Give the column schema as "columns" or the "session_id" of an upload.'}), 400
+    
+    definition, error = compile_rule_set(name, data.get('rules'), data, columns)
+    if error:
+        return jsonify({'error': error}), 400
+    existed = get_rule_set(name) is not None
+    definition = save_rule_set(definition)
+    logger.info('Saved rule set %s with %d rules', name, len(definition['rules']), extra={'rule_set': name})
+    return jsonify({'success': True, 'rule_set': definition}), 200 if existed else 201
+
+@app.route('/rule-sets/<name>', methods=['GET'])
+def rule_set_detail(name):
+    """Return a saved rule set with its compiled plan"""
+    definition = get_rule_set(name)
+    if definition is None:
+        return jsonify({'error': 'Rule set not found'}), 404
+    return jsonify({'success': True, 'rule_set': definition})
+
+@app.route('/rule-sets/<name>', methods=['DELETE'])
+def rule_set_delete(name):
+    """Delete a saved rule set"""
+    if not delete_rule_set(name):
+        return jsonify({'error': 'Rule set not found'}), 404
+    return jsonify({'success': True})
+
+@app.route('/rule-sets/<name>/apply', methods=['POST'])
+def apply_rule_set(name):
+    """Split an upload with a saved rule set: {"session_id", "async"?, output option overrides?}
+    
+    Only checks that the upload has the columns the rules need; the rules themselves were
+    validated and compiled when the set was saved.
+    """
+    definition = get_rule_set(name)
+    if definition is None:
+        return jsonify({'error': 'Rule set not found'}), 404
+    data = request.get_json(force=True, silent=True) or {}
+    file_path = get_session_file(data.get('session_id'))
+    if not file_path or not os.path.exists(file_path):
+        return jsonify({'error': 'No file uploaded or file not found'}), 400
+    dataset_id = dataset_id_for(file_path)
+    touch_disk_items(file_path, dataset_cache_dir(dataset_id))
+    output, error = parse_output_options({**definition['output'],
+                                          **{key: data[key] for key in OUTPUT_OPTION_KEYS if key in data}})
+    if error:
+        return jsonify({'error': error}), 400
+    
+    try:
+        columns = set(dataset_columns(dataset_id))
+    except Exception as e:
+        logger.error(f"Error reading columns for rule set {name}: {str(e)}")
+        return jsonify({'error': 'Failed to read the uploaded file.'}), 400
+    missing = [col for col in definition['required_columns'] if col not in columns]
+    missing += [col for col in missing_output_columns(output, columns) if col not in missing]
+    if missing:
+        return jsonify({
+            'error': f'The file is missing columns the rule set uses: {", ".join(missing)}',
+            'missing_columns': missing
+        }), 400
+    
+    try:
+        return start_split(dataset_id, definition['rules'], output, data.get('async'),
+                           rule_set_plan(definition), rule_set=name)
+    except Exception as e:
+        logger.error(f"Error applying rule set {name}: {str(e)}", exc_info=True)
+        return jsonify({'error': f'Error processing rules: {str(e)}'}), 500
+
+def materialize_deferred_download(run_id, filename):
+    """Write a lazy run's output for a download within the memory budget: returns (path, error response)"""
+    dataset_id, _, output = deferred_output(run_id, filename)
+    estimate = estimate_split_memory(dataset_id, output['columns'])
+    reservation = reserve_memory(estimate, ADMISSION_WAIT_SECONDS)
+    if reservation is None:
+        return None, (jsonify({'error': 'The server is busy with other large splits. Please try again in a minute.'}),
+                      503, {'Retry-After': '30'})
     try:
-        print(f"=== DOWNLOAD REQUESTED ===")  # Debug log
-        print(f"Filename: {filename}")  # Debug log
+        file_path, error = materialize_output(run_id, filename)
+    finally:
+        release_memory(reservation)
+    if error:
+        return None, (jsonify({'error': error}), 410)
+    return file_path, None
+
+@app.route('/download/<run_id>/<filename>')
+def download_file(run_id, filename):
+    """Download a file generated by a split run"""
+    try:
+        logger.debug('Download requested', extra={'run': run_id, 'file': filename})
+        
+        folder = run_output_dir(run_id)
+        if folder is None or filename.startswith('.') or filename != os.path.basename(filename):
+            return jsonify({'error': 'File not found'}), 404
+        file_path = os.path.join(folder, filename)
+        touch_disk_items(folder)
         
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
-        print(f"File path: {file_path}")  # Debug log
-        print(f"File exists: {os.path.exists(file_path)}")  # Debug log
+        # Outputs of a lazy run are written by their first download
+        if not os.path.exists(file_path) and deferred_output(run_id, filename) is not None:
+            file_path, error = materialize_deferred_download(run_id, filename)
+            if error:
+                return error
         
-        if os.path.exists(file_path):
-            print(f"File size: {os.path.getsize(file_path)} bytes")  # Debug log
+        if file_path and os.path.exists(file_path):
             return send_file(
                 file_path, 
                 as_attachment=True, 
                 download_name=filename,
-                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+                mimetype=OUTPUT_MIMETYPES.get(filename.rsplit('.', 1)[-1].lower(), 'application/octet-stream')
             )
         else:
-            print(f"File not found: {file_path}")  # Debug log
+            logger.debug('Download not found: %s', file_path, extra={'run': run_id})
             return jsonify({'error': 'File not found'}), 404
     except Exception as e:
-        print(f"Error in download_file: {str(e)}")  # Debug log
+        logger.error(f"Error in download_file: {str(e)}", exc_info=True)
         return jsonify({'error': f'Error downloading file: {str(e)}'}), 500
 
+def materialized_files(run_id, files):
+    """Yield a run's (filename, path) pairs, writing each deferred output just before it is needed"""
+    for filename, path in files:
+        if not os.path.exists(path):
+            _, error = materialize_output(run_id, filename)
+            if error:
+                logger.warning('Leaving %s out of the bundle: %s', filename, error, extra={'run': run_id})
+        yield filename, path
+
+@app.route('/bundle/<run_id>')
+def download_bundle(run_id):
+    """Stream a ZIP of every file produced by a split run, built on the fly"""
+    files = get_run_files(run_id)
+    if files is None:
+        return jsonify({'error': 'Run not found'}), 404
+    if not files:
+        return jsonify({'error': 'This run has not produced any files'}), 404
+    touch_disk_items(run_output_dir(run_id))
+    
+    logger.info('Streaming bundle of %d files for run %s', len(files), run_id, extra={'run': run_id})
+    return Response(
+        stream_with_context(stream_zip(materialized_files(run_id, files))),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="split_{run_id[:8]}.zip"'}
+    )
+
 @app.route('/cleanup', methods=['POST'])
 def cleanup_files():
     """Clean up uploaded and generated files"""
     try:
-        file_path = session.get('file_path')
-        if file_path and os.path.exists(file_path):
-            os.remove(file_path)
-        
-        # Clean up generated files (older than 1 hour)
-        current_time = datetime.now()
-        for filename in os.listdir(UPLOAD_FOLDER):
-            file_path = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.isfile(file_path):
-                file_time = datetime.fromtimestamp(os.path.getctime(file_path))
-                if (current_time - file_time).total_seconds() > 3600:  # 1 hour
-                    os.remove(file_path)
+        file_path, shared = forget_session(session.get('session_id'))
+        # Identical uploads share one stored copy, so keep it while another session uses it, and
+        # leave it to the janitor while a queued or running job still needs it
+        if file_path and not shared:
+            discard_upload(file_path)
         
+        # Old outputs, caches and partial uploads are evicted by the background janitor
+        janitor_wakeup.set()
         session.clear()
         return jsonify({'success': True})
     except Exception as e:
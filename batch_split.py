@@ -0,0 +1,188 @@
+"""
+Split many workbooks from the command line, without the web UI
+
+Takes input files (or directories, or glob patterns) and a rules file in the same JSON schema
+/process accepts, and splits each input in its own worker process:
+
+    python batch_split.py masters/ --rules rules.json --output split_output
+    python batch_split.py "masters/*_2024-12.xlsx" --rules rules.json --workers 8
+
+The rules file is either a list of rules or a /process request body ({"rules": [...],
+"output_format": "csv", ...}). Each input's files go to a folder named after it inside
+--output, and a summary of rows and files per input is printed at the end.
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from splitting import (ALLOWED_EXTENSIONS, categorize_columns, evaluate_plan, generate_filename,
+                       missing_output_columns, parse_output_options, partition_rows, plan_rules, read_upload,
+                       sheet_name_for, split_group_rule, validate_rule, write_output, write_workbook)
+
+def find_inputs(patterns):
+    """Expand files, directories and glob patterns into a sorted list of splittable files"""
+    found = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        else:
+            paths = glob.glob(pattern) or [pattern]
+        for path in paths:
+            name = os.path.basename(path)
+            # Skip Excel's ~$ lock files and anything the web upload wouldn't take
+            if os.path.isfile(path) and not name.startswith('~$') and \
+                    name.rsplit('.', 1)[-1].lower() in ALLOWED_EXTENSIONS:
+                found.add(path)
+    return sorted(found)
+
+def load_request(path):
+    """Read a rules file and return (rules, output options); raises ValueError for a bad file"""
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = {'rules': data}
+    if not isinstance(data, dict) or not isinstance(data.get('rules'), list) or not data['rules']:
+        raise ValueError('The rules file must hold a list of rules or an object with a "rules" list')
+    output, error = parse_output_options(data)
+    if error:
+        raise ValueError(error)
+    return data['rules'], output
+
+def rule_outputs(df, rule, extension, columns=None):
+    """Yield (filename, rows) for every output of one rule: one for a plain rule, one per group
+    for a split rule. Rows are selected on every column; only columns (None: all) are kept."""
+    written = df if columns is None else df[columns]
+    if rule.get('rule_type') == 'split':
+        for key, row_indices in partition_rows(df, rule['columns']):
+            yield generate_filename(split_group_rule(rule, key), extension), written.iloc[row_indices]
+        return
+    mask = evaluate_plan(df, *plan_rules([rule]))[0]
+    if mask.any():
+        yield generate_filename(rule, extension), written[mask]
+
+def split_outputs(df, rules, output, errors):
+    """Yield the (filename, rows) outputs of every rule in turn, so only the file being written
+    is held in memory; rules that fail are added to errors"""
+    for i, rule in enumerate(rules):
+        error = validate_rule(rule, df.columns.tolist())
+        if error:
+            errors.append(f'Rule {i + 1}: {error}')
+            continue
+        try:
+            yield from rule_outputs(df, rule, output['format'], output['columns'])
+        except Exception as e:
+            errors.append(f'Rule {i + 1}: {str(e)}')
+
+def split_file(input_path, rules, output, output_root):
+    """Split one input into output_root/<input name>/ and return its summary"""
+    start = time.perf_counter()
+    summary = {'input': input_path, 'rows': 0, 'files': [], 'errors': []}
+    try:
+        df = categorize_columns(read_upload(input_path))
+    except Exception as e:
+        summary['errors'].append(f'Could not read the file: {str(e)}')
+        summary['seconds'] = round(time.perf_counter() - start, 3)
+        return summary
+    summary['rows'] = len(df)
+    missing = missing_output_columns(output, df.columns)
+    if missing:
+        summary['errors'].append(f'output_columns not found in the file: {", ".join(missing)}')
+        summary['seconds'] = round(time.perf_counter() - start, 3)
+        return summary
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    folder = os.path.join(output_root, name)
+    os.makedirs(folder, exist_ok=True)
+
+    outputs = split_outputs(df, rules, output, summary['errors'])
+    if output['mode'] == 'workbook':
+        first = next(outputs, None)
+        if first is not None:
+            used_names = set()
+            filename = f"{output['workbook_name'] or name}.xlsx"
+            sheets = ((sheet_name_for(sheet_filename, used_names), part)
+                      for sheet_filename, part in itertools.chain([first], outputs))
+            try:
+                stats = write_workbook(sheets, os.path.join(folder, filename), output['writer'])
+                summary['files'].append({'filename': filename, 'rows': stats['rows'], 'bytes': stats['bytes']})
+            except Exception as e:
+                summary['errors'].append(f'{filename}: {str(e)}')
+    else:
+        for filename, part in outputs:
+            try:
+                stats = write_output(part, os.path.join(folder, filename), output['writer'])
+            except Exception as e:
+                summary['errors'].append(f'{filename}: {str(e)}')
+                continue
+            summary['files'].append({'filename': filename, 'rows': stats['rows'], 'bytes': stats['bytes']})
+    summary['output'] = folder
+    summary['seconds'] = round(time.perf_counter() - start, 3)
+    return summary
+
+def run_batch(inputs, rules, output, output_root, workers=None):
+    """Split every input, in a pool of worker processes when there is more than one; yield each
+    input's summary as it finishes"""
+    workers = min(workers or os.cpu_count() or 1, len(inputs))
+    if workers <= 1:
+        for input_path in inputs:
+            yield split_file(input_path, rules, output, output_root)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(split_file, input_path, rules, output, output_root) for input_path in inputs]
+        for future in as_completed(futures):
+            yield future.result()
+
+def print_summary(summaries):
+    """Print one line per input, in input order, plus totals"""
+    width = max([len(summary['input']) for summary in summaries] + [5])
+    print(f"\n{'Input':<{width}}  {'Rows':>10}  {'Files':>6}  {'Rows written':>12}  {'Seconds':>8}")
+    for summary in summaries:
+        written = sum(entry['rows'] for entry in summary['files'])
+        print(f"{summary['input']:<{width}}  {summary['rows']:>10}  {len(summary['files']):>6}  "
+              f"{written:>12}  {summary['seconds']:>8}")
+        for error in summary['errors']:
+            print(f"    ⚠️ {error}")
+    print(f"{'Total':<{width}}  {sum(s['rows'] for s in summaries):>10}  "
+          f"{sum(len(s['files']) for s in summaries):>6}  "
+          f"{sum(entry['rows'] for s in summaries for entry in s['files']):>12}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Split many Excel, CSV or Parquet files with one set of rules')
+    parser.add_argument('inputs', nargs='+', help='input files, directories or glob patterns')
+    parser.add_argument('--rules', required=True, help='JSON file with the rules, in the /process request format')
+    parser.add_argument('--output', default='split_output', help='folder for the results (default: split_output)')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--format', choices=('xlsx', 'csv', 'parquet'), help="override the rules file's output_format")
+    args = parser.parse_args()
+
+    try:
+        rules, output = load_request(args.rules)
+    except (OSError, ValueError) as e:
+        print(f"❌ {args.rules}: {e}")
+        return 2
+    if args.format:
+        output['format'] = args.format
+        if output['mode'] == 'workbook' and args.format != 'xlsx':
+            print('❌ The single-workbook output mode writes .xlsx files only.')
+            return 2
+    inputs = find_inputs(args.inputs)
+    if not inputs:
+        print('❌ No .xlsx, .xls, .csv or .parquet files found')
+        return 2
+
+    print(f"Splitting {len(inputs)} files with {len(rules)} rules into {args.output}")
+    order = {path: position for position, path in enumerate(inputs)}
+    summaries = []
+    for summary in run_batch(inputs, rules, output, args.output, args.workers):
+        status = '❌' if summary['errors'] and not summary['files'] else '✅'
+        print(f"{status} {summary['input']}: {len(summary['files'])} files in {summary['seconds']}s")
+        summaries.append(summary)
+    print_summary(sorted(summaries, key=lambda summary: order[summary['input']]))
+    return 1 if any(summary['errors'] for summary in summaries) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+"""
+Benchmark the Excel Splitter end to end
+
+Generates sample data with create_sample_data.py, then drives /upload, /process and every
+/download through the Flask test client, timing each phase and sampling peak memory. Each
+scenario's results are appended as one JSON line to a results file, so runs from different
+commits can be compared:
+
+    python benchmark.py --rows 1000 --rows 100000 --format csv
+    python benchmark.py --rows 1000 --rows 100000 --format csv --baseline baseline.jsonl
+
+With --baseline, a phase that got slower or used more memory than the baseline's result for the
+same scenario by more than --tolerance is reported, and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+from create_sample_data import CATEGORY_VALUES, create_sample_data, parse_cardinality, value_pool
+
+PHASES = ('upload', 'process', 'download')
+SAMPLE_INTERVAL = 0.005  # Seconds between memory samples
+RESULTS_PATH = 'benchmark_results.jsonl'
+
+def rss_bytes():
+    """Return this process's resident memory from /proc, or None where /proc isn't available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def max_rss_bytes():
+    """Return the process's lifetime peak resident memory, or None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Bytes on macOS, KiB elsewhere
+
+@contextmanager
+def measure():
+    """Time a block and sample its peak resident memory; fills in the yielded dict on exit
+
+    Without /proc the peak is the process's lifetime peak, so only the first phase is exact.
+    """
+    result = {}
+    peak = [rss_bytes()]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(SAMPLE_INTERVAL):
+            peak[0] = max(peak[0], rss_bytes())
+
+    sampler = threading.Thread(target=sample, daemon=True) if peak[0] is not None else None
+    if sampler:
+        sampler.start()
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result['seconds'] = round(time.perf_counter() - start, 4)
+        done.set()
+        if sampler:
+            sampler.join()
+            peak[0] = max(peak[0], rss_bytes())
+        result['peak_rss_bytes'] = peak[0] if sampler else max_rss_bytes()
+
+def benchmark_rules(columns, cardinality):
+    """One plain rule, one AND rule and one split rule over the first categorical columns"""
+    categorical = [col for col in columns if col in CATEGORY_VALUES or col.startswith('Attribute_')]
+    if not categorical:
+        raise ValueError('The benchmark needs at least one categorical column; use --columns 3 or more')
+    first, second = categorical[0], categorical[min(1, len(categorical) - 1)]
+    if not isinstance(cardinality, dict):
+        cardinality = {'*': cardinality}
+    value = lambda column: value_pool(column, cardinality.get(column, cardinality.get('*')))[0]
+    return [
+        {'rule_type': 'single', 'column1': first, 'value1': [value(first)]},
+        {'rule_type': 'and', 'column1': first, 'value1': [value(first)], 'column2': second, 'value2': [value(second)]},
+        {'rule_type': 'split', 'columns': [first]},
+    ]
+
+def run_once(client, path, cardinality, output_format):
+    """Upload a file, split it and download every output; return per-phase measurements"""
+    phases = {}
+    with measure() as phases['upload']:
+        with open(path, 'rb') as f:
+            response = client.post('/upload', data={'file': (f, os.path.basename(path))},
+                                   content_type='multipart/form-data')
+    upload = response.get_json()
+    if response.status_code != 200:
+        raise RuntimeError(f"Upload failed: {upload}")
+
+    rules = benchmark_rules(upload['columns'], cardinality)
+    with measure() as phases['process']:
+        response = client.post('/process', json={'rules': rules, 'session_id': upload['session_id'],
+                                                 'output_format': output_format})
+    result = response.get_json()
+    if response.status_code != 200:
+        raise RuntimeError(f"Processing failed: {result}")
+
+    downloaded = 0
+    with measure() as phases['download']:
+        for entry in result['files']:
+            response = client.get(entry['download_url'])
+            downloaded += len(response.get_data())
+            response.close()
+
+    client.post('/cleanup')
+    return phases, {
+        'rows': upload['total_rows'],
+        'reused_upload': upload.get('reused', False),
+        'files': len(result['files']),
+        'rows_written': result['write_stats']['rows'],
+        'bytes_downloaded': downloaded,
+    }
+
+def run_scenario(client, workdir, rows, columns=None, cardinality=None, input_format='xlsx',
+                 output_format='xlsx', repeat=3, seed=42):
+    """Benchmark one scenario repeat times and return its result record
+
+    Each repeat generates its data with its own seed, so upload dedupe and the output memo
+    never turn a repeat into a cache hit. Seconds are the median over repeats; peak memory
+    is the highest seen.
+    """
+    runs = []
+    for i in range(repeat):
+        path = os.path.join(workdir, f'benchmark_{rows}.{input_format}')
+        create_sample_data(rows, columns, cardinality, path, seed + i, verbose=False)
+        runs.append(run_once(client, path, cardinality, output_format))
+        os.remove(path)
+
+    phases = {
+        phase: {
+            'seconds': round(statistics.median(measured[phase]['seconds'] for measured, _ in runs), 4),
+            'peak_rss_bytes': max((measured[phase]['peak_rss_bytes'] or 0) for measured, _ in runs) or None,
+        }
+        for phase in PHASES
+    }
+    counts = runs[-1][1]
+    phases['process']['rows_per_second'] = round(counts['rows'] / phases['process']['seconds']) \
+        if phases['process']['seconds'] > 0 else None
+    return {
+        'scenario': scenario_name(rows, columns, cardinality, input_format, output_format),
+        'parameters': {'rows': rows, 'columns': columns, 'cardinality': cardinality,
+                       'input_format': input_format, 'output_format': output_format, 'repeat': repeat},
+        'phases': phases,
+        **counts,
+    }
+
+def scenario_name(rows, columns, cardinality, input_format, output_format):
+    """A stable key for matching a scenario's results across runs"""
+    if isinstance(cardinality, dict):
+        cardinality = ','.join(f'{column}={count}' for column, count in sorted(cardinality.items()))
+    return f"{rows}r-{columns or 'default'}c-{cardinality or 'default'}card-{input_format}-{output_format}"
+
+def environment():
+    """Where and on what a result was measured"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ''
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+
+def compare_results(results, baseline, tolerance=0.25):
+    """Return a message for every phase of results that is slower or uses more memory than the
+    matching scenario in baseline by more than tolerance (a fraction)"""
+    previous = {record['scenario']: record for record in baseline}  # Last record per scenario wins
+    regressions = []
+    for record in results:
+        before = previous.get(record['scenario'])
+        if before is None:
+            continue
+        for phase in PHASES:
+            for key in ('seconds', 'peak_rss_bytes'):
+                old, new = before['phases'][phase].get(key), record['phases'][phase].get(key)
+                if old and new and new > old * (1 + tolerance):
+                    regressions.append(f"{record['scenario']} {phase} {key}: {old} -> {new} (+{new / old - 1:.0%})")
+    return regressions
+
+def read_results(path):
+    """Read a results file written by this script"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark upload, process and download')
+    parser.add_argument('--rows', type=int, action='append', help='rows per scenario; repeatable (default: 1000)')
+    parser.add_argument('--columns', type=int, help='columns in the generated data (default: 13)')
+    parser.add_argument('--cardinality', action='append', metavar='[COLUMN=]N',
+                        help='distinct values per categorical column, as for create_sample_data.py')
+    parser.add_argument('--format', default='xlsx', choices=('xlsx', 'csv', 'parquet'), help='upload format')
+    parser.add_argument('--output-format', default='xlsx', choices=('xlsx', 'csv', 'parquet'))
+    parser.add_argument('--repeat', type=int, default=3, help='runs per scenario, summarized by the median')
+    parser.add_argument('--results', default=RESULTS_PATH, help=f'file results are appended to (default: {RESULTS_PATH})')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown as a fraction (default: 0.25)')
+    args = parser.parse_args()
+    cardinality = parse_cardinality(args.cardinality)
+
+    with tempfile.TemporaryDirectory(prefix='excel-splitter-bench-') as workdir:
+        # A private upload folder and registry, so earlier uploads and memoized outputs can't be reused
+        os.environ['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+        os.environ.setdefault('DISK_JANITOR_INTERVAL', '0')
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+        os.environ['FLASK_DEBUG'] = 'False'
+        from app import app
+
+        results = []
+        with app.test_client() as client:
+            for rows in args.rows or [1000]:
+                record = run_scenario(client, workdir, rows, args.columns, cardinality, args.format,
+                                      args.output_format, args.repeat)
+                record.update(environment())
+                results.append(record)
+                print(f"{record['scenario']}: " + ', '.join(
+                    f"{phase} {record['phases'][phase]['seconds']}s" for phase in PHASES
+                ) + f", {record['phases']['process']['rows_per_second']} rows/s")
+
+    with open(args.results, 'a') as f:
+        for record in results:
+            f.write(json.dumps(record) + '\n')
+    print(f"Results appended to {args.results}")
+
+    if args.baseline:
+        regressions = compare_results(results, read_results(args.baseline), args.tolerance)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
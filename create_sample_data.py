@@ -1,77 +1,115 @@
 """
 Create sample Excel data for testing the Excel Splitter application
+
+Run without arguments for the 100-row fashion sheet used by the tests. --rows, --columns and
+--cardinality scale it up for benchmarks, e.g.:
+
+    python create_sample_data.py --rows 1000000 --columns 30 --cardinality Region=200 --output big.parquet
 """
+import argparse
+import os
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
+from datetime import datetime
+
+# Sample values for fashion industry (Ralph Lauren context), in column order
+CATEGORY_VALUES = {
+    'Category': ['Shirts', 'Pants', 'Dresses', 'Shoes', 'Accessories', 'Outerwear'],
+    'Season': ['Spring', 'Summer', 'Fall', 'Winter'],
+    'Gender': ['Men', 'Women', 'Unisex'],
+    'Color': ['Black', 'White', 'Blue', 'Red', 'Green', 'Brown', 'Gray', 'Pink'],
+    'Size': ['XS', 'S', 'M', 'L', 'XL', 'XXL'],
+    'Region': ['North America', 'Europe', 'Asia', 'South America', 'Africa'],
+    'Price_Range': ['Budget', 'Mid-range', 'Premium', 'Luxury'],
+}
+EXTRA_COLUMN_CARDINALITY = 10  # Distinct values in each generated Attribute_N column
+EXCEL_MAX_ROWS = 1048575  # One row of the sheet holds the header
+
+def value_pool(column, cardinality=None):
+    """Return the values a categorical column draws from, padded or trimmed to cardinality"""
+    values = CATEGORY_VALUES.get(column, [])
+    if cardinality is None:
+        return values or [f'{column}_{i}' for i in range(1, EXTRA_COLUMN_CARDINALITY + 1)]
+    return (values + [f'{column}_{i}' for i in range(len(values) + 1, cardinality + 1)])[:cardinality]
+
+def build_sample_frame(n_records=100, n_columns=None, cardinality=None, seed=42):
+    """Build the sample DataFrame
+
+    n_columns trims the 13 standard columns or adds Attribute_N categorical columns after them.
+    cardinality is the number of distinct values for every categorical column (an int) or per
+    column (a dict, where '*' covers the columns not named); columns left out keep their usual values.
+    """
+    np.random.seed(seed)  # For reproducible results
+    if not isinstance(cardinality, dict):
+        cardinality = {'*': cardinality}
+    pick = lambda column: np.random.choice(value_pool(column, cardinality.get(column, cardinality.get('*'))),
+                                           n_records)
 
-def create_sample_data():
-    """Create sample Excel data with various columns for testing"""
-    
-    # Sample data for fashion industry (Ralph Lauren context)
-    np.random.seed(42)  # For reproducible results
-    
-    # Generate 100 sample records
-    n_records = 100
-    
-    # Product categories
-    categories = ['Shirts', 'Pants', 'Dresses', 'Shoes', 'Accessories', 'Outerwear']
-    
-    # Seasons
-    seasons = ['Spring', 'Summer', 'Fall', 'Winter']
-    
-    # Genders
-    genders = ['Men', 'Women', 'Unisex']
-    
-    # Colors
-    colors = ['Black', 'White', 'Blue', 'Red', 'Green', 'Brown', 'Gray', 'Pink']
-    
-    # Sizes
-    sizes = ['XS', 'S', 'M', 'L', 'XL', 'XXL']
-    
-    # Regions
-    regions = ['North America', 'Europe', 'Asia', 'South America', 'Africa']
-    
-    # Price ranges
-    price_ranges = ['Budget', 'Mid-range', 'Premium', 'Luxury']
-    
-    # Generate sample data
     data = {
         'Product_ID': [f'PROD{i:03d}' for i in range(1, n_records + 1)],
         'Product_Name': [f'Product {i}' for i in range(1, n_records + 1)],
-        'Category': np.random.choice(categories, n_records),
-        'Season': np.random.choice(seasons, n_records),
-        'Gender': np.random.choice(genders, n_records),
-        'Color': np.random.choice(colors, n_records),
-        'Size': np.random.choice(sizes, n_records),
-        'Region': np.random.choice(regions, n_records),
-        'Price_Range': np.random.choice(price_ranges, n_records),
+        **{column: pick(column) for column in CATEGORY_VALUES},
         'Price': np.random.uniform(25, 500, n_records).round(2),
         'Stock_Quantity': np.random.randint(0, 100, n_records),
         'Active': np.random.choice(['Yes', 'No'], n_records),
-        'Launch_Date': [(datetime.now() - timedelta(days=np.random.randint(0, 365))).strftime('%Y-%m-%d') for _ in range(n_records)]
     }
-    
-    # Create DataFrame
-    df = pd.DataFrame(data)
-    
-    # Save to Excel file
-    filename = 'sample_data.xlsx'
-    df.to_excel(filename, index=False, sheet_name='Products')
-    
+    days_ago = pd.to_timedelta(np.random.randint(0, 365, n_records), unit='D')
+    data['Launch_Date'] = (pd.Timestamp(datetime.now()) - days_ago).strftime('%Y-%m-%d')
+
+    n_columns = n_columns or len(data)
+    for i in range(1, n_columns - len(data) + 1):
+        data[f'Attribute_{i}'] = pick(f'Attribute_{i}')
+    return pd.DataFrame(data).iloc[:, :max(n_columns, 1)]
+
+def create_sample_data(n_records=100, n_columns=None, cardinality=None, filename='sample_data.xlsx',
+                       seed=42, verbose=True):
+    """Create sample data with various columns for testing; the extension of filename picks
+    .xlsx, .csv or .parquet"""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in ('.xlsx', '.csv', '.parquet'):
+        raise ValueError(f'Unsupported sample file type: {extension}')
+    if extension == '.xlsx' and n_records > EXCEL_MAX_ROWS:
+        raise ValueError(f'A sheet holds at most {EXCEL_MAX_ROWS} rows; use .csv or .parquet')
+
+    df = build_sample_frame(n_records, n_columns, cardinality, seed)
+    if extension == '.xlsx':
+        df.to_excel(filename, index=False, sheet_name='Products')
+    elif extension == '.csv':
+        df.to_csv(filename, index=False)
+    else:
+        df.to_parquet(filename, index=False)
+
+    if not verbose:
+        return filename
     print(f"✅ Sample data created: {filename}")
     print(f"📊 Total records: {len(df)}")
     print(f"📋 Columns: {list(df.columns)}")
     print("\n📈 Sample data preview:")
     print(df.head())
-    
+
     print("\n🎯 Example rules you can test:")
     print("1. Single Column: Category = 'Shirts'")
     print("2. AND Logic: Gender = 'Men' AND Season = 'Winter'")
     print("3. OR Logic: Color = 'Black' OR Color = 'White'")
     print("4. AND Logic: Price_Range = 'Premium' AND Region = 'North America'")
-    
+
     return filename
 
+def parse_cardinality(specs):
+    """Turn --cardinality arguments (N for every column, or COLUMN=N) into build_sample_frame's form"""
+    cardinality = {}
+    for spec in specs or []:
+        column, _, count = spec.rpartition('=')
+        cardinality[column or '*'] = int(count)
+    return cardinality or None
+
 if __name__ == "__main__":
-    create_sample_data() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Create sample data for the Excel Splitter')
+    parser.add_argument('--rows', type=int, default=100, help='number of rows (default: 100)')
+    parser.add_argument('--columns', type=int, help='number of columns; extra ones are Attribute_N')
+    parser.add_argument('--cardinality', action='append', metavar='[COLUMN=]N',
+                        help='distinct values for every categorical column, or for one column; repeatable')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='sample_data.xlsx', help='.xlsx, .csv or .parquet file to write')
+    args = parser.parse_args()
+    create_sample_data(args.rows, args.columns, parse_cardinality(args.cardinality), args.output, args.seed)
@@ -0,0 +1,868 @@
+"""
+Splitting core shared by the web app and batch_split.py
+Rule compilation and evaluation, output filenames and the output file writers. Importing it
+has no side effects: no folders, registry or log files are created.
+"""
+
+import os
+import json
+import math
+import operator
+import re
+import time
+import uuid
+import warnings
+import zipfile
+from datetime import datetime, date, timedelta, time as time_of_day
+from xml.sax.saxutils import escape as xml_escape, quoteattr
+import numpy as np
+import pandas as pd
+
+ALLOWED_EXTENSIONS = {'xlsx', 'xls', 'csv', 'parquet'}
+
+# Output writers: 'streaming' writes .xlsx with constant memory, 'openpyxl' uses pandas' default engine
+OUTPUT_WRITER = os.environ.get('OUTPUT_WRITER', 'streaming')
+WRITE_CHUNK_ROWS = int(os.environ.get('WRITE_CHUNK_ROWS', 10000))
+WRITE_COMPRESSLEVEL = int(os.environ.get('WRITE_COMPRESSLEVEL', 1))  # zlib level for generated .xlsx files
+
+# Per-run output formats. .xlsx files go through the selected writer backend; the other formats
+# have a single writer each, picked by file extension
+OUTPUT_FORMATS = ('xlsx', 'csv', 'parquet')
+OUTPUT_MIMETYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+# Text columns with at most this ratio of distinct values to rows are loaded as categoricals
+CATEGORY_MAX_RATIO = float(os.environ.get('CATEGORY_MAX_RATIO', 0.5))
+
+def restore_dtypes(df):
+    """Return df with the columns compact_dataset shrank back in their parsed dtypes
+    
+    The result doesn't carry the parsed_dtypes attribute, which Parquet would otherwise
+    store in the file's metadata.
+    """
+    parsed = df.attrs.get('parsed_dtypes')
+    if parsed is None:
+        return df
+    changed = {col: dtype for col, dtype in parsed.items() if col in df.columns and df[col].dtype != dtype}
+    restored = df.astype(changed) if changed else df.copy(deep=False)
+    restored.attrs = {key: value for key, value in df.attrs.items() if key != 'parsed_dtypes'}
+    return restored
+
+def format_value(value):
+    """Render a cell value the way it is shown to users and matched in rules"""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def read_upload(file_path):
+    """Read a whole stored upload into a DataFrame, whatever its format"""
+    extension = file_path.rsplit('.', 1)[1].lower()
+    if extension == 'csv':
+        return pd.read_csv(file_path, encoding_errors='replace')
+    if extension == 'parquet':
+        return pd.read_parquet(file_path)
+    return pd.read_excel(file_path)
+
+# Path separators, characters Windows rejects in file names, and control characters
+UNSAFE_FILENAME_CHARS = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+def safe_filename(name):
+    """Make a name built from rule values usable as a file name in an output folder
+    
+    Characters that would make it a path, or that Windows doesn't allow, become '_'; leading
+    dots are dropped so no output is hidden or named '..'.
+    """
+    return UNSAFE_FILENAME_CHARS.sub('_', name).strip().lstrip('.') or 'split'
+
+def generate_filename(rule_data, extension='xlsx'):
+    """Generate filename based on rule data, with the extension of the output format"""
+    if rule_data.get('custom_name'):
+        return f"{safe_filename(rule_data['custom_name'])}.{extension}"
+    
+    # Auto-generate name based on rule
+    rule_type = rule_data['rule_type']
+    if rule_type == 'single':
+        col = rule_data['column1']
+        values = rule_data['value1'] if isinstance(rule_data['value1'], list) else [rule_data['value1']]
+        values_str = '_'.join(values)
+        return f"{safe_filename(f'{col}_{values_str}')}.{extension}"
+    elif rule_type == 'and':
+        # Start with first two columns
+        col1 = rule_data['column1']
+        values1 = rule_data['value1'] if isinstance(rule_data['value1'], list) else [rule_data['value1']]
+        col2 = rule_data['column2']
+        values2 = rule_data['value2'] if isinstance(rule_data['value2'], list) else [rule_data['value2']]
+        values1_str = '_'.join(values1)
+        values2_str = '_'.join(values2)
+        filename = f"{col1}_{values1_str}_{col2}_{values2_str}"
+        
+        # Add additional columns
+        additional_columns = rule_data.get('additional_columns', [])
+        additional_values = rule_data.get('additional_values', [])
+        
+        for i, col in enumerate(additional_columns):
+            if i < len(additional_values):
+                values = additional_values[i] if isinstance(additional_values[i], list) else [additional_values[i]]
+                values_str = '_'.join(values)
+                filename += f"_{col}_{values_str}"
+        
+        return f"{safe_filename(filename)}.{extension}"
+    elif rule_type == 'filter':
+        return f"{safe_filename(condition_label(rule_data['condition']))}.{extension}"
+    elif rule_type == 'or':
+        # Start with first two columns
+        col1 = rule_data['column1']
+        values1 = rule_data['value1'] if isinstance(rule_data['value1'], list) else [rule_data['value1']]
+        col2 = rule_data['column2']
+        values2 = rule_data['value2'] if isinstance(rule_data['value2'], list) else [rule_data['value2']]
+        values1_str = '_'.join(values1)
+        values2_str = '_'.join(values2)
+        filename = f"{col1}_{values1_str}_OR_{col2}_{values2_str}"
+        
+        # Add additional columns
+        additional_columns = rule_data.get('additional_columns', [])
+        additional_values = rule_data.get('additional_values', [])
+        
+        for i, col in enumerate(additional_columns):
+            if i < len(additional_values):
+                values = additional_values[i] if isinstance(additional_values[i], list) else [additional_values[i]]
+                values_str = '_'.join(values)
+                filename += f"_OR_{col}_{values_str}"
+        
+        return f"{safe_filename(filename)}.{extension}"
+    
+    return f"split_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+
+# Fixed parts of the .xlsx package written by StreamingWorkbook
+XLSX_NAMESPACE = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+XLSX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/></Relationships>'
+)
+XLSX_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    f'<styleSheet xmlns="{XLSX_NAMESPACE}">'
+    '<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy-mm-dd hh:mm:ss"/></numFmts>'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/><family val="2"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/><family val="2"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="2"><border><left/><right/><top/><bottom/><diagonal/></border>'
+    '<border><left style="thin"><color auto="1"/></left><right style="thin"><color auto="1"/></right>'
+    '<top style="thin"><color auto="1"/></top><bottom style="thin"><color auto="1"/></bottom><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="1" xfId="0" applyFont="1" applyBorder="1" applyAlignment="1">'
+    '<alignment horizontal="center" vertical="top"/></xf></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles></styleSheet>'
+)
+XLSX_MAX_ROWS = 1048576
+XLSX_MAX_STRING = 32767
+XLSX_DATE_STYLE = 1
+XLSX_HEADER_STYLE = 2
+EXCEL_EPOCH = datetime(1899, 12, 30)
+ILLEGAL_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+def column_letter(index):
+    """Convert a zero-based column index to its Excel letters (0 -> A, 27 -> AB)"""
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def excel_serial(value):
+    """Convert a date/time value to an Excel serial day number"""
+    if isinstance(value, datetime):
+        return (value.replace(tzinfo=None) - EXCEL_EPOCH).total_seconds() / 86400
+    if isinstance(value, date):
+        return (datetime.combine(value, time_of_day()) - EXCEL_EPOCH).total_seconds() / 86400
+    if isinstance(value, time_of_day):
+        return (value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1e6) / 86400
+    return value.total_seconds() / 86400  # timedelta
+
+class StreamingWorkbook:
+    """Constant-memory .xlsx writer
+    
+    Each sheet's XML is generated a chunk of rows at a time and compressed straight into the
+    zip container, so memory use doesn't grow with the number of rows. Only the shared-strings
+    table stays in memory, and every sheet in the workbook shares it. The target can be a path
+    or any writable file object, including unseekable response streams.
+    """
+    
+    def __init__(self, target):
+        self.zip = zipfile.ZipFile(target, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=WRITE_COMPRESSLEVEL)
+        self.shared_strings = {}
+        self.sheet_names = []
+    
+    def string_index(self, value):
+        """Return a string's position in the shared-strings table, adding it if new"""
+        index = self.shared_strings.get(value)
+        if index is None:
+            index = self.shared_strings[value] = len(self.shared_strings)
+        return index
+    
+    def cell_tail(self, value):
+        """Return a cell's XML after its reference (`<c r="A1` + tail), or None for a blank cell"""
+        if value is None or value is pd.NaT or (isinstance(value, float) and not math.isfinite(value)):
+            return None
+        if isinstance(value, str):
+            return f'" t="s"><v>{self.string_index(value)}</v></c>'
+        if isinstance(value, (bool, np.bool_)):
+            return f'" t="b"><v>{int(value)}</v></c>'
+        if isinstance(value, (int, np.integer)):
+            return f'"><v>{int(value)}</v></c>'
+        if isinstance(value, (float, np.floating)):
+            return f'"><v>{float(value)!r}</v></c>'
+        if isinstance(value, (datetime, date, time_of_day)):
+            return f'" s="{XLSX_DATE_STYLE}"><v>{excel_serial(value)!r}</v></c>'
+        if isinstance(value, timedelta):
+            return f'"><v>{excel_serial(value)!r}</v></c>'
+        return f'" t="s"><v>{self.string_index(str(value))}</v></c>'
+    
+    def column_cells(self, series, letter, first_row):
+        """Return the cell XML for each value of a column chunk (empty string for blank cells)"""
+        refs = [f'<c r="{letter}{row}' for row in range(first_row, first_row + len(series))]
+        dtype = series.dtype
+        
+        if isinstance(dtype, pd.CategoricalDtype):
+            # Render each category once; missing values (code -1) pick the trailing blank
+            tails = [self.cell_tail(value) for value in series.cat.categories.astype(object)] + [None]
+            tails = [tail or '' for tail in tails]
+            return [ref + tails[code] if tails[code] else '' for ref, code in zip(refs, series.cat.codes.tolist())]
+        
+        if pd.api.types.is_bool_dtype(dtype):
+            return [f'{ref}" t="b"><v>{int(value)}</v></c>' for ref, value in zip(refs, series.tolist())]
+        
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            if getattr(dtype, 'tz', None) is not None:
+                series = series.dt.tz_localize(None)
+            serials = ((series - EXCEL_EPOCH) / pd.Timedelta(days=1)).tolist()
+            return [f'{ref}" s="{XLSX_DATE_STYLE}"><v>{serial!r}</v></c>' if serial == serial else ''
+                    for ref, serial in zip(refs, serials)]
+        
+        if pd.api.types.is_integer_dtype(dtype) and not pd.api.types.is_extension_array_dtype(dtype):
+            return [f'{ref}"><v>{value}</v></c>' for ref, value in zip(refs, series.tolist())]
+        
+        if pd.api.types.is_float_dtype(dtype) and not pd.api.types.is_extension_array_dtype(dtype):
+            return [f'{ref}"><v>{value!r}</v></c>' if math.isfinite(value) else ''
+                    for ref, value in zip(refs, series.tolist())]
+        
+        values = series.astype(object).where(series.notna(), None).tolist()
+        cells = []
+        for ref, value in zip(refs, values):
+            tail = self.cell_tail(value)
+            cells.append(ref + tail if tail else '')
+        return cells
+    
+    def add_sheet(self, name, df):
+        """Stream a DataFrame into a new worksheet, header row first"""
+        if len(df) + 1 > XLSX_MAX_ROWS:
+            raise ValueError(f"{len(df)} rows exceed Excel's limit of {XLSX_MAX_ROWS - 1} data rows per sheet")
+        
+        self.sheet_names.append(name)
+        letters = [column_letter(i) for i in range(len(df.columns))]
+        entry = f'xl/worksheets/sheet{len(self.sheet_names)}.xml'
+        # Very large sheets need zip64 headers since the entry size isn't known up front
+        large = len(df) * max(len(df.columns), 1) > 20_000_000
+        
+        with self.zip.open(entry, 'w', force_zip64=large) as sheet:
+            sheet.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                         f'<worksheet xmlns="{XLSX_NAMESPACE}"><sheetData>').encode('utf-8'))
+            
+            header = [f'<c r="{letter}1" s="{XLSX_HEADER_STYLE}" t="s"><v>{self.string_index(format_value(col))}</v></c>'
+                      for letter, col in zip(letters, df.columns)]
+            sheet.write(f'<row r="1">{"".join(header)}</row>'.encode('utf-8'))
+            
+            for start in range(0, len(df), WRITE_CHUNK_ROWS):
+                chunk = df.iloc[start:start + WRITE_CHUNK_ROWS]
+                first_row = start + 2
+                columns = [self.column_cells(chunk.iloc[:, i], letters[i], first_row) for i in range(len(letters))]
+                rows = [f'<row r="{first_row + offset}">{"".join(cells)}</row>' for offset, cells in enumerate(zip(*columns))]
+                sheet.write(''.join(rows).encode('utf-8'))
+            
+            sheet.write(b'</sheetData></worksheet>')
+    
+    def close(self):
+        """Write the shared-strings table and workbook metadata, then finish the zip container"""
+        try:
+            with self.zip.open('xl/sharedStrings.xml', 'w') as sst:
+                sst.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                           f'<sst xmlns="{XLSX_NAMESPACE}" uniqueCount="{len(self.shared_strings)}">').encode('utf-8'))
+                batch = []
+                for value in self.shared_strings:
+                    text = xml_escape(ILLEGAL_XML_CHARS.sub('', value[:XLSX_MAX_STRING]))
+                    batch.append(f'<si><t xml:space="preserve">{text}</t></si>')
+                    if len(batch) >= WRITE_CHUNK_ROWS:
+                        sst.write(''.join(batch).encode('utf-8'))
+                        batch = []
+                sst.write((''.join(batch) + '</sst>').encode('utf-8'))
+            
+            sheets = ''.join(f'<sheet name={quoteattr(name)} sheetId="{i}" r:id="rId{i}"/>'
+                             for i, name in enumerate(self.sheet_names, start=1))
+            self.zip.writestr('xl/workbook.xml', (
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                f'<workbook xmlns="{XLSX_NAMESPACE}" '
+                'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+                f'<sheets>{sheets}</sheets></workbook>'))
+            
+            count = len(self.sheet_names)
+            relationships = ''.join(
+                f'<Relationship Id="rId{i}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                f'Target="worksheets/sheet{i}.xml"/>' for i in range(1, count + 1))
+            self.zip.writestr('xl/_rels/workbook.xml.rels', (
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                f'{relationships}'
+                f'<Relationship Id="rId{count + 1}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+                'Target="styles.xml"/>'
+                f'<Relationship Id="rId{count + 2}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings" '
+                'Target="sharedStrings.xml"/></Relationships>'))
+            
+            self.zip.writestr('xl/styles.xml', XLSX_STYLES)
+            self.zip.writestr('_rels/.rels', XLSX_RELS)
+            
+            overrides = ''.join(
+                f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                for i in range(1, count + 1))
+            self.zip.writestr('[Content_Types].xml', (
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                '<Default Extension="xml" ContentType="application/xml"/>'
+                '<Override PartName="/xl/workbook.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                f'{overrides}'
+                '<Override PartName="/xl/styles.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+                '<Override PartName="/xl/sharedStrings.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+                '</Types>'))
+        finally:
+            self.zip.close()
+
+def write_workbook_streaming(sheets, output_path):
+    """Write (sheet name, DataFrame) pairs into one workbook with the streaming writer
+    
+    Sheets are written one after another and share a single shared-strings table.
+    """
+    workbook = StreamingWorkbook(output_path)
+    try:
+        for sheet_name, df in sheets:
+            workbook.add_sheet(sheet_name, df)
+    finally:
+        workbook.close()
+
+def write_workbook_openpyxl(sheets, output_path):
+    """Write (sheet name, DataFrame) pairs into one workbook through pandas' openpyxl engine"""
+    with pd.ExcelWriter(output_path, engine='openpyxl') as excel_writer:
+        for sheet_name, df in sheets:
+            df.to_excel(excel_writer, sheet_name=sheet_name, index=False)
+
+def write_xlsx_streaming(df, output_path):
+    """Write a DataFrame as a single-sheet workbook with the streaming writer"""
+    write_workbook_streaming([('Sheet1', df)], output_path)
+
+def write_xlsx_openpyxl(df, output_path):
+    """Write a DataFrame through pandas' default openpyxl engine"""
+    df.to_excel(output_path, index=False)
+
+def write_csv(df, output_path):
+    """Write a DataFrame as UTF-8 CSV"""
+    df.to_csv(output_path, index=False)
+
+def write_parquet(df, output_path):
+    """Write a DataFrame as Parquet, storing mixed-type text columns as strings"""
+    try:
+        df.to_parquet(output_path, index=False)
+    except Exception:
+        # Arrow needs one type per column; a column mixing numbers and text is written as text
+        mixed = {col: 'string' for col in df.columns if df[col].dtype == object}
+        df.astype(mixed).to_parquet(output_path, index=False)
+
+# Writers of the non-Excel output formats, by file extension
+FORMAT_WRITERS = {
+    'csv': write_csv,
+    'parquet': write_parquet,
+}
+
+# Registered .xlsx writers, selectable per run with the 'writer' request field
+OUTPUT_WRITERS = {
+    'streaming': write_xlsx_streaming,
+    'openpyxl': write_xlsx_openpyxl,
+}
+
+# Multi-sheet counterparts of OUTPUT_WRITERS, used by the 'workbook' output mode
+WORKBOOK_WRITERS = {
+    'streaming': write_workbook_streaming,
+    'openpyxl': write_workbook_openpyxl,
+}
+
+# 'lazy' works out each file's rows up front but writes a file only when it is first downloaded
+OUTPUT_MODES = ('files', 'workbook', 'lazy')
+
+# Excel's limits on worksheet names
+SHEET_NAME_MAX_LENGTH = 31
+INVALID_SHEET_NAME_CHARS = re.compile(r'[\[\]:*?/\\]')
+
+def sheet_name_for(filename, used_names):
+    """Turn an output filename into a valid, unique Excel sheet name
+    
+    The extension and characters Excel rejects are removed and the name is trimmed to 31
+    characters; clashes (compared case-insensitively, like Excel) get a ~2, ~3... suffix.
+    used_names is updated with the returned name.
+    """
+    name = INVALID_SHEET_NAME_CHARS.sub('_', os.path.splitext(filename)[0]).strip("'").strip()
+    if not name or name.lower() == 'history':  # 'History' is reserved by Excel
+        name = f"{name}_" if name else 'Sheet'
+    name = name[:SHEET_NAME_MAX_LENGTH]
+    candidate = name
+    suffix_number = 2
+    while candidate.lower() in used_names:
+        suffix = f"~{suffix_number}"
+        candidate = name[:SHEET_NAME_MAX_LENGTH - len(suffix)] + suffix
+        suffix_number += 1
+    used_names.add(candidate.lower())
+    return candidate
+
+def write_atomically(output_path, write):
+    """Call write(tmp_path), then move the finished file to output_path; return seconds taken"""
+    folder, filename = os.path.split(output_path)
+    # Write under a temporary name so downloads never see a half-written file
+    tmp_path = os.path.join(folder, f".{uuid.uuid4().hex}_{filename}")
+    start = time.perf_counter()
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return time.perf_counter() - start
+
+def output_stats(writer, rows, output_path, seconds):
+    """Throughput stats for one written file"""
+    size = os.path.getsize(output_path)
+    return {
+        'writer': writer,
+        'rows': rows,
+        'bytes': size,
+        'seconds': round(seconds, 4),
+        'rows_per_second': round(rows / seconds) if seconds > 0 else None
+    }
+
+def write_output(df, output_path, writer=None):
+    """Write a DataFrame in the format named by its extension and return its throughput stats
+    
+    .xlsx files use the selected writer backend; the stats name the format's writer otherwise.
+    """
+    extension = output_path.rsplit('.', 1)[-1].lower()
+    if extension in FORMAT_WRITERS:
+        writer, write = extension, FORMAT_WRITERS[extension]
+    else:
+        writer = writer or OUTPUT_WRITER
+        write = OUTPUT_WRITERS[writer]
+    df = restore_dtypes(df)  # The compact in-memory dtypes don't change what is written
+    seconds = write_atomically(output_path, lambda path: write(df, path))
+    return output_stats(writer, len(df), output_path, seconds)
+
+def write_workbook(sheets, output_path, writer=None):
+    """Write an iterable of (sheet name, DataFrame) pairs as one workbook and return its stats
+    
+    sheets may be a generator; each DataFrame is only needed while its sheet is written.
+    """
+    writer = writer or OUTPUT_WRITER
+    rows = 0
+    
+    def counted_sheets():
+        nonlocal rows
+        for sheet_name, df in sheets:
+            rows += len(df)
+            yield sheet_name, restore_dtypes(df)
+    
+    seconds = write_atomically(output_path, lambda path: WORKBOOK_WRITERS[writer](counted_sheets(), path))
+    return output_stats(writer, rows, output_path, seconds)
+
+def as_value_list(value):
+    """Wrap a single rule value in a list"""
+    return value if isinstance(value, list) else [value]
+
+def rule_conditions(rule_data):
+    """Return a rule's (column, values) conditions in the order they appear"""
+    conditions = [(rule_data['column1'], as_value_list(rule_data['value1']))]
+    if rule_data['rule_type'] in ['and', 'or']:
+        conditions.append((rule_data['column2'], as_value_list(rule_data['value2'])))
+        
+        # Additional columns (3-6) if they exist
+        additional_columns = rule_data.get('additional_columns', [])
+        additional_values = rule_data.get('additional_values', [])
+        for i, col in enumerate(additional_columns):
+            if i < len(additional_values):
+                conditions.append((col, as_value_list(additional_values[i])))
+    return conditions
+
+# Operators of a 'filter' rule's conditions. Numbers compare numerically and strings as dates;
+# 'period' matches the dates in a month, quarter or year written as '2024-07', '2024-Q3' or '2024'.
+COMPARISONS = {'=': operator.eq, '!=': operator.ne, '>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+CONDITION_OPS = ('in', *COMPARISONS, 'between', 'prefix', 'period')
+CONDITION_MAX_DEPTH = 20
+COMPARISON_NAMES = {'=': 'eq', '!=': 'ne', '>': 'gt', '>=': 'ge', '<': 'lt', '<=': 'le'}
+
+def is_number(value):
+    """True for JSON numbers (bool is an int in Python, but not a number here)"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def date_operand(value):
+    """Return a text value as a tz-naive ISO date string, or None if it isn't a date"""
+    if not isinstance(value, str) or not value.strip():
+        return None
+    try:
+        timestamp = pd.Timestamp(value.strip())
+    except (ValueError, TypeError):
+        return None
+    if timestamp is pd.NaT:
+        return None
+    return (timestamp.tz_convert(None) if timestamp.tz else timestamp).isoformat()
+
+def comparison_operand(value, op, column):
+    """Turn a comparison value into a leaf key part: a float, or an ISO date string"""
+    if is_number(value):
+        return float(value)
+    if date_operand(value) is not None:
+        return date_operand(value)
+    raise ValueError(f'"{op}" on column "{column}" needs a number or a date, not {json.dumps(value)}.')
+
+def compile_leaf(node):
+    """Compile a {'column', 'op', 'value'} condition into a predicate tree node"""
+    column, op, value = node.get('column'), node.get('op', 'in'), node.get('value')
+    if not isinstance(column, str) or not column:
+        raise ValueError('Every condition needs a column.')
+    if op not in CONDITION_OPS:
+        raise ValueError(f'Unknown operator "{op}". Available operators: {", ".join(CONDITION_OPS)}.')
+    
+    if op == 'in' or (op in ('=', '!=') and not is_number(value)):
+        values = as_value_list(value)
+        if not values or any(v is None or isinstance(v, (dict, list)) for v in values):
+            raise ValueError(f'Select at least one value for column "{column}".')
+        leaf = {'leaf': ('in', column, frozenset(format_value(v) for v in values))}
+        moment = date_operand(value) if op != 'in' else None
+        if moment is not None:
+            # On a date column the value is a point in time, whichever way it is written
+            leaf = {'op': 'or', 'children': [leaf, {'leaf': ('date_is', column, moment)}]}
+        return {'op': 'not', 'children': [leaf]} if op == '!=' else leaf
+    if op == '!=':
+        # Like NOT, != matches blank cells too
+        return {'op': 'not', 'children': [{'leaf': ('compare', column, '=', comparison_operand(value, op, column))}]}
+    if op in COMPARISONS:
+        return {'leaf': ('compare', column, op, comparison_operand(value, op, column))}
+    if op == 'between':
+        if not isinstance(value, list) or len(value) != 2:
+            raise ValueError(f'"between" on column "{column}" needs a [low, high] pair.')
+        low, high = (comparison_operand(bound, op, column) for bound in value)
+        if type(low) is not type(high):
+            raise ValueError(f'"between" on column "{column}" needs two numbers or two dates.')
+        return {'leaf': ('between', column, min(low, high), max(low, high))}
+    if op == 'prefix':
+        if not isinstance(value, str) or not value:
+            raise ValueError(f'"prefix" on column "{column}" needs some text to match.')
+        return {'leaf': ('prefix', column, value)}
+    try:
+        period = pd.Period(str(value).strip())
+    except (ValueError, TypeError):
+        raise ValueError(f'"{value}" is not a period; use a date, month, quarter or year like '
+                         f'2024-07-15, 2024-07, 2024-Q3 or 2024.')
+    return {'leaf': ('window', column, period.start_time.isoformat(), (period + 1).start_time.isoformat())}
+
+def compile_condition(node, depth=0):
+    """Compile a 'filter' rule's condition into a predicate tree, raising ValueError if it's invalid
+    
+    A condition is a leaf {'column', 'op', 'value'} or a group {'and': [...]}, {'or': [...]}
+    or {'not': condition}; groups nest.
+    """
+    if depth > CONDITION_MAX_DEPTH:
+        raise ValueError(f'Conditions can be nested at most {CONDITION_MAX_DEPTH} levels deep.')
+    if not isinstance(node, dict):
+        raise ValueError('A condition must be an object.')
+    groups = [op for op in ('and', 'or', 'not') if op in node]
+    if len(groups) > 1 or (groups and 'column' in node):
+        raise ValueError('A condition must be one of a column test, an "and" group, an "or" group or a "not".')
+    if not groups:
+        return compile_leaf(node)
+    op = groups[0]
+    if op == 'not':
+        return {'op': 'not', 'children': [compile_condition(node['not'], depth + 1)]}
+    if not isinstance(node[op], list) or not node[op]:
+        raise ValueError(f'An "{op}" group needs a list of at least one condition.')
+    return {'op': op, 'children': [compile_condition(child, depth + 1) for child in node[op]]}
+
+def condition_columns(node):
+    """Yield the columns a (valid) condition reads, in order"""
+    if 'not' in node:
+        yield from condition_columns(node['not'])
+    elif 'and' in node or 'or' in node:
+        for child in node.get('and', node.get('or')):
+            yield from condition_columns(child)
+    else:
+        yield node['column']
+
+def condition_label(node):
+    """Describe a (valid) condition for a file name, e.g. Price_100-500_OR_(NOT_Region_Asia)"""
+    if 'not' in node:
+        return f"NOT_{condition_label(node['not'])}"
+    if 'and' in node or 'or' in node:
+        children = node.get('and', node.get('or'))
+        labels = [condition_label(child) if 'column' in child or 'not' in child else f"({condition_label(child)})" for child in children]
+        return ('_' if 'and' in node else '_OR_').join(labels)
+    op, value = node.get('op', 'in'), node.get('value')
+    if op == 'between':
+        return f"{node['column']}_{format_value(value[0])}-{format_value(value[1])}"
+    if op == 'in' or (op == '=' and not is_number(value)):
+        return f"{node['column']}_{'_'.join(format_value(v) for v in as_value_list(value))}"
+    prefix = {'prefix': 'starts_', 'period': '', **{name: f'{label}_' for name, label in COMPARISON_NAMES.items()}}[op]
+    return f"{node['column']}_{prefix}{format_value(value)}"
+
+def compile_rule(rule_data):
+    """Compile a rule dict into a predicate tree
+    
+    Inner nodes are {'op': 'and' | 'or' | 'not', 'children': [...]}; leaves are {'leaf': key}
+    where key is ('in', column, frozenset of value strings) for a value list, or a 'compare',
+    'date_is', 'between', 'prefix' or 'window' key from compile_leaf. An empty 'and' matches every row.
+    """
+    rule_type = rule_data.get('rule_type')
+    if rule_type == 'filter':
+        return compile_condition(rule_data['condition'])
+    if rule_type not in ['single', 'and', 'or']:
+        return {'op': 'and', 'children': []}
+    
+    children = []
+    for column, values in rule_conditions(rule_data):
+        children.append({'leaf': ('in', column, frozenset(format_value(v) for v in values))})
+    return {'op': 'or' if rule_type == 'or' else 'and', 'children': children}
+
+def tree_leaves(tree):
+    """Yield the leaf keys of a predicate tree"""
+    if 'leaf' in tree:
+        yield tree['leaf']
+    else:
+        for child in tree['children']:
+            yield from tree_leaves(child)
+
+def plan_rules(rules):
+    """Compile a list of rules and collect the distinct predicates they share
+    
+    Returns (predicates, trees): the ordered distinct leaf keys across all rules and one
+    predicate tree per rule.
+    """
+    trees = [compile_rule(rule_data) for rule_data in rules]
+    predicates = {}
+    for tree in trees:
+        for key in tree_leaves(tree):
+            predicates.setdefault(key, None)
+    return list(predicates), trees
+
+def categorize_columns(df):
+    """Convert low-cardinality text columns to categoricals so rules match on integer codes"""
+    for col in df.columns:
+        series = df[col]
+        if series.dtype != object or len(series) == 0:
+            continue
+        if series.nunique(dropna=True) <= len(series) * CATEGORY_MAX_RATIO:
+            try:
+                df[col] = series.astype('category')
+            except TypeError:
+                pass  # Values that can't be hashed stay as they are
+    return df
+
+def column_codes(series):
+    """Return (integer codes, {value string: [codes]}, number of distinct values) for a column;
+    missing values get code -1"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes = series.cat.codes.to_numpy()
+        categories = series.cat.categories
+    else:
+        codes, categories = pd.factorize(series)
+    label_codes = {}
+    for code, category in enumerate(categories):
+        label_codes.setdefault(format_value(category), []).append(code)
+    return codes, label_codes, len(categories)
+
+def to_datetimes(values):
+    """Parse a Series as tz-naive datetimes; values that aren't dates (and numbers) become NaT"""
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        parsed = values
+    elif pd.api.types.is_numeric_dtype(values.dtype):
+        return pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    else:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)  # Format inference falls back to per-value parsing
+            parsed = pd.to_datetime(values, errors='coerce')
+    if getattr(parsed.dt, 'tz', None) is not None:
+        parsed = parsed.dt.tz_convert(None)
+    return parsed.astype('datetime64[ns]')
+
+def comparable_values(series, kind):
+    """Return a column as a float ('number') or datetime64 ('date') array for comparisons
+    
+    Values that can't be read as such become NaN or NaT, which no comparison matches. A
+    categorical column converts only its categories.
+    """
+    convert = (lambda values: pd.to_numeric(values, errors='coerce').astype(float)) if kind == 'number' else to_datetimes
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        converted = convert(pd.Series(series.cat.categories)).to_numpy()
+        missing = np.array([np.nan if kind == 'number' else np.datetime64('NaT', 'ns')], dtype=converted.dtype)
+        # Code -1 (missing) reads the extra last slot
+        return np.concatenate([converted, missing])[series.cat.codes.to_numpy()]
+    return convert(series).to_numpy()
+
+def evaluate_tree(tree, leaf_masks, n_rows):
+    """Evaluate a predicate tree against precomputed leaf masks"""
+    if 'leaf' in tree:
+        return leaf_masks[tree['leaf']]
+    masks = [evaluate_tree(child, leaf_masks, n_rows) for child in tree['children']]
+    if tree['op'] == 'not':
+        return ~masks[0]
+    if not masks:
+        return np.ones(n_rows, dtype=bool)
+    if len(masks) == 1:
+        return masks[0]
+    if tree['op'] == 'or':
+        return np.logical_or.reduce(masks)
+    return np.logical_and.reduce(masks)
+
+def evaluate_leaf(df, key, encoded):
+    """Evaluate one leaf key over a DataFrame as a vectorized mask
+    
+    Value lists and prefixes are lookups on the column's integer codes; comparisons, ranges
+    and date windows compare the column, converted once to numbers or dates, with the bounds.
+    encoded caches codes and converted columns across the leaves of a plan.
+    """
+    kind, column = key[0], key[1]
+    if kind in ('in', 'prefix'):
+        if column not in encoded:
+            encoded[column] = column_codes(df[column])
+        codes, label_codes, n_categories = encoded[column]
+        labels = key[2] if kind == 'in' else [label for label in label_codes if label.startswith(key[2])]
+        # Lookup table indexed by code; the extra last slot is what code -1 (missing) reads
+        lookup = np.zeros(n_categories + 1, dtype=bool)
+        for value in labels:
+            lookup[label_codes.get(value, [])] = True
+        return lookup[codes]
+    
+    if kind == 'date_is':
+        # Only a column that holds dates compares as dates; text is matched by the 'in' leaf beside this one
+        series = df[column]
+        dtype = series.cat.categories.dtype if isinstance(series.dtype, pd.CategoricalDtype) else series.dtype
+        if not pd.api.types.is_datetime64_any_dtype(dtype):
+            return np.zeros(len(df), dtype=bool)
+        kind, key = 'compare', ('compare', column, '=', key[2])
+    
+    bounds = key[3:] if kind == 'compare' else key[2:]
+    value_kind = 'number' if isinstance(bounds[0], float) else 'date'
+    if (column, value_kind) not in encoded:
+        encoded[column, value_kind] = comparable_values(df[column], value_kind)
+    values = encoded[column, value_kind]
+    if value_kind == 'date':
+        bounds = [np.datetime64(pd.Timestamp(bound), 'ns') for bound in bounds]
+    if kind == 'compare':
+        return COMPARISONS[key[2]](values, bounds[0])
+    if kind == 'between':
+        return (values >= bounds[0]) & (values <= bounds[1])
+    return (values >= bounds[0]) & (values < bounds[1])  # 'window': start inclusive, end exclusive
+
+def evaluate_plan(df, predicates, trees):
+    """Evaluate every distinct predicate once as a vectorized mask, then each rule's tree"""
+    encoded = {}
+    leaf_masks = {key: evaluate_leaf(df, key, encoded) for key in predicates}
+    return [evaluate_tree(tree, leaf_masks, len(df)) for tree in trees]
+
+def apply_rule(df, rule_data):
+    """Apply rule to DataFrame and return filtered data"""
+    predicates, trees = plan_rules([rule_data])
+    return df[evaluate_plan(df, predicates, trees)[0]]
+
+def partition_rows(df, columns):
+    """Group row positions by the distinct values of the key columns in one groupby pass
+    
+    Returns a list of (key tuple, row indices); rows with a blank key are left out.
+    """
+    try:
+        grouped = df.groupby(columns, sort=True, observed=True, dropna=True)
+        indices = grouped.indices
+    except TypeError:
+        # Mixed value types can't be sorted; keep first-seen order instead
+        indices = df.groupby(columns, sort=False, observed=True, dropna=True).indices
+    return [(key if isinstance(key, tuple) else (key,), rows) for key, rows in indices.items()]
+
+def split_group_rule(rule_data, key):
+    """Return the single/AND rule equivalent to one group of a split rule, for naming its file"""
+    columns = rule_data['columns']
+    values = [format_value(value) for value in key]
+    group_rule = {'rule_type': 'single' if len(columns) == 1 else 'and', 'column1': columns[0], 'value1': [values[0]]}
+    if len(columns) > 1:
+        group_rule.update(column2=columns[1], value2=[values[1]],
+                          additional_columns=columns[2:], additional_values=[[value] for value in values[2:]])
+    if rule_data.get('custom_name'):
+        group_rule['custom_name'] = f"{rule_data['custom_name']}_{'_'.join(values)}"
+    return group_rule
+
+def validate_rule(rule, columns):
+    """Return an error message for an invalid rule, or None if it can be applied"""
+    if rule.get('rule_type') == 'filter':
+        try:
+            compile_condition(rule.get('condition'))
+        except ValueError as e:
+            return str(e)
+        for col in condition_columns(rule['condition']):
+            if col not in columns:
+                return f'Column "{col}" not found in the uploaded file.'
+        return None
+    if rule.get('rule_type') == 'split':
+        split_columns = rule.get('columns')
+        if not isinstance(split_columns, list) or not split_columns:
+            return 'Select at least one column to split by.'
+        for col in split_columns:
+            if col not in columns:
+                return f'Column "{col}" not found in the uploaded file.'
+        return None
+    if not rule.get('column1') or not rule.get('value1'):
+        return 'Missing required column or value.'
+    if rule.get('rule_type') in ['and', 'or'] and (not rule.get('column2') or not rule.get('value2')):
+        return 'Missing required column2 or value2.'
+    # Check columns exist
+    for col in [rule.get('column1'), rule.get('column2')] + rule.get('additional_columns', []):
+        if col and col not in columns:
+            return f'Column "{col}" not found in the uploaded file.'
+    return None
+
+def parse_output_options(data):
+    """Read the output settings of a /process request: returns (options, error message)"""
+    writer = data.get('writer') or OUTPUT_WRITER
+    if writer not in OUTPUT_WRITERS:
+        return None, f'Unknown writer "{writer}". Available writers: {", ".join(OUTPUT_WRITERS)}.'
+    mode = data.get('output_mode') or 'files'
+    if mode not in OUTPUT_MODES:
+        return None, f'Unknown output mode "{mode}". Available modes: {", ".join(OUTPUT_MODES)}.'
+    output_format = str(data.get('output_format') or 'xlsx').lower().lstrip('.')
+    if output_format not in OUTPUT_FORMATS:
+        return None, f'Unknown output format "{output_format}". Available formats: {", ".join(OUTPUT_FORMATS)}.'
+    if mode == 'workbook' and output_format != 'xlsx':
+        return None, 'The single-workbook output mode writes .xlsx files only.'
+    workbook_name = str(data.get('workbook_name') or '').strip()
+    if workbook_name.lower().endswith('.xlsx'):
+        workbook_name = workbook_name[:-5]
+    output_columns = data.get('output_columns') or None
+    if output_columns is not None and (not isinstance(output_columns, list)
+                                       or not all(isinstance(col, str) for col in output_columns)):
+        return None, 'output_columns must be a list of column names.'
+    return {'writer': writer, 'mode': mode, 'format': output_format, 'workbook_name': workbook_name or None,
+            'columns': list(dict.fromkeys(output_columns)) if output_columns else None}, None
+
+def missing_output_columns(output, columns):
+    """Return the output_columns a dataset doesn't have"""
+    return [col for col in output['columns'] or [] if col not in columns]
@@ -5,6 +5,16 @@ import os
 import sys
 import subprocess
 import time
+import io
+import zipfile
+import json
+import tempfile
+
+# Keep the suite's uploads, registry and error log out of the working tree. These are read when
+# app is first imported, so they are set here, before any test imports it.
+TEST_STATE_DIR = tempfile.mkdtemp(prefix='excel_splitter_test_')
+os.environ.setdefault('UPLOAD_FOLDER', os.path.join(TEST_STATE_DIR, 'uploads'))
+os.environ.setdefault('ERROR_LOG_PATH', os.path.join(TEST_STATE_DIR, 'error.log'))
 
 def test_dependencies():
     """Test if all required dependencies are installed"""
@@ -81,6 +91,1073 @@ def test_flask_app():
         print(f"❌ Flask application test failed: {e}")
         return False
 
+def upload_sample(client):
+    """Upload sample_data.xlsx through the test client and return the JSON response"""
+    from create_sample_data import create_sample_data
+    filename = create_sample_data()
+    with open(filename, 'rb') as f:
+        response = client.post('/upload', data={'file': (f, filename)}, content_type='multipart/form-data')
+    assert response.status_code == 200, f"Upload failed: {response.get_data(as_text=True)}"
+    return response.get_json()
+
+def write_rows_or_fail(dataset_id, row_indices, output_path, writer, columns=None):
+    """Stand-in for app.write_rows_task that fails in the worker for outputs named pool_fail"""
+    import app as app_module
+    if os.path.basename(output_path).startswith('pool_fail'):
+        raise OSError('disk full')
+    return app_module.write_rows_task(dataset_id, row_indices, output_path, writer, columns)
+
+def test_dataset_cache():
+    """Test that /process reuses the dataset parsed during upload"""
+    print("\n🗄️ Testing parsed dataset cache...")
+    
+    import app as app_module
+    
+    with app_module.app.test_client() as client:
+        data = upload_sample(client)
+        dataset_id = app_module.dataset_id_for(app_module.get_session_file(data['session_id']))
+        assert os.listdir(app_module.dataset_cache_dir(dataset_id)), "Parsed dataset was not cached"
+        print("✅ Parsed dataset cached on disk")
+        
+        # Drop the in-memory copy and make re-parsing impossible: /process must use the disk cache
+        app_module.dataset_cache.clear()
+        original_read_excel = app_module.pd.read_excel
+        app_module.pd.read_excel = None
+        try:
+            df = app_module.load_dataset(dataset_id)
+        finally:
+            app_module.pd.read_excel = original_read_excel
+        assert len(df) == data['total_rows'], "Cached dataset has the wrong number of rows"
+        assert dataset_id in app_module.dataset_cache, "Dataset was not promoted to the in-memory cache"
+        print("✅ Dataset loaded from cache without re-parsing")
+    
+    return True
+
+def test_streaming_ingest():
+    """Test that streaming ingestion matches pandas on rows, columns and value summaries"""
+    print("\n🌊 Testing streaming ingestion...")
+    
+    import pandas as pd
+    import app as app_module
+    import splitting
+    from create_sample_data import create_sample_data
+    
+    filename = create_sample_data()
+    summary = app_module.ingest_workbook('streaming-test', filename)
+    df = pd.read_excel(filename)
+    
+    assert summary['columns'] == df.columns.tolist(), "Streamed headers differ from pandas"
+    assert summary['total_rows'] == len(df), "Streamed row count differs from pandas"
+    for col in df.columns:
+        expected = df[col].dropna().map(splitting.format_value).nunique()
+        assert summary['distinct_values'][col] == expected, f"Distinct value count differs for {col}"
+    
+    cached = app_module.read_dataset_parts('streaming-test')
+    assert cached.shape == df.shape, "Streamed dataset cache has the wrong shape"
+    app_module.drop_dataset('streaming-test')
+    print("✅ Streaming ingestion matches pandas")
+    
+    return True
+
+def test_rule_planner():
+    """Test that rules share predicates and /process returns the expected row counts"""
+    print("\n🧮 Testing multi-rule planner...")
+    
+    import pandas as pd
+    import app as app_module
+    import splitting
+    
+    rules = [
+        {'rule_type': 'single', 'column1': 'Gender', 'value1': ['Men'], 'custom_name': 'planner_men'},
+        {'rule_type': 'and', 'column1': 'Gender', 'value1': ['Men'], 'column2': 'Season', 'value2': ['Winter'],
+         'custom_name': 'planner_men_winter'},
+        {'rule_type': 'or', 'column1': 'Gender', 'value1': ['Men'], 'column2': 'Season', 'value2': ['Winter'],
+         'additional_columns': ['Region'], 'additional_values': [['Asia']], 'custom_name': 'planner_or'},
+    ]
+    predicates, _ = splitting.plan_rules(rules)
+    assert len(predicates) == 3, f"Expected 3 shared predicates, got {len(predicates)}"
+    print("✅ Rules share predicates")
+    
+    with app_module.app.test_client() as client:
+        session_id = upload_sample(client)['session_id']
+        response = client.post('/process', json={'rules': rules, 'session_id': session_id})
+        assert response.status_code == 200, f"Process failed: {response.get_data(as_text=True)}"
+        rows = {f['filename']: f['rows'] for f in response.get_json()['files']}
+    
+    df = pd.read_excel('sample_data.xlsx')
+    men, winter, asia = df['Gender'] == 'Men', df['Season'] == 'Winter', df['Region'] == 'Asia'
+    assert rows.get('planner_men.xlsx') == men.sum()
+    assert rows.get('planner_men_winter.xlsx') == (men & winter).sum()
+    assert rows.get('planner_or.xlsx') == (men | winter | asia).sum()
+    print("✅ /process row counts match pandas")
+    
+    # Values arrive as strings from the UI and must match numeric and categorical columns
+    splitting.categorize_columns(df)
+    assert str(df['Region'].dtype) == 'category', "Low-cardinality column was not categorized"
+    quantity = str(df['Stock_Quantity'].iloc[0])
+    matched = splitting.apply_rule(df, {'rule_type': 'single', 'column1': 'Stock_Quantity', 'value1': [quantity]})
+    assert len(matched) == (df['Stock_Quantity'] == int(quantity)).sum(), "Numeric values did not match"
+    print("✅ Rules match on categorical codes and numeric columns")
+    
+    return True
+
+def test_streaming_writer():
+    """Test that the streaming writer produces the same workbook content as pandas/openpyxl"""
+    print("\n✍️ Testing streaming XLSX writer...")
+    
+    import pandas as pd
+    import app as app_module
+    import splitting
+    from create_sample_data import create_sample_data
+    
+    df = pd.read_excel(create_sample_data())
+    df['Launch_Date'] = pd.to_datetime(df['Launch_Date'])
+    df.loc[0, 'Price'] = None
+    splitting.categorize_columns(df)
+    
+    output_path = os.path.join(app_module.UPLOAD_FOLDER, 'writer_test.xlsx')
+    stats = splitting.write_output(df, output_path, 'streaming')
+    assert stats['rows'] == len(df) and stats['bytes'] > 0, "Writer stats are missing"
+    
+    written = pd.read_excel(output_path)
+    expected = df.astype({col: object for col in df.select_dtypes('category').columns})
+    assert written.columns.tolist() == df.columns.tolist(), "Header row was not kept"
+    assert written['Launch_Date'].dtype.kind == 'M', "Dates were not written as dates"
+    pd.testing.assert_frame_equal(written, expected, check_dtype=False)
+    os.remove(output_path)
+    print(f"✅ Streaming writer output matches ({stats['rows_per_second']} rows/sec)")
+    
+    return True
+
+def test_async_job():
+    """Test that /process can queue a job and /jobs reports its progress and downloads"""
+    print("\n⏳ Testing asynchronous split jobs...")
+    
+    import app as app_module
+    
+    rules = [
+        {'rule_type': 'single', 'column1': 'Gender', 'value1': ['Women'], 'custom_name': 'async_women'},
+        {'rule_type': 'single', 'column1': 'Gender', 'value1': ['Nobody'], 'custom_name': 'async_nobody'},
+    ]
+    with app_module.app.test_client() as client:
+        session_id = upload_sample(client)['session_id']
+        response = client.post('/process', json={'rules': rules, 'session_id': session_id, 'async': True})
+        assert response.status_code == 202, f"Job was not queued: {response.get_data(as_text=True)}"
+        status_url = response.get_json()['status_url']
+        
+        for _ in range(100):
+            job = client.get(status_url).get_json()
+            if job['status'] in ['finished', 'failed']:
+                break
+            time.sleep(0.1)
+        
+        assert job['status'] == 'finished', f"Job did not finish: {job}"
+        assert [rule['status'] for rule in job['rules']] == ['done', 'skipped']
+        assert job['rows_written'] == job['files'][0]['rows'] > 0
+        assert client.get(job['files'][0]['download_url']).status_code == 200
+        assert client.get('/jobs/does-not-exist').status_code == 404
+        
+        bundle = client.get(job['bundle_url'])
+        assert bundle.status_code == 200 and bundle.mimetype == 'application/zip'
+        with zipfile.ZipFile(io.BytesIO(bundle.data)) as archive:
+            assert archive.namelist() == ['async_women.xlsx'], f"Unexpected bundle contents: {archive.namelist()}"
+            assert archive.infolist()[0].compress_type == zipfile.ZIP_STORED
+            assert archive.testzip() is None
+    print("✅ Job finished with per-rule progress, a working download and a ZIP bundle")
+    
+    return True
+
+def test_split_by_columns():
+    """Test that a split rule writes one file per key combination, named like generate_filename"""
+    print("\n🪓 Testing split-by-column-values rules...")
+    
+    import pandas as pd
+    import app as app_module
+    import splitting
+    
+    with app_module.app.test_client() as client:
+        session_id = upload_sample(client)['session_id']
+        response = client.post('/process', json={
+            'rules': [{'rule_type': 'split', 'columns': ['Region', 'Season']}],
+            'session_id': session_id
+        })
+        assert response.status_code == 200, f"Split failed: {response.get_data(as_text=True)}"
+        rows = {f['filename']: f['rows'] for f in response.get_json()['files']}
+        
+        bad = client.post('/process', json={'rules': [{'rule_type': 'split', 'columns': []}], 'session_id': session_id})
+        assert bad.status_code == 400, "Split rule without columns was accepted"
+    
+    df = pd.read_excel('sample_data.xlsx')
+    expected = {}
+    for (region, season), group in df.groupby(['Region', 'Season']):
+        rule = {'rule_type': 'and', 'column1': 'Region', 'value1': [region], 'column2': 'Season', 'value2': [season]}
+        expected[splitting.generate_filename(rule)] = len(group)
+    assert rows == expected, "Split files or row counts differ from a pandas groupby"
+    print(f"✅ Split produced {len(rows)} files matching a pandas groupby")
+    
+    # Split values that look like paths still name a file in the run folder
+    data = pd.DataFrame({'Region': ['E/W', 'E/W', '../up', 'North'], 'Units': [1, 2, 3, 4]}).to_csv(index=False)
+    split = {'rule_type': 'split', 'columns': ['Region']}
+    with app_module.app.test_client() as client:
+        session_id = client.post('/upload', data={'file': (io.BytesIO(data.encode('utf-8')), 'regions.csv')},
+                                 content_type='multipart/form-data').get_json()['session_id']
+        result = client.post('/process', json={'rules': [split], 'session_id': session_id}).get_json()
+        rows = {f['filename']: f['rows'] for f in result['files']}
+        assert rows == {'Region_E_W.xlsx': 2, 'Region_.._up.xlsx': 1, 'Region_North.xlsx': 1}, f"Unsafe names: {rows}"
+        assert result['failed_files'] == []
+        
+        # A group that can't be written is reported, and so is its rule
+        write_output = app_module.write_output
+        def failing_write(df, output_path, writer=None):
+            if output_path.endswith('Region_North.csv'):
+                raise OSError('disk full')
+            return write_output(df, output_path, writer)
+        east_west = {'rule_type': 'single', 'column1': 'Region', 'value1': ['E/W'], 'custom_name': 'east_west'}
+        app_module.write_output = failing_write
+        try:
+            response = client.post('/process', json={'rules': [split, east_west], 'session_id': session_id,
+                                                     'output_format': 'csv', 'async': True})
+            for _ in range(100):
+                job = client.get(response.get_json()['status_url']).get_json()
+                if job['status'] in ['finished', 'failed']:
+                    break
+                time.sleep(0.1)
+        finally:
+            app_module.write_output = write_output
+        assert job['failed_files'] == [{'filename': 'Region_North.csv', 'rule': 1}], f"Failed group: {job['failed_files']}"
+        assert [rule['status'] for rule in job['rules']] == ['failed', 'done']
+        assert sorted(job['rules'][0]['files']) == ['Region_.._up.csv', 'Region_E_W.csv']
+    print("✅ Split values are made safe for file names and failed groups are reported")
+    
+    return True
+
+def test_workbook_output():
+    """Test that workbook mode writes every rule as a sheet of a single workbook"""
+    print("\n📑 Testing single-workbook output mode...")
+    
+    import pandas as pd
+    import app as app_module
+    import splitting
+    
+    used = set()
+    long_name = splitting.sheet_name_for('Region_North_South_East_West_OR_Season_Winter.xlsx', used)
+    assert len(long_name) == 31, "Sheet name was not trimmed to Excel's limit"
+    assert splitting.sheet_name_for('Region_North_South_East_West_OR_Season_Summer.xlsx', used) == long_name[:29] + '~2', \
+        "Clashing sheet names were not made unique"
+    assert splitting.sheet_name_for('a/b[c]:d.xlsx', used) == 'a_b_c__d', "Invalid sheet name characters were kept"
+    
+    with app_module.app.test_client() as client:
+        session_id = upload_sample(client)['session_id']
+        response = client.post('/process', json={
+            'rules': [
+                {'rule_type': 'single', 'column1': 'Region', 'value1': ['Europe']},
+                {'rule_type': 'split', 'columns': ['Season']}
+            ],
+            'session_id': session_id,
+            'output_mode': 'workbook',
+            'workbook_name': 'all_rules'
+        })
+        assert response.status_code == 200, f"Workbook run failed: {response.get_data(as_text=True)}"
+        files = response.get_json()['files']
+        run_id = response.get_json()['run_id']
+        assert [f['filename'] for f in files] == ['all_rules.xlsx'], "Workbook mode did not write a single file"
+    
+    sheets = pd.read_excel(os.path.join(app_module.run_output_dir(run_id), 'all_rules.xlsx'), sheet_name=None)
+    df = pd.read_excel('sample_data.xlsx')
+    expected = {'Region_Europe': len(df[df['Region'] == 'Europe'])}
+    for season, group in df.groupby('Season'):
+        expected[f'Season_{season}'] = len(group)
+    assert {name: len(sheet) for name, sheet in sheets.items()} == expected, "Sheets differ from the rule results"
+    assert {s['sheet']: s['rows'] for s in files[0]['sheets']} == expected, "Reported sheet rows are wrong"
+    print(f"✅ Workbook holds {len(sheets)} sheets matching the rules")
+    
+    return True
+
+def test_value_index():
+    """Test that /values pages through every distinct value with counts and supports search"""
+    print("\n🔎 Testing column value index...")
+    
+    import pandas as pd
+    import app as app_module
+    
+    df = pd.read_excel('sample_data.xlsx')
+    with app_module.app.test_client() as client:
+        session_id = upload_sample(client)['session_id']
+        
+        def values(**params):
+            response = client.get('/values', query_string={'session_id': session_id, **params})
+            assert response.status_code == 200, f"/values failed: {response.get_data(as_text=True)}"
+            return response.get_json()
+        
+        # Page through a high-cardinality column and compare with pandas
+        seen = {}
+        offset = 0
+        while True:
+            page = values(column='Product_ID', offset=offset, limit=30)
+            seen.update((item['value'], item['count']) for item in page['values'])
+            offset += 30
+            if offset >= page['total']:
+                break
+        assert seen == df['Product_ID'].value_counts().to_dict(), "Paged values or counts differ from pandas"
+        
+        prefix = values(column='Region', q='south')
+        assert [item['value'] for item in prefix['values']] == ['South America'], "Prefix search failed"
+        contains = values(column='Region', q='america', match='contains')
+        assert {item['value'] for item in contains['values']} == {'North America', 'South America'}, "Substring search failed"
+        
+        missing = client.get('/values', query_string={'session_id': session_id, 'column': 'Nope'})
+        assert missing.status_code == 400, "Unknown column was accepted"
+    print(f"✅ Value index served {len(seen)} Product_ID values across pages")
+    
+    return True
+
+def test_preview():
+    """Test that /preview counts match the rows /process would write"""
+    print("\n👀 Testing match-count preview...")
+    
+    import pandas as pd
+    import app as app_module
+    
+    rules = [
+        {'rule_type': 'single', 'column1': 'Region', 'value1': ['Europe', 'Asia']},
+        {'rule_type': 'and', 'column1': 'Gender', 'value1': ['Men'], 'column2': 'Season', 'value2': ['Winter', 'Fall']},
+        {'rule_type': 'or', 'column1': 'Product_ID', 'value1': ['PROD001'], 'column2': 'Color', 'value2': ['Black']},
+        {'rule_type': 'single', 'column1': 'Region', 'value1': ['Atlantis']},
+        {'rule_type': 'split', 'columns': ['Region', 'Season']},
+        {'rule_type': 'single', 'column1': 'Region', 'value1': []}
+    ]
+    with app_module.app.test_client() as client:
+        session_id = upload_sample(client)['session_id']
+        response = client.post('/preview', json={'session_id': session_id, 'rules': rules})
+        assert response.status_code == 200, f"Preview failed: {response.get_data(as_text=True)}"
+        results = response.get_json()['rules']
+    
+    df = pd.read_excel('sample_data.xlsx')
+    expected = [
+        df['Region'].isin(['Europe', 'Asia']).sum(),
+        ((df['Gender'] == 'Men') & df['Season'].isin(['Winter', 'Fall'])).sum(),
+        ((df['Product_ID'] == 'PROD001') | (df['Color'] == 'Black')).sum(),
+        0
+    ]
+    assert [result['rows'] for result in results[:4]] == expected, "Preview counts differ from pandas"
+    assert results[4]['files'] == df.groupby(['Region', 'Season']).ngroups, "Split preview has the wrong file count"
+    assert 'error' in results[5], "Incomplete rule was not reported"
+    print(f"✅ Preview counts match pandas: {expected}")
+    
+    return True
+
+def test_chunked_upload():
+    """Test resumable chunked uploads and reuse of an identical, already parsed upload"""
+    print("\n📦 Testing chunked uploads...")
+    
+    import app as app_module
+    from create_sample_data import create_sample_data
+    
+    with open(create_sample_data(), 'rb') as f:
+        content = f.read()
+    
+    with app_module.app.test_client() as client:
+        start = client.post('/uploads', json={'filename': 'master.xlsx', 'size': len(content)})
+        assert start.status_code == 201, f"Starting the upload failed: {start.get_data(as_text=True)}"
+        upload_url = start.get_json()['upload_url']
+        
+        half = len(content) // 2
+        assert client.put(f'{upload_url}?offset=0', data=content[:half]).status_code == 200, "First chunk failed"
+        # A repeated or skipped chunk is refused with the offset to resume from
+        retry = client.put(f'{upload_url}?offset=0', data=content[:half])
+        assert retry.status_code == 409 and retry.get_json()['received'] == half, "Out-of-order chunk was accepted"
+        app_module.upload_hashers.clear()  # Resuming must work even after the running hash is lost
+        assert client.get(upload_url).get_json()['received'] == half, "Upload status is wrong"
+        assert client.put(f'{upload_url}?offset={half}', data=content[half:]).status_code == 200, "Second chunk failed"
+        
+        first = client.post(f'{upload_url}/complete')
+        assert first.status_code == 200, f"Completing the upload failed: {first.get_data(as_text=True)}"
+        assert client.get(upload_url).status_code == 404, "Finished upload was not cleaned up"
+        
+        # The same bytes through /upload reuse the stored copy and parsed cache
+        second = client.post('/upload', data={'file': (io.BytesIO(content), 'copy.xlsx')}, content_type='multipart/form-data')
+        first, second = first.get_json(), second.get_json()
+        assert second['reused'], "Identical upload was parsed again"
+        assert second['session_id'] != first['session_id'], "Sessions of identical uploads were merged"
+        assert app_module.get_session_file(second['session_id']) == app_module.get_session_file(first['session_id']), \
+            "Identical uploads were stored twice"
+        assert second['columns'] == first['columns'] and second['total_rows'] == first['total_rows'], \
+            "Reused upload summary differs"
+    print("✅ Chunked upload resumed and identical upload reused")
+    
+    return True
+
+def test_shared_registry():
+    """Test that sessions, jobs and run files are visible to another worker process"""
+    print("\n🗄️ Testing the shared registry...")
+    
+    import json
+    import app as app_module
+    
+    rules = [{'rule_type': 'single', 'column1': 'Gender', 'value1': ['Men'], 'custom_name': 'registry_men'}]
+    with app_module.app.test_client() as client:
+        session_id = upload_sample(client)['session_id']
+        job_id = client.post('/process', json={'rules': rules, 'session_id': session_id, 'async': True}).get_json()['job_id']
+        for _ in range(100):
+            if app_module.get_job(job_id)['status'] in ['finished', 'failed']:
+                break
+            time.sleep(0.1)
+    
+    # A separate interpreter stands in for another gunicorn worker
+    script = (
+        "import json, sys, app\n"
+        "print(json.dumps({'file': app.get_session_file(sys.argv[1]), 'job': app.get_job(sys.argv[2]),"
+        " 'run': app.get_run_files(sys.argv[2])}))"
+    )
+    result = subprocess.run([sys.executable, '-c', script, session_id, job_id], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(app_module.__file__)), timeout=120)
+    assert result.returncode == 0, f"Second process failed: {result.stderr}"
+    seen = json.loads(result.stdout.strip().splitlines()[-1])
+    assert seen['file'] == app_module.get_session_file(session_id), "Session is not shared"
+    assert seen['job']['status'] == 'finished' and seen['job']['rows_written'] > 0, f"Job is not shared: {seen['job']}"
+    assert [filename for filename, _ in seen['run']] == ['registry_men.xlsx'], f"Run files are not shared: {seen['run']}"
+    print("✅ Another process sees the session, the finished job and its run files")
+    
+    return True
+
+def test_output_memo():
+    """Test that runs write to their own folders and identical splits reuse the memoized file"""
+    print("\n🧠 Testing per-run outputs and memoization...")
+    
+    import uuid
+    import pandas as pd
+    import app as app_module
+    
+    # A fresh file no earlier run has seen, holding the same columns as the sample
+    df = pd.read_excel('sample_data.xlsx')
+    df['Product_Name'] = df['Product_Name'] + ' ' + uuid.uuid4().hex
+    fresh = io.BytesIO()
+    df.to_excel(fresh, index=False)
+    
+    def run(client, session_id, values):
+        rule = {'rule_type': 'single', 'column1': 'Season', 'value1': values, 'custom_name': 'memo_season'}
+        response = client.post('/process', json={'rules': [rule], 'session_id': session_id})
+        assert response.status_code == 200, f"Run failed: {response.get_data(as_text=True)}"
+        return response.get_json()
+    
+    with app_module.app.test_client() as client:
+        sample_session = upload_sample(client)['session_id']
+        fresh_session = client.post('/upload', data={'file': (io.BytesIO(fresh.getvalue()), 'fresh.xlsx')},
+                                    content_type='multipart/form-data').get_json()['session_id']
+        
+        first = run(client, fresh_session, ['Summer', 'Winter'])
+        assert not first['files'][0]['memoized'], "A split of a new file was reported as memoized"
+        # Same file and the same rule with its values reordered: the written file is reused
+        second = run(client, fresh_session, ['Winter', 'Summer'])
+        assert second['files'][0]['memoized'] and second['write_stats']['memoized_files'] == 1, "Identical split was written again"
+        assert second['files'][0]['rows'] == first['files'][0]['rows']
+        # Another file under the same output name lands in its own run folder
+        other = run(client, sample_session, ['Summer', 'Winter'])
+        
+        paths = [os.path.join(app_module.run_output_dir(result['run_id']), 'memo_season.xlsx') for result in (first, second, other)]
+        assert len(set(paths)) == 3 and all(os.path.exists(path) for path in paths), "Runs share an output path"
+        assert pd.read_excel(paths[0]).equals(pd.read_excel(paths[1])), "Memoized file differs from the original"
+        assert not pd.read_excel(paths[2])['Product_Name'].equals(pd.read_excel(paths[0])['Product_Name']), \
+            "Runs on different files overwrote each other"
+        for result in (first, second, other):
+            assert client.get(result['files'][0]['download_url']).status_code == 200, "Run download failed"
+        assert client.get('/download/not-a-run/memo_season.xlsx').status_code == 404
+    print("✅ Runs kept separate files and the repeated split reused the memoized one")
+    
+    return True
+
+def test_disk_janitor():
+    """Test that the janitor evicts least recently used items over quota and spares pinned ones"""
+    print("\n🧹 Testing the disk janitor...")
+    
+    import uuid
+    import app as app_module
+    
+    folders = []
+    for last_used in (1, 2, 3):
+        folder = app_module.run_output_dir(str(uuid.uuid4()))
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'out.xlsx'), 'wb') as f:
+            f.write(b'x' * 1000)
+        app_module.track_disk_item('run', folder)
+        app_module.registry().execute('UPDATE disk_items SET last_used = ? WHERE path = ?', (last_used, folder))
+        folders.append(folder)
+    total = app_module.registry().execute('SELECT SUM(bytes) FROM disk_items').fetchone()[0]
+    
+    quota, ttl = app_module.DISK_QUOTA_BYTES, app_module.DISK_TTL_SECONDS
+    app_module.DISK_QUOTA_BYTES, app_module.DISK_TTL_SECONDS = total - 500, 10 ** 12
+    try:
+        # The oldest run is in use, so the next least recently used one goes instead
+        with app_module.pin_disk_items([folders[0]]):
+            app_module.registry().execute('UPDATE disk_items SET last_used = 1 WHERE path = ?', (folders[0],))
+            evicted = app_module.evict_disk_items()
+        assert evicted == [folders[1]], f"Unexpected eviction: {evicted}"
+        assert os.path.exists(folders[0]) and not os.path.exists(folders[1]) and os.path.exists(folders[2])
+        
+        # Past the TTL an item goes even under quota, and a dead worker's pin doesn't hold it
+        app_module.DISK_QUOTA_BYTES, app_module.DISK_TTL_SECONDS = total, 0
+        app_module.registry().execute('INSERT INTO disk_pins (path, pid) VALUES (?, ?)', (folders[2], 2 ** 22 + 1))
+        evicted = app_module.evict_disk_items()
+        assert folders[0] in evicted and folders[2] in evicted, f"Idle items were kept: {evicted}"
+    finally:
+        app_module.DISK_QUOTA_BYTES, app_module.DISK_TTL_SECONDS = quota, ttl
+    print("✅ Janitor evicted by LRU and TTL from the index and skipped the pinned run")
+    
+    # The background row index build pins the parsed cache it reads
+    build_row_index = app_module.build_row_index
+    pinned = []
+    app_module.build_row_index = lambda dataset_id: pinned.extend(
+        row[0] for row in app_module.registry().execute('SELECT path FROM disk_pins'))
+    try:
+        app_module.prebuild_row_index('janitor-test')
+    finally:
+        app_module.build_row_index = build_row_index
+    assert app_module.dataset_cache_dir('janitor-test') in pinned, f"Row index build pinned {pinned}"
+    print("✅ Row index builds pin the parsed cache")
+    
+    # /cleanup leaves an upload a job has pinned to the janitor, which evicts it once unpinned
+    data = f"Key,Value\n{uuid.uuid4().hex},1\n".encode('utf-8')
+    with app_module.app.test_client() as client:
+        session_id = client.post('/upload', data={'file': (io.BytesIO(data), 'pinned.csv')},
+                                 content_type='multipart/form-data').get_json()['session_id']
+        file_path = app_module.registry().execute('SELECT file_path FROM sessions WHERE session_id = ?',
+                                                  (session_id,)).fetchone()[0]
+        cache_dir = app_module.dataset_cache_dir(app_module.dataset_id_for(file_path))
+        with app_module.pin_disk_items([cache_dir]):
+            assert client.post('/cleanup').status_code == 200
+            assert os.path.exists(file_path) and os.path.exists(cache_dir), "/cleanup deleted pinned files"
+    for _ in range(50):
+        app_module.evict_disk_items()
+        if not os.path.exists(file_path):
+            break
+        time.sleep(0.1)  # The background row index build may still hold its own pins
+    assert not os.path.exists(file_path) and not os.path.exists(cache_dir), "Unpinned files were not evicted"
+    print("✅ /cleanup kept pinned files and the janitor removed them afterwards")
+    
+    return True
+
+def test_csv_parquet():
+    """Test CSV and Parquet uploads (CSV read in chunks) and CSV/Parquet output formats"""
+    print("\n📄 Testing CSV and Parquet input and output...")
+    
+    import pandas as pd
+    import app as app_module
+    
+    df = pd.read_excel('sample_data.xlsx')
+    chunk_rows = app_module.INGEST_CHUNK_ROWS
+    app_module.INGEST_CHUNK_ROWS = 30  # Several chunks from the 100-row sample
+    try:
+        with app_module.app.test_client() as client:
+            expected = upload_sample(client)
+            for input_format, output_format in (('csv', 'parquet'), ('parquet', 'csv')):
+                content = io.BytesIO()
+                getattr(df, f'to_{input_format}')(content, index=False)
+                upload = client.post('/upload', data={'file': (io.BytesIO(content.getvalue()), f'master.{input_format}')},
+                                     content_type='multipart/form-data')
+                assert upload.status_code == 200, f"{input_format} upload failed: {upload.get_data(as_text=True)}"
+                upload = upload.get_json()
+                assert upload['total_rows'] == expected['total_rows'] and upload['columns'] == expected['columns']
+                assert upload['distinct_values'] == expected['distinct_values'], f"{input_format} summary differs"
+                
+                response = client.post('/process', json={
+                    'rules': [{'rule_type': 'single', 'column1': 'Region', 'value1': ['Europe']}],
+                    'session_id': upload['session_id'],
+                    'output_format': output_format
+                })
+                assert response.status_code == 200, f"{output_format} run failed: {response.get_data(as_text=True)}"
+                result = response.get_json()
+                assert [f['filename'] for f in result['files']] == [f'Region_Europe.{output_format}']
+                output_path = os.path.join(app_module.run_output_dir(result['run_id']), f'Region_Europe.{output_format}')
+                written = getattr(pd, f'read_{output_format}')(output_path)
+                assert len(written) == len(df[df['Region'] == 'Europe']), f"{output_format} output has the wrong rows"
+                assert client.get(result['files'][0]['download_url']).status_code == 200
+            
+            response = client.post('/process', json={'rules': [{'rule_type': 'split', 'columns': ['Season']}],
+                                                     'session_id': upload['session_id'],
+                                                     'output_format': 'csv', 'output_mode': 'workbook'})
+            assert response.status_code == 400, "Workbook mode accepted a non-Excel format"
+        
+        # Identical bytes are reused from earlier runs, so check the chunked CSV reader directly
+        csv_path = os.path.join(app_module.PARTIAL_FOLDER, 'chunked_test.csv')
+        df.to_csv(csv_path, index=False)
+        summary = app_module.ingest_csv('csv-chunk-test', csv_path)
+        parts = app_module.dataset_part_names(app_module.dataset_cache_dir('csv-chunk-test'))
+        assert summary['total_rows'] == len(df) and len(parts) == 4, f"CSV was not read in chunks: {parts}"
+        assert len(app_module.read_dataset_parts('csv-chunk-test')) == len(df)
+        app_module.drop_dataset('csv-chunk-test')
+        app_module.untrack_disk_items(app_module.dataset_cache_dir('csv-chunk-test'))
+        os.remove(csv_path)
+    finally:
+        app_module.INGEST_CHUNK_ROWS = chunk_rows
+    print("✅ CSV and Parquet uploads match the Excel summary and both formats were written")
+    
+    return True
+
+def test_metrics():
+    """Test per-stage timings on the Prometheus metrics endpoint"""
+    print("\n📈 Testing stage metrics...")
+    
+    import re
+    import app as app_module
+    
+    def sample_value(text, name, stage):
+        match = re.search(rf'^{name}{{stage="{stage}"}} (\S+)$', text, re.M)
+        return float(match.group(1)) if match else 0.0
+    
+    with app_module.app.test_client() as client:
+        upload = upload_sample(client)
+        before = client.get('/metrics').get_data(as_text=True)
+        response = client.post('/process', json={
+            'rules': [{'rule_type': 'single', 'column1': 'Region', 'value1': ['Europe']},
+                      {'rule_type': 'single', 'column1': 'Season', 'value1': ['Winter']}],
+            'session_id': upload['session_id'],
+            'output_format': 'csv'
+        })
+        assert response.status_code == 200, f"Run failed: {response.get_data(as_text=True)}"
+        written = response.get_json()['write_stats']
+        
+        response = client.get('/metrics')
+        assert response.status_code == 200 and response.content_type.startswith('text/plain')
+        after = response.get_data(as_text=True)
+    
+    assert '# TYPE excel_splitter_stage_seconds histogram' in after
+    for stage in ('upload_save', 'parse', 'column_summary', 'filter'):
+        assert sample_value(after, 'excel_splitter_stage_seconds_count', stage) > 0, f"No {stage} timings"
+    writes = (sample_value(after, 'excel_splitter_stage_seconds_count', 'write')
+              - sample_value(before, 'excel_splitter_stage_seconds_count', 'write'))
+    size = (sample_value(after, 'excel_splitter_stage_bytes_total', 'write')
+            - sample_value(before, 'excel_splitter_stage_bytes_total', 'write'))
+    assert written['files'] + written['memoized_files'] == 2
+    assert writes == written['files'], f"Expected one write timing per written file, got {writes}"
+    assert size == written['bytes'], f"Bytes written {size} do not match the run's {written['bytes']}"
+    assert sample_value(after, 'excel_splitter_stage_rows_per_second', 'write') > 0
+    assert 'excel_splitter_stage_seconds_bucket{le="+Inf",stage="write"}' in after, "Histogram has no +Inf bucket"
+    
+    with open('app.py') as f:
+        assert 'print(' not in f.read(), "app.py still prints instead of logging"
+    print("✅ Stage timings, rows/sec and bytes written are exposed on /metrics")
+    
+    # Only errors reach the error log, however low LOG_LEVEL is
+    import uuid
+    level = app_module.logger.level
+    probe = uuid.uuid4().hex
+    try:
+        app_module.logger.setLevel('DEBUG')
+        app_module.logger.info('info %s', probe)
+        app_module.logger.debug('debug %s', probe)
+        app_module.logger.error('error %s', probe)
+        app_module.error_log_handler.flush()
+    finally:
+        app_module.logger.setLevel(level)
+    with open(app_module.ERROR_LOG_PATH) as f:
+        logged = [line for line in f if probe in line]
+    assert len(logged) == 1 and f'error {probe}' in logged[0], f"Error log got {logged}"
+    print("✅ The error log only receives errors")
+    
+    return True
+
+def test_benchmark():
+    """Test the scalable sample data generator and the benchmark harness"""
+    print("\n⏱️ Testing sample data generator and benchmark...")
+    
+    import app as app_module
+    from create_sample_data import build_sample_frame
+    from benchmark import PHASES, compare_results, run_scenario
+    
+    df = build_sample_frame(2000, 20, {'Region': 40, '*': 3})
+    assert df.shape == (2000, 20), f"Unexpected shape {df.shape}"
+    assert df['Region'].nunique() == 40 and df['Season'].nunique() == 3 and df['Attribute_7'].nunique() == 3
+    assert list(build_sample_frame(50, 5).columns) == ['Product_ID', 'Product_Name', 'Category', 'Season', 'Gender']
+    
+    with tempfile.TemporaryDirectory() as workdir, app_module.app.test_client() as client:
+        record = run_scenario(client, workdir, 1000, 15, 4, input_format='csv', output_format='csv', repeat=2, seed=7)
+    assert record['rows'] == 1000 and record['files'] == 6, f"Unexpected run: {record}"
+    for phase in PHASES:
+        assert record['phases'][phase]['seconds'] > 0, f"{phase} was not timed"
+    assert record['bytes_downloaded'] > 0 and record['phases']['process']['rows_per_second'] > 0
+    json.dumps(record)  # Results are stored as JSON lines
+    
+    slower = json.loads(json.dumps(record))
+    slower['phases']['process']['seconds'] = record['phases']['process']['seconds'] * 2
+    assert compare_results([record], [record]) == []
+    regressions = compare_results([slower], [record], tolerance=0.25)
+    assert len(regressions) == 1 and 'process seconds' in regressions[0], regressions
+    print(f"✅ Benchmarked {record['scenario']} in {record['phases']['process']['seconds']}s of processing")
+    
+    return True
+
+def test_batch_split():
+    """Test the headless batch CLI splitting several files across worker processes"""
+    print("\n🗂️ Testing batch split CLI...")
+    
+    import pandas as pd
+    from create_sample_data import create_sample_data
+    from batch_split import find_inputs, load_request, run_batch
+    
+    with tempfile.TemporaryDirectory() as workdir:
+        inputs = os.path.join(workdir, 'masters')
+        os.makedirs(inputs)
+        for rows, extension in ((200, 'xlsx'), (300, 'xlsx'), (400, 'csv')):
+            create_sample_data(rows, filename=os.path.join(inputs, f'master_{rows}.{extension}'), seed=rows, verbose=False)
+        open(os.path.join(inputs, '~$master_200.xlsx'), 'wb').close()  # Excel lock file
+        rules_path = os.path.join(workdir, 'rules.json')
+        with open(rules_path, 'w') as f:
+            json.dump({'rules': [{'rule_type': 'single', 'column1': 'Region', 'value1': ['Europe']},
+                                 {'rule_type': 'split', 'columns': ['Gender']}], 'output_format': 'csv',
+                       'output_columns': ['Product_ID', 'Region']}, f)
+        
+        found = find_inputs([inputs])
+        assert [os.path.basename(path) for path in found] == ['master_200.xlsx', 'master_300.xlsx', 'master_400.csv']
+        assert find_inputs([os.path.join(inputs, '*.csv')]) == found[2:]
+        rules, output = load_request(rules_path)
+        summaries = {s['input']: s for s in run_batch(found, rules, output, os.path.join(workdir, 'out'), workers=2)}
+        
+        for path in found:
+            summary = summaries[path]
+            source = pd.read_csv(path) if path.endswith('.csv') else pd.read_excel(path)
+            assert not summary['errors'] and summary['rows'] == len(source), f"Bad summary: {summary}"
+            assert len(summary['files']) == 1 + source['Gender'].nunique()
+            europe = pd.read_csv(os.path.join(summary['output'], 'Region_Europe.csv'))
+            assert len(europe) == (source['Region'] == 'Europe').sum(), f"{path}: wrong Europe rows"
+            assert europe.columns.tolist() == ['Product_ID', 'Region'], f"{path}: output_columns were not applied"
+        
+        # The CLI must not create the web app's uploads folder, registry or error log where it runs
+        subprocess.run([sys.executable, '-c', 'import batch_split'], cwd=workdir, check=True,
+                       env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__))))
+        assert sorted(os.listdir(workdir)) == ['masters', 'out', 'rules.json'], "Importing batch_split had side effects"
+    print(f"✅ Split {len(found)} files in parallel with the /process rule schema")
+    
+    return True
+
+def test_rule_sets():
+    """Test saving a rule set once and applying its compiled plan to an upload"""
+    print("\n📚 Testing saved rule sets...")
+    
+    import app as app_module
+    
+    rules = [
+        {'rule_type': 'single', 'column1': 'Region', 'value1': ['Europe']},
+        {'rule_type': 'or', 'column1': 'Season', 'value1': ['Winter'], 'column2': 'Color', 'value2': ['Black']},
+        {'rule_type': 'split', 'columns': ['Gender']}
+    ]
+    with app_module.app.test_client() as client:
+        upload = upload_sample(client)
+        client.delete('/rule-sets/Month end')
+        response = client.put('/rule-sets/Month end', json={'rules': rules, 'session_id': upload['session_id'],
+                                                             'output_format': 'csv'})
+        assert response.status_code == 201, f"Save failed: {response.get_data(as_text=True)}"
+        saved = response.get_json()['rule_set']
+        assert saved['required_columns'] == ['Region', 'Season', 'Color', 'Gender']
+        assert len(saved['plan']['predicates']) == 3 and saved['plan']['layout'][0]['filename'] == 'Region_Europe.csv'
+        
+        response = client.put('/rule-sets/Broken', json={'rules': [{'rule_type': 'single', 'column1': 'Nope', 'value1': ['x']}],
+                                                         'columns': upload['columns']})
+        assert response.status_code == 400 and 'Nope' in response.get_json()['error']
+        assert 'Month end' in [entry['name'] for entry in client.get('/rule-sets').get_json()['rule_sets']]
+        
+        # The precompiled plan splits exactly like the same rules sent to /process
+        applied = client.post('/rule-sets/Month end/apply', json={'session_id': upload['session_id']})
+        assert applied.status_code == 200, f"Apply failed: {applied.get_data(as_text=True)}"
+        direct = client.post('/process', json={'rules': rules, 'session_id': upload['session_id'], 'output_format': 'csv'})
+        summary = lambda response: sorted((f['filename'], f['rows']) for f in response.get_json()['files'])
+        assert summary(applied) == summary(direct), "Saved rule set and /process disagree"
+        
+        other = client.post('/upload', data={'file': (io.BytesIO(b'Region,Season\nEurope,Winter\n'), 'other.csv')},
+                            content_type='multipart/form-data').get_json()
+        response = client.post('/rule-sets/Month end/apply', json={'session_id': other['session_id']})
+        assert response.status_code == 400 and response.get_json()['missing_columns'] == ['Color', 'Gender']
+        
+        assert client.delete('/rule-sets/Month end').status_code == 200
+        assert client.post('/rule-sets/Month end/apply', json={'session_id': upload['session_id']}).status_code == 404
+    print("✅ Rule set saved once, applied by name and checked for missing columns")
+    
+    return True
+
+def test_memory_admission():
+    """Test compact loading, output column projection and memory admission control"""
+    print("\n🧮 Testing memory-aware loading and admission control...")
+    
+    import pandas as pd
+    import app as app_module
+    
+    rule = {'rule_type': 'single', 'column1': 'Region', 'value1': ['Europe']}
+    budget, wait = app_module.MEMORY_BUDGET_BYTES, app_module.ADMISSION_WAIT_SECONDS
+    with app_module.app.test_client() as client:
+        upload = upload_sample(client)
+        dataset_id = app_module.dataset_id_for(app_module.get_session_file(upload['session_id']))
+        with app_module.dataset_cache_lock:
+            app_module.dataset_cache.pop(dataset_id, None)
+        projected = app_module.load_dataset(dataset_id, ['Region', 'Stock_Quantity'])
+        assert projected.columns.tolist() == ['Region', 'Stock_Quantity'], "Projected load read every column"
+        df = app_module.load_dataset(dataset_id)
+        assert isinstance(df['Region'].dtype, pd.CategoricalDtype) and df['Stock_Quantity'].dtype == 'int8'
+        
+        response = client.post('/process', json={'rules': [rule], 'session_id': upload['session_id'],
+                                                 'output_format': 'csv', 'output_columns': ['Product_ID', 'Price']})
+        assert response.status_code == 200, f"Projected run failed: {response.get_data(as_text=True)}"
+        written = pd.read_csv(os.path.join(app_module.run_output_dir(response.get_json()['run_id']), 'Region_Europe.csv'))
+        assert written.columns.tolist() == ['Product_ID', 'Price'] and len(written) == (df['Region'] == 'Europe').sum()
+        
+        # The compact dtypes stay in memory: outputs keep the input's schema
+        import pyarrow.parquet as pq
+        response = client.post('/process', json={'rules': [rule], 'session_id': upload['session_id'],
+                                                 'output_format': 'parquet'})
+        schema = pq.read_schema(os.path.join(app_module.run_output_dir(response.get_json()['run_id']), 'Region_Europe.parquet'))
+        assert str(schema.field('Stock_Quantity').type) == 'int64' and str(schema.field('Region').type) == 'string', \
+            f"Compacted dtypes leaked into the output: {schema}"
+        
+        try:
+            app_module.MEMORY_BUDGET_BYTES = 1000
+            response = client.post('/process', json={'rules': [rule], 'session_id': upload['session_id']})
+            assert response.status_code == 413 and 'budget' in response.get_json()['error'], "Oversized split admitted"
+            
+            # With the budget held by another split, a synchronous split is turned away...
+            app_module.MEMORY_BUDGET_BYTES = 10 ** 9
+            app_module.ADMISSION_WAIT_SECONDS = 0.2
+            held = app_module.reserve_memory(10 ** 9 - 1)
+            response = client.post('/process', json={'rules': [rule], 'session_id': upload['session_id']})
+            assert response.status_code == 503 and response.headers.get('Retry-After'), "Busy server admitted a split"
+            
+            # ...while an async one waits in the queue until the memory is released
+            response = client.post('/process', json={'rules': [rule], 'session_id': upload['session_id'], 'async': True})
+            status_url = response.get_json()['status_url']
+            time.sleep(0.5)
+            job = client.get(status_url).get_json()
+            assert job['status'] == 'queued' and job['waiting_for_memory'], f"Job did not wait: {job}"
+            app_module.release_memory(held)
+            for _ in range(50):
+                job = client.get(status_url).get_json()
+                if job['status'] in ('finished', 'failed'):
+                    break
+                time.sleep(0.1)
+            assert job['status'] == 'finished' and app_module.memory_in_use() == 0, f"Job did not run: {job}"
+        finally:
+            app_module.MEMORY_BUDGET_BYTES, app_module.ADMISSION_WAIT_SECONDS = budget, wait
+    print("✅ Compact loading, projections and memory admission work")
+    
+    return True
+
+def test_lazy_output():
+    """Test that the lazy output mode writes each file on its first download only"""
+    print("\n💤 Testing lazy output mode...")
+    
+    import uuid
+    import pandas as pd
+    import app as app_module
+    
+    # A fresh file, so no output can come from the memo
+    df = pd.read_excel('sample_data.xlsx')
+    df['Product_Name'] = df['Product_Name'] + ' ' + uuid.uuid4().hex
+    fresh = io.BytesIO()
+    df.to_excel(fresh, index=False)
+    
+    with app_module.app.test_client() as client:
+        session_id = client.post('/upload', data={'file': (io.BytesIO(fresh.getvalue()), 'lazy.xlsx')},
+                                 content_type='multipart/form-data').get_json()['session_id']
+        rules = [{'rule_type': 'split', 'columns': ['Season']}]
+        response = client.post('/process', json={'rules': rules, 'session_id': session_id,
+                                                 'output_mode': 'lazy', 'output_format': 'csv'})
+        assert response.status_code == 200, f"Lazy run failed: {response.get_data(as_text=True)}"
+        result = response.get_json()
+        folder = app_module.run_output_dir(result['run_id'])
+        assert result['deferred_files'] == len(result['files']) == df['Season'].nunique()
+        assert all(entry['deferred'] for entry in result['files']), "Lazy run reported written files"
+        assert not any(os.path.exists(os.path.join(folder, entry['filename'])) for entry in result['files']), \
+            "Lazy run wrote files before they were downloaded"
+        assert sum(entry['rows'] for entry in result['files']) == len(df)
+        
+        first = result['files'][0]
+        response = client.get(first['download_url'])
+        assert response.status_code == 200, f"Lazy download failed: {response.get_data(as_text=True)}"
+        downloaded = pd.read_csv(io.BytesIO(response.get_data()))
+        response.close()
+        assert len(downloaded) == first['rows'] and downloaded['Product_Name'].tolist() == \
+            df.loc[df['Season'] == downloaded['Season'].iloc[0], 'Product_Name'].tolist(), "Lazy file holds the wrong rows"
+        assert app_module.deferred_output(result['run_id'], first['filename']) is None, "Written file is still deferred"
+        written_at = os.path.getmtime(os.path.join(folder, first['filename']))
+        response = client.get(first['download_url'])
+        assert response.status_code == 200 and len(pd.read_csv(io.BytesIO(response.get_data()))) == first['rows']
+        response.close()
+        assert os.path.getmtime(os.path.join(folder, first['filename'])) == written_at, "Second download wrote the file again"
+        
+        # The bundle writes whatever is still deferred
+        response = client.get(result['bundle_url'])
+        with zipfile.ZipFile(io.BytesIO(response.get_data())) as archive:
+            assert sorted(archive.namelist()) == sorted(entry['filename'] for entry in result['files']), \
+                "Bundle is missing deferred files"
+        response.close()
+        assert client.get(f"/download/{result['run_id']}/missing.csv").status_code == 404
+    print("✅ Lazy outputs were written on first download and reused after")
+    
+    return True
+
+def test_condition_rules():
+    """Test range, comparison, NOT, prefix and date-window conditions in nested groups"""
+    print("\n📐 Testing condition rules...")
+    
+    import pandas as pd
+    import app as app_module
+    import splitting
+    
+    df = pd.read_excel('sample_data.xlsx')
+    dates = pd.to_datetime(df['Launch_Date'])
+    quarter = dates.iloc[0].to_period('Q')
+    rules = [
+        {'rule_type': 'filter', 'custom_name': 'cond_nested', 'condition': {'or': [
+            {'and': [{'column': 'Price', 'op': 'between', 'value': [100, 300]},
+                     {'not': {'column': 'Region', 'op': 'in', 'value': ['Asia']}}]},
+            {'column': 'Product_ID', 'op': 'prefix', 'value': 'PROD00'}]}},
+        {'rule_type': 'filter', 'custom_name': 'cond_quarter',
+         'condition': {'column': 'Launch_Date', 'op': 'period', 'value': str(quarter)}},
+        {'rule_type': 'filter', 'custom_name': 'cond_stock',
+         'condition': {'and': [{'column': 'Stock_Quantity', 'op': '>=', 'value': 50},
+                               {'column': 'Launch_Date', 'op': '<', 'value': str(dates.median().date())}]}},
+        {'rule_type': 'filter', 'custom_name': 'cond_not_equal',
+         'condition': {'column': 'Stock_Quantity', 'op': '!=', 'value': int(df['Stock_Quantity'].iloc[0])}},
+    ]
+    expected = [
+        ((df['Price'].between(100, 300) & (df['Region'] != 'Asia')) | df['Product_ID'].str.startswith('PROD00')).sum(),
+        ((dates >= quarter.start_time) & (dates < (quarter + 1).start_time)).sum(),
+        ((df['Stock_Quantity'] >= 50) & (dates < pd.Timestamp(dates.median().date()))).sum(),
+        (df['Stock_Quantity'] != df['Stock_Quantity'].iloc[0]).sum(),
+    ]
+    
+    with app_module.app.test_client() as client:
+        session_id = upload_sample(client)['session_id']
+        response = client.post('/process', json={'rules': rules, 'session_id': session_id})
+        assert response.status_code == 200, f"Process failed: {response.get_data(as_text=True)}"
+        rows = {f['filename']: f['rows'] for f in response.get_json()['files']}
+        assert [rows.get(f"{rule['custom_name']}.xlsx", 0) for rule in rules] == expected, \
+            f"Condition row counts {rows} differ from pandas {expected}"
+        
+        response = client.post('/preview', json={'session_id': session_id, 'rules': rules})
+        assert [result['rows'] for result in response.get_json()['rules']] == expected, "Preview counts differ from pandas"
+        
+        bad = {'rule_type': 'filter', 'condition': {'column': 'Price', 'op': 'between', 'value': [1, 'soon']}}
+        response = client.post('/preview', json={'session_id': session_id, 'rules': [bad]})
+        assert 'between' in response.get_json()['rules'][0]['error'], "Invalid condition was not reported"
+        
+        # Numbers in an 'in' list, or a single number, are still a value list in the file name
+        first, second = (int(quantity) for quantity in df['Stock_Quantity'].iloc[:2])
+        numeric_in = [
+            {'rule_type': 'filter', 'condition': {'column': 'Stock_Quantity', 'op': 'in', 'value': first}},
+            {'rule_type': 'filter', 'condition': {'column': 'Stock_Quantity', 'op': 'in', 'value': [first, second]}},
+        ]
+        response = client.post('/process', json={'rules': numeric_in, 'session_id': session_id})
+        assert response.status_code == 200, f"Process failed: {response.get_data(as_text=True)}"
+        rows = {f['filename']: f['rows'] for f in response.get_json()['files']}
+        assert rows == {f'Stock_Quantity_{first}.xlsx': (df['Stock_Quantity'] == first).sum(),
+                        f'Stock_Quantity_{first}_{second}.xlsx': df['Stock_Quantity'].isin([first, second]).sum()}, \
+            f"Numeric 'in' rules wrote {rows}"
+        response = client.put('/rule-sets/numeric-in', json={'rules': numeric_in, 'session_id': session_id})
+        assert response.status_code in (200, 201), f"Saving numeric 'in' rules failed: {response.get_data(as_text=True)}"
+        client.delete('/rule-sets/numeric-in')
+    
+    # = and != on a date column compare dates, as the other comparisons do; text still matches exactly
+    dated = df.assign(Launch_Date=dates, Launch_Text=df['Launch_Date'])
+    day = str(dates.iloc[0].date())
+    for column in ('Launch_Date', 'Launch_Text'):
+        equal = {'rule_type': 'filter', 'condition': {'column': column, 'op': '=', 'value': day}}
+        not_equal = {'rule_type': 'filter', 'condition': {'column': column, 'op': '!=', 'value': day}}
+        assert len(splitting.apply_rule(dated, equal)) == (dates == day).sum() > 0, f"= on {column} missed its date"
+        assert len(splitting.apply_rule(dated, not_equal)) == (dates != day).sum(), f"!= on {column} kept its date"
+    
+    # Each condition is one vectorized comparison, evaluated once however many rules share it
+    predicates, _ = splitting.plan_rules(rules + [rules[0]])
+    assert sorted(key[0] for key in predicates) == ['between', 'compare', 'compare', 'compare', 'in', 'prefix', 'window']
+    print(f"✅ Condition rules match pandas: {expected}")
+    
+    return True
+
+def test_values_paging_windows():
+    """Test that /values answers the out-of-order windows a scrolled value picker asks for
+    
+    Only the server side is covered: /values paging and that the page ships the picker. The
+    picker's windowing and caching in the browser are not exercised here.
+    """
+    print("\n🪟 Testing /values paging windows...")
+    
+    import random
+    import app as app_module
+    from create_sample_data import build_sample_frame
+    
+    # Tens of thousands of distinct values, as in a column of IDs
+    df = build_sample_frame(30000, seed=7)
+    with app_module.app.test_client() as client:
+        page = client.get('/').get_data(as_text=True)
+        assert 'value-list-spacer' in page and 'valueStore' in page, "Page has no windowed value picker"
+        
+        data = df.to_csv(index=False).encode('utf-8')
+        session_id = client.post('/upload', data={'file': (io.BytesIO(data), 'ids.csv')},
+                                 content_type='multipart/form-data').get_json()['session_id']
+        
+        def window(offset, q=''):
+            response = client.get('/values', query_string={'session_id': session_id, 'column': 'Product_ID', 'q': q,
+                                                           'match': 'contains', 'offset': offset, 'limit': 100})
+            assert response.status_code == 200, f"/values failed: {response.get_data(as_text=True)}"
+            return response.get_json()
+        
+        # Windows fetched in scroll order, jumping around, must tile the same list as reading it in order
+        offsets = list(range(0, 30000, 100))
+        random.Random(7).shuffle(offsets)
+        windows = {offset: window(offset) for offset in offsets}
+        assert {page['total'] for page in windows.values()} == {30000}, "Total changed between windows"
+        values = [item['value'] for offset in sorted(windows) for item in windows[offset]['values']]
+        assert len(values) == len(set(values)) == 30000, "Windows overlap or leave gaps"
+        assert values == sorted(values), "Windows are not in one stable order"
+        
+        searched = window(0, 'PROD2999')
+        assert searched['total'] == df['Product_ID'].str.contains('prod2999', case=False).sum()
+    print("✅ 300 out-of-order windows tiled 30,000 values")
+    
+    return True
+
+def test_process_pool():
+    """Test that PROCESS_WORKERS writes the same files as the request process, and that a rule
+    failing in a worker is reported without losing the others"""
+    print("\n🏭 Testing process pool writers...")
+    
+    import pandas as pd
+    import app as app_module
+    
+    rules = [
+        {'rule_type': 'single', 'column1': 'Gender', 'value1': ['Men'], 'custom_name': 'pool_men'},
+        {'rule_type': 'split', 'columns': ['Season'], 'custom_name': 'pool_season'},
+        {'rule_type': 'single', 'column1': 'Gender', 'value1': ['Women'], 'custom_name': 'pool_fail'},
+    ]
+    request = {'rules': rules, 'output_format': 'csv', 'output_columns': ['Product_ID', 'Gender', 'Season']}
+    
+    def run(client, session_id, workers):
+        app_module.PROCESS_WORKERS = workers
+        app_module.registry().execute('DELETE FROM output_memo')  # Write every file, don't link earlier ones
+        response = client.post('/process', json=dict(request, session_id=session_id))
+        assert response.status_code == 200, f"Process failed: {response.get_data(as_text=True)}"
+        result = response.get_json()
+        folder = app_module.run_output_dir(result['run_id'])
+        return result, {f['filename']: pd.read_csv(os.path.join(folder, f['filename'])) for f in result['files']}
+    
+    workers, write_rows_task = app_module.PROCESS_WORKERS, app_module.write_rows_task
+    try:
+        with app_module.app.test_client() as client:
+            session_id = upload_sample(client)['session_id']
+            app_module.write_rows_task = write_rows_or_fail
+            pooled, pooled_files = run(client, session_id, 2)
+            app_module.write_rows_task = write_rows_task
+            local, local_files = run(client, session_id, 0)
+    finally:
+        app_module.PROCESS_WORKERS, app_module.write_rows_task = workers, write_rows_task
+        app_module.reset_process_pool()
+    
+    assert pooled['failed_files'] == [{'filename': 'pool_fail.csv', 'rule': 3}], f"Failure not reported: {pooled}"
+    assert sorted(pooled_files) == sorted(name for name in local_files if name != 'pool_fail.csv'), \
+        f"Pool wrote {sorted(pooled_files)}, the request process {sorted(local_files)}"
+    assert 'pool_men.csv' in pooled_files and any(name.startswith('pool_season_') for name in pooled_files)
+    for name, df in pooled_files.items():
+        pd.testing.assert_frame_equal(df, local_files[name], obj=name)
+    print(f"✅ {len(pooled_files)} files from 2 worker processes match the in-process ones; the failing rule was reported")
+    
+    return True
+
 def main():
     """Run all tests"""
     print("🧪 Excel Splitter Application Test Suite")
@@ -98,6 +1175,98 @@ def main():
     if not test_flask_app():
         return False
     
+    # Test 4: Dataset cache
+    if not test_dataset_cache():
+        return False
+    
+    # Test 5: Streaming ingestion
+    if not test_streaming_ingest():
+        return False
+    
+    # Test 6: Rule planner
+    if not test_rule_planner():
+        return False
+    
+    # Test 7: Streaming writer
+    if not test_streaming_writer():
+        return False
+    
+    # Test 8: Asynchronous jobs
+    if not test_async_job():
+        return False
+    
+    # Test 9: Split by column values
+    if not test_split_by_columns():
+        return False
+    
+    # Test 10: Single-workbook output
+    if not test_workbook_output():
+        return False
+    
+    # Test 11: Column value index
+    if not test_value_index():
+        return False
+    
+    # Test 12: Match-count preview
+    if not test_preview():
+        return False
+    
+    # Test 13: Chunked uploads
+    if not test_chunked_upload():
+        return False
+    
+    # Test 14: Shared registry
+    if not test_shared_registry():
+        return False
+    
+    # Test 15: Run outputs and memoization
+    if not test_output_memo():
+        return False
+    
+    # Test 16: Disk janitor
+    if not test_disk_janitor():
+        return False
+    
+    # Test 17: CSV and Parquet
+    if not test_csv_parquet():
+        return False
+    
+    # Test 18: Stage metrics
+    if not test_metrics():
+        return False
+    
+    # Test 19: Data generator and benchmark
+    if not test_benchmark():
+        return False
+    
+    # Test 20: Batch split CLI
+    if not test_batch_split():
+        return False
+    
+    # Test 21: Saved rule sets
+    if not test_rule_sets():
+        return False
+    
+    # Test 22: Memory-aware loading and admission control
+    if not test_memory_admission():
+        return False
+    
+    # Test 23: Lazy output mode
+    if not test_lazy_output():
+        return False
+    
+    # Test 24: Range, comparison and date conditions
+    if not test_condition_rules():
+        return False
+    
+    # Test 25: /values paging windows
+    if not test_values_paging_windows():
+        return False
+    
+    # Test 26: Process pool writers
+    if not test_process_pool():
+        return False
+    
     print("\n" + "=" * 50)
     print("🎉 All tests passed! Your application is ready to run.")
     print("\n📋 Next steps:")